@@ -1,15 +1,20 @@
+from functools import lru_cache
+
 from django import template
 from django.core.exceptions import ImproperlyConfigured
 
 from classytags.exceptions import InvalidFlag
 from classytags.utils import NULL, TemplateConstant, mixin
-from classytags.values import ChoiceValue, DictValue, IntegerValue, ListValue, StrictStringValue, StringValue
+from classytags.values import (
+    ChoiceSet, ChoiceValue, DictValue, IntegerValue, ListValue, StrictStringValue, StringValue,
+)
 
 
 class Argument:
     """
     A basic single value argument.
     """
+    __slots__ = ('name', 'default', 'required', 'resolve')
     value_class = StringValue
 
     def __init__(self, name, default=None, required=True, resolve=True):
@@ -33,6 +38,13 @@ class Argument:
         else:
             return TemplateConstant(token)
 
+    def wrap_value(self, var):
+        """
+        Wrap a parsed token in the value class, literals are resolved and
+        cleaned right away.
+        """
+        return self.value_class(var).fold()
+
     def parse(self, parser, token, tagname, kwargs):
         """
         Parse a token.
@@ -41,11 +53,12 @@ class Argument:
             return False
         else:
             value = self.parse_token(parser, token)
-            kwargs[self.name] = self.value_class(value)
+            kwargs[self.name] = self.wrap_value(value)
             return True
 
 
 class StringArgument(Argument):
+    __slots__ = ()
     value_class = StrictStringValue
 
 
@@ -53,6 +66,7 @@ class KeywordArgument(Argument):
     """
     A single 'key=value' argument
     """
+    __slots__ = ('defaultkey', 'splitter')
     wrapper_class = DictValue
 
     def __init__(self, name, default=None, required=True, resolve=True,
@@ -76,7 +90,7 @@ class KeywordArgument(Argument):
         else:
             key = self.defaultkey
             value = super().parse_token(parser, token)
-        return key, self.value_class(value)
+        return key, self.wrap_value(value)
 
     def parse(self, parser, token, tagname, kwargs):
         if self.name in kwargs:  # pragma: no cover
@@ -93,13 +107,34 @@ class IntegerArgument(Argument):
     """
     Same as Argument but converts the value to integers.
     """
+    __slots__ = ()
     value_class = IntegerValue
 
 
+@lru_cache(maxsize=None)
+def choice_value_class(value_class):
+    """
+    Returns the combination of value_class and ChoiceValue holding the
+    choice_set of the argument in a slot, created once per value class. Its
+    values are created with the var and the choice_set.
+    """
+    def __init__(self, var, choice_set):
+        super(klass, self).__init__(var)
+        self.choice_set = choice_set
+
+    attrs = {'__slots__': ('choice_set',), '__init__': __init__}
+    if issubclass(value_class, ChoiceValue):
+        klass = type(value_class.__name__, (value_class,), attrs)
+    else:
+        klass = mixin(value_class, ChoiceValue, attrs=attrs)
+    return klass
+
+
 class ChoiceArgument(Argument):
     """
     An Argument which checks if it's value is in a predefined list of choices.
     """
+    __slots__ = ('choice_set',)
 
     def __init__(self, name, choices, default=None, required=True,
                  resolve=True):
@@ -108,20 +143,18 @@ class ChoiceArgument(Argument):
             value_on_error = default
         else:
             value_on_error = choices[0]
-        self.value_class = mixin(
-            self.value_class,
-            ChoiceValue,
-            attrs={
-                'choices': choices,
-                'value_on_error': value_on_error,
-            }
-        )
+        self.choice_set = ChoiceSet(choices, value_on_error)
+
+    def wrap_value(self, var):
+        value_class = choice_value_class(self.value_class)
+        return value_class(var, self.choice_set).fold()
 
 
 class MultiValueArgument(Argument):
     """
     An argument which allows multiple values.
     """
+    __slots__ = ('max_values',)
     sequence_class = ListValue
     value_class = StringValue
 
@@ -138,7 +171,7 @@ class MultiValueArgument(Argument):
         """
         Parse a token.
         """
-        value = self.value_class(self.parse_token(parser, token))
+        value = self.wrap_value(self.parse_token(parser, token))
         if self.name in kwargs:
             if self.max_values and len(kwargs[self.name]) == self.max_values:
                 return False
@@ -149,6 +182,8 @@ class MultiValueArgument(Argument):
 
 
 class MultiKeywordArgument(KeywordArgument):
+    __slots__ = ('max_values',)
+
     def __init__(self, name, default=None, required=True, resolve=True,
                  max_values=None, splitter='='):
         if not default:
@@ -185,6 +220,11 @@ class Flag(Argument):
     """
     A boolean flag
     """
+    __slots__ = (
+        'case_sensitive', 'true_values', 'false_values', 'lookup',
+        'allowed_values',
+    )
+
     def __init__(self, name, default=NULL, true_values=None, false_values=None,
                  case_sensitive=False):
         if default is not NULL:
@@ -196,35 +236,42 @@ class Flag(Argument):
             true_values = []
         if false_values is None:
             false_values = []
-        if case_sensitive:
-            self.mod = lambda x: x
-        else:
-            self.mod = lambda x: str(x).lower()
+        self.case_sensitive = case_sensitive
         self.true_values = [self.mod(tv) for tv in true_values]
         self.false_values = [self.mod(fv) for fv in false_values]
         if not any([self.true_values, self.false_values]):
             raise ImproperlyConfigured(
                 "Flag must specify either true_values and/or false_values"
             )
+        # true values win over false values, like they always did
+        self.lookup = dict.fromkeys(self.false_values, TemplateConstant(False))
+        self.lookup.update(
+            dict.fromkeys(self.true_values, TemplateConstant(True))
+        )
+        self.allowed_values = tuple(self.true_values + self.false_values)
+
+    def mod(self, value):
+        """
+        Normalize a token or flag value for comparison
+        """
+        if self.case_sensitive:
+            return value
+        return str(value).lower()
 
     def parse(self, parser, token, tagname, kwargs):
         """
         Parse a token.
         """
-        ltoken = self.mod(token)
         if self.name in kwargs:
             return False
-        if self.true_values and ltoken in self.true_values:
-            kwargs[self.name] = TemplateConstant(True)
-        elif self.false_values and ltoken in self.false_values:
-            kwargs[self.name] = TemplateConstant(False)
+        try:
+            value = self.lookup[token]
+        except KeyError:
+            value = self.lookup.get(self.mod(token))
+        if value is not None:
+            kwargs[self.name] = value
         elif self.default is NULL:
-            allowed_values = []
-            if self.true_values:
-                allowed_values += self.true_values
-            if self.false_values:
-                allowed_values += self.false_values
-            raise InvalidFlag(self.name, token, allowed_values, tagname)
+            raise InvalidFlag(self.name, token, self.allowed_values, tagname)
         else:
             kwargs[self.name] = self.get_default()
         return True
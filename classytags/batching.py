@@ -0,0 +1,28 @@
+"""
+Renders templates coalescing the Tag.load calls of their tags.
+
+While a template is rendered with render_to_string of this module, a tag
+loading a key which isn't known yet renders nothing. Once the template is
+rendered, all keys requested by its tags are loaded with a single batch_load
+call per implementation and the template is rendered again, the tags now
+finding their keys loaded.
+"""
+from django.utils.safestring import mark_safe
+
+from classytags.helpers import template_context
+from classytags.utils import Batch
+
+
+def render_to_string(template_name, context=None, request=None):
+    """
+    Same as django.template.loader.render_to_string, batching the loads of
+    the tags in the template.
+    """
+    batch = Batch(defer=True)
+
+    def render():
+        with template_context(template_name, context, request) as (compiled, bound):
+            bound.render_context.dicts[0][Batch] = batch
+            return compiled.nodelist.render(bound)
+
+    return mark_safe(batch.render(render))
@@ -25,11 +25,50 @@ class BlockDefinition:
     def collect(self, parser):
         return [_collect(name, parser) for name in self.names]
 
+    @property
+    def static(self):
+        """
+        Whether the names of this block are the same for every parse.
+        """
+        return type(self).collect is BlockDefinition.collect and not any(
+            callable(getattr(name, 'collect', None)) for name in self.names
+        )
+
+
+class BlockIdentifiers:
+    """
+    The identifiers of a sequence of blocks as walked by the parser: for each
+    block the set of names ending it and the names ending it or any later
+    block, in the order the template parser reports them in errors.
+    """
+    __slots__ = ('ends', 'until')
+
+    def __init__(self, identifiers):
+        self.ends = tuple(frozenset(names) for names in identifiers)
+        until = []
+        following = ()
+        for names in reversed(identifiers):
+            following = tuple(names) + following
+            until.append(following)
+        self.until = tuple(reversed(until))
+
+    @classmethod
+    def compile(cls, blocks):
+        """
+        Returns the identifiers of blocks if all of them are static, otherwise
+        None since they have to be collected on every parse.
+        """
+        if all(block.static for block in blocks):
+            return cls([block.collect(None) for block in blocks])
+        return None
+
 
 class VariableBlockName:
     def __init__(self, template, argname):
         self.template = template
         self.argname = argname
+        # formatted names by argument literal
+        self.names = {}
 
     def validate(self, options):
         if self.argname not in options.all_argument_names:
@@ -40,5 +79,9 @@ class VariableBlockName:
             )
 
     def collect(self, parser):
-        value = parser.kwargs[self.argname]
-        return self.template % {'value': value.literal}
+        literal = parser.kwargs[self.argname].literal
+        try:
+            return self.names[literal]
+        except KeyError:
+            name = self.names[literal] = self.template % {'value': literal}
+            return name
@@ -1,10 +1,20 @@
+import asyncio
+from contextvars import ContextVar
 from operator import attrgetter
 
 from django.template import Node
+from django.template.base import TextNode
+from django.utils.safestring import SafeString
+
+from asgiref.sync import async_to_sync, sync_to_async
 
 from classytags.blocks import BlockDefinition
 from classytags.parser import Parser
-from classytags.utils import StructuredOptions, get_default_name
+from classytags.utils import (
+    NULL, Batch, Deferred, LRUCache, ParsePlan, StructuredOptions, TemplateConstant, get_default_name, get_location,
+    iter_filters, make_hashable, set_source,
+)
+from classytags.values import ConstantValue
 
 
 class Options:
@@ -47,6 +57,12 @@ class Options:
             self.parser_class = kwargs['parser_class']
         else:
             self.parser_class = Parser
+        self.plan = ParsePlan(
+            self.options,
+            self.breakpoints,
+            self.blocks,
+            self.combined_breakpoints
+        )
 
     def __repr__(self):
         bits = list(map(repr, self.options[None]))
@@ -89,12 +105,7 @@ class Options:
         """
         Bootstrap this options
         """
-        return StructuredOptions(
-            self.options,
-            self.breakpoints,
-            self.blocks,
-            self.combined_breakpoints
-        )
+        return StructuredOptions(self.plan)
 
     def parse(self, parser, tokens):
         """
@@ -105,6 +116,46 @@ class Options:
         return argument_parser.parse(parser, tokens)
 
 
+class ParseCache(LRUCache):
+    """
+    Process wide cache of the parsed arguments of tags without blocks, keyed by
+    tag class and token contents.
+
+    Cached arguments are only reused if every filter they use is still the
+    filter registered under that name for the template being parsed.
+    """
+    def __init__(self, maxsize=1024):
+        super().__init__(maxsize)
+        self.stale = 0
+
+    def clear(self):
+        super().clear()
+        self.stale = 0
+
+    def parse(self, tag, parser, tokens):
+        key = (tag.__class__, tokens.contents)
+        entry = self.get(key)
+        if entry is not None:
+            kwargs, filters = entry
+            available = getattr(parser, 'filters', {})
+            if all(available.get(name) is func for name, func in filters):
+                return dict(kwargs), {}
+            self.stale += 1
+        kwargs, blocks = tag.options.parse(parser, tokens)
+        filters = tuple(
+            (getattr(func, '_filter_name', None), func)
+            for value in kwargs.values() for func in iter_filters(value)
+        )
+        self.set(key, (kwargs, filters))
+        return dict(kwargs), blocks
+
+
+parse_cache = ParseCache()
+
+
+prefetched = ContextVar('classytags_prefetched', default=None)
+
+
 class TagMeta(type):
     """
     Metaclass for the Tag class that set's the name attribute onto the class
@@ -114,7 +165,12 @@ class TagMeta(type):
             return super().__new__(cls, name, bases, attrs)
         tag_name = str(attrs.get('name', get_default_name(name)))
         attrs['name'] = tag_name
-        return super().__new__(cls, tag_name, bases, attrs)
+        klass = super().__new__(cls, tag_name, bases, attrs)
+        if klass.pure and not klass.options.blocks:
+            klass.render_cache = LRUCache(klass.cache_size)
+        else:
+            klass.render_cache = None
+        return klass
 
 
 class Tag(TagMeta('TagMeta', (Node,), {})):
@@ -123,29 +179,262 @@ class Tag(TagMeta('TagMeta', (Node,), {})):
     """
     options = Options()
     name = None
+    cache_parse = False
+    pure = False
+    cache_size = 128
+    render_cache = None
+    # set by prepare_render on the first render
+    resolvers = None
+    static_kwargs = None
 
     def __init__(self, parser, tokens):
-        self.kwargs, self.blocks = self.options.parse(parser, tokens)
+        # Django sets these once the tag is added to its nodelist, setting
+        # them here makes them available while parsing and for tags created
+        # directly
+        self.token = tokens
+        self.origin = getattr(parser, 'origin', None)
+        if self.cache_parse and not self.options.blocks:
+            self.kwargs, self.blocks = parse_cache.parse(self, parser, tokens)
+        else:
+            self.kwargs, self.blocks = self.options.parse(parser, tokens)
         self.child_nodelists = []
         for key, value in self.blocks.items():
             setattr(self, key, value)
             self.child_nodelists.append(key)
 
+    @property
+    def call_site(self):
+        """
+        The (template name, line) this tag was parsed from
+        """
+        return get_location(self.origin, self.token)
+
+    def prepare_render(self):
+        """
+        Split the arguments into those which need to be resolved when rendering
+        and those which don't. Called on the first render, so subclasses may
+        change kwargs or blocks after initialization. Must be called again if
+        they are changed after the tag was rendered.
+        """
+        resolvers = []
+        static_kwargs = {}
+        for key, value in self.kwargs.items():
+            if isinstance(value, (ConstantValue, TemplateConstant)):
+                static_kwargs[key] = value.resolve(None)
+            else:
+                set_source(value, (self.name, key))
+                resolvers.append((key, value))
+        static_kwargs.update(self.blocks)
+        self.static_kwargs = static_kwargs
+        self.resolvers = tuple(resolvers)
+
+    def resolve_kwargs(self, context):
+        """
+        Returns a new dictionary of the resolved arguments and the blocks
+        """
+        if self.resolvers is None:
+            self.prepare_render()
+        kwargs = self.static_kwargs.copy()
+        for key, value in self.resolvers:
+            kwargs[key] = value.resolve(context)
+        return kwargs
+
     def render(self, context):
         """
         INTERNAL method to prepare rendering
         Usually you should not override this method, but rather use render_tag.
         """
-        items = self.kwargs.items()
-        kwargs = {key: value.resolve(context) for key, value in items}
-        kwargs.update(self.blocks)
-        return str(self.render_tag(context, **kwargs))
+        kwargs = self.resolve_kwargs(context)
+        try:
+            if self.render_cache is None:
+                output = self.render_tag(context, **kwargs)
+            else:
+                output = self.render_tag_cached(context, kwargs)
+        except Deferred:
+            # the output is discarded once the keys requested are collected
+            return ''
+        if isinstance(output, str):
+            return output
+        return str(output)
+
+    async def arender(self, context):
+        """
+        INTERNAL method to prepare rendering asynchronously
+        Usually you should not override this method, but rather use
+        arender_tag. Arguments which aren't constant are resolved in a thread
+        since resolving variables may query the database.
+        """
+        if self.resolvers is None:
+            self.prepare_render()
+        if self.resolvers:
+            kwargs = await sync_to_async(self.resolve_kwargs)(context)
+        else:
+            kwargs = self.resolve_kwargs(context)
+        if self.render_cache is None:
+            output = await self.arender_tag(context, **kwargs)
+        else:
+            output = await self.arender_tag_cached(context, kwargs)
+        if isinstance(output, str):
+            return output
+        return str(output)
+
+    def render_tag_cached(self, context, kwargs):
+        """
+        Used instead of render_tag for pure tags
+        """
+        return self.call_cached(self.render_tag, context, kwargs)
+
+    async def arender_tag_cached(self, context, kwargs):
+        """
+        Used instead of arender_tag for pure tags
+        """
+        return await self.acall_cached(self.arender_tag, context, kwargs)
+
+    def call_cached(self, func, context, kwargs):
+        """
+        Returns func(context, **kwargs), memoized in render_cache by the
+        arguments. Called through if the arguments can't be hashed.
+        """
+        try:
+            key = (func.__name__, make_hashable(sorted(kwargs.items())))
+        except TypeError:
+            return func(context, **kwargs)
+        result = self.render_cache.get(key, NULL)
+        if result is NULL:
+            result = func(context, **kwargs)
+            self.render_cache.set(key, result)
+        return result
+
+    async def acall_cached(self, func, context, kwargs):
+        """
+        Same as call_cached for coroutine functions
+        """
+        try:
+            key = (func.__name__, make_hashable(sorted(kwargs.items())))
+        except TypeError:
+            return await func(context, **kwargs)
+        result = self.render_cache.get(key, NULL)
+        if result is NULL:
+            result = await func(context, **kwargs)
+            self.render_cache.set(key, result)
+        return result
 
     def render_tag(self, context, **kwargs):
         """
-        The method you should override in your custom tags
+        The method you should override in your custom tags. Tags which only
+        override arender_tag are rendered by running it in the event loop.
         """
+        if type(self).arender_tag is not Tag.arender_tag:
+            return async_to_sync(self.arender_tag)(context, **kwargs)
         raise NotImplementedError
 
+    async def arender_tag(self, context, **kwargs):
+        """
+        The method you should override in your custom tags to render them
+        asynchronously, by default calls render_tag in a thread, as synchronous
+        code may query the database and blocks may hold tags which only render
+        asynchronously.
+        """
+        return await sync_to_async(self.render_tag)(context, **kwargs)
+
+    def prefetch(self, context, **kwargs):
+        """
+        Override this to load data for this tag concurrently with the other
+        tags of a template before it is rendered, see classytags.prefetch
+        """
+        return None
+
+    async def aprefetch(self, context, **kwargs):
+        """
+        Same as prefetch when prefetching asynchronously, by default calls
+        prefetch in a thread
+        """
+        return await asyncio.to_thread(self.prefetch, context, **kwargs)
+
+    def get_prefetch_kwargs(self, context):
+        """
+        Returns the arguments prefetch is called with
+        """
+        return self.resolve_kwargs(context)
+
+    def has_prefetch(self):
+        """
+        Whether this tag overrides prefetch or aprefetch
+        """
+        klass = type(self)
+        return (
+            klass.prefetch is not Tag.prefetch
+            or klass.aprefetch is not Tag.aprefetch
+        )
+
+    def load(self, context, key):
+        """
+        Returns the value batch_load returns for key. Within one render the
+        keys loaded by all tags of this class are loaded with as few
+        batch_load calls as possible and the values are memoized.
+        """
+        if getattr(context, 'render_context', None) is None:
+            return Batch().load(self, key)
+        return Batch.get(context).load(self, key)
+
+    def batch_load(self, keys):
+        """
+        Override this to load many keys at once for load, returning either a
+        list of values in the order of keys or a dictionary
+        """
+        raise NotImplementedError
+
+    def find_prefetched(self, kwargs):
+        """
+        Returns the result prefetched for this tag and these arguments, or
+        NULL if there is none
+        """
+        results = prefetched.get()
+        if results is None or self not in results:
+            return NULL
+        prefetch_kwargs, result = results[self]
+        if prefetch_kwargs != kwargs:
+            return NULL
+        return result
+
+    def get_prefetched(self, context, **kwargs):
+        """
+        Returns the result of prefetch for these arguments, as loaded ahead of
+        rendering or by calling prefetch now if it wasn't.
+        """
+        result = self.find_prefetched(kwargs)
+        if result is NULL:
+            result = self.prefetch(context, **kwargs)
+        return result
+
+    async def aget_prefetched(self, context, **kwargs):
+        """
+        Same as get_prefetched, awaiting aprefetch if needed
+        """
+        result = self.find_prefetched(kwargs)
+        if result is NULL:
+            result = await self.aprefetch(context, **kwargs)
+        return result
+
     def __repr__(self):
         return '<Tag: %s>' % self.name
+
+
+async def arender_nodelist(nodelist, context):
+    """
+    Renders a nodelist like NodeList.render, awaiting Tag.arender of the tags
+    at its top level. Other nodes than text, which may hold tags ({% if %},
+    {% for %}, {% extends %}...) or resolve variables querying the database,
+    are rendered synchronously in a thread, where the tags
+    nested in them run arender_tag in the event loop if they only override
+    it.
+    """
+    bits = []
+    for node in nodelist:
+        if isinstance(node, Tag):
+            bits.append(await node.arender(context))
+        elif isinstance(node, TextNode):
+            bits.append(node.render_annotated(context))
+        else:
+            bits.append(await sync_to_async(node.render_annotated)(context))
+    return SafeString(''.join(bits))
@@ -0,0 +1,134 @@
+"""
+Aggregates the errors of values which failed to clean while DEBUG is off.
+
+Instead of a warning for every failed clean, the first error of each (tag,
+argument, category) is warned about and repeats are only counted. A bounded
+summary of the repeats is warned about once per interval, or at the end of
+every request if per_request is set. The counters are available through
+collector.snapshot().
+"""
+import warnings
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic
+
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+from classytags.exceptions import TemplateSyntaxWarning
+
+
+# the (tag, argument) names of the argument being parsed
+parsing = ContextVar('classytags_parsing', default=None)
+
+
+class Entry:
+    """
+    The counters of a (tag, argument, category) and its last error.
+    """
+    __slots__ = ('total', 'pending', 'source', 'value')
+
+    def __init__(self):
+        self.total = 0
+        self.pending = 0
+        self.source = None
+        self.value = None
+
+    def message(self, category):
+        return self.source.get_error_message(self.value, category)
+
+
+class Diagnostics:
+    """
+    Thread safe counters of value errors keyed by (tag, argument, category).
+    """
+    def __init__(self, interval=60, limit=10, per_request=False):
+        self.interval = interval
+        self.limit = limit
+        self.per_request = per_request
+        self.lock = Lock()
+        self.entries = {}
+        self.pending = False
+        self.emitted = monotonic()
+
+    def record(self, source, value, category, tag=None, argument=None):
+        """
+        Counts the error of the value source failing to clean value in the
+        argument of the tag named, warns about it if it is the first of its
+        key since the last summary and emits the summary once interval passed.
+        The message is only formatted when it is warned about.
+        """
+        key = (tag, argument, category)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = Entry()
+            entry.total += 1
+            entry.pending += 1
+            entry.source = source
+            entry.value = value
+            self.pending = True
+            first = entry.pending == 1
+            due = monotonic() - self.emitted >= self.interval
+        if first:
+            warnings.warn(
+                source.get_error_message(value, category),
+                TemplateSyntaxWarning,
+            )
+        if due:
+            self.emit()
+
+    def emit(self):
+        """
+        Warns about the errors repeated since the last summary, at most limit
+        of them, and starts a new interval.
+        """
+        repeated = []
+        with self.lock:
+            for key, entry in self.entries.items():
+                if entry.pending > 1:
+                    repeated.append(
+                        (key, entry.pending - 1, entry.message(key[2]))
+                    )
+                entry.pending = 0
+                entry.source = entry.value = None
+            self.pending = False
+            self.emitted = monotonic()
+        if repeated:
+            repeated.sort(key=lambda item: -item[1])
+            warnings.warn(self.format_summary(repeated), TemplateSyntaxWarning)
+
+    def format_summary(self, repeated):
+        lines = ['%d value errors repeated since the last summary:' % sum(
+            count for key, count, message in repeated
+        )]
+        for (tag, argument, category), count, message in repeated[:self.limit]:
+            lines.append('  %s (tag %r, argument %r): %d times, last: %s' % (
+                category, tag, argument, count, message
+            ))
+        if len(repeated) > self.limit:
+            lines.append('  and %d more' % (len(repeated) - self.limit))
+        return '\n'.join(lines)
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the total number of errors per (tag, argument,
+        category) since the last reset.
+        """
+        with self.lock:
+            return {key: entry.total for key, entry in self.entries.items()}
+
+    def reset(self):
+        with self.lock:
+            self.entries = {}
+            self.pending = False
+            self.emitted = monotonic()
+
+
+collector = Diagnostics()
+
+
+@receiver(request_finished)
+def request_summary(sender, **kwargs):
+    if collector.per_request and collector.pending:
+        collector.emit()
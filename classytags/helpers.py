@@ -1,8 +1,135 @@
+from contextlib import contextmanager
+from functools import partial
+from hashlib import md5
+
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
 from django.core.exceptions import ImproperlyConfigured
-from django.template.loader import render_to_string
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import Context
+from django.template.backends.django import Template as DjangoBackendTemplate
+from django.template.context import make_context
+from django.template.loader import get_template, select_template
+from django.utils.autoreload import file_changed
+
+from asgiref.sync import async_to_sync, sync_to_async
+
+from classytags.core import Tag, arender_nodelist
+from classytags.utils import PENDING, Deferred, LRUCache, flatten_context, lazy_flatten_context
+
+
+template_versions = LRUCache(256)
+
+
+def get_template_version(template_name):
+    """
+    Returns a digest of the source of the template (or the first of a list of
+    templates) which exists, computed once per template name.
+    """
+    if isinstance(template_name, (list, tuple)):
+        template_name = tuple(template_name)
+    version = template_versions.get(template_name)
+    if version is None:
+        template = load_template(template_name)
+        source = getattr(getattr(template, 'template', None), 'source', '')
+        version = md5(source.encode(), usedforsecurity=False).hexdigest()
+        template_versions.set(template_name, version)
+    return version
+
+
+def get_nodelist_version(nodelist):
+    """
+    Returns a digest of the source of the nodes in nodelist and nested in
+    them, built from the contents of their tokens.
+    """
+    digest = md5(usedforsecurity=False)
+    stack = [nodelist]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            digest.update(item.encode())
+            continue
+        for node in reversed(item):
+            children = []
+            for attr in node.child_nodelists:
+                child = getattr(node, attr, None)
+                if child:
+                    children.extend(['[%s:' % attr, child, ']'])
+            token = getattr(node, 'token', None)
+            stack.extend(reversed(children))
+            stack.append('%s\x00%s\x00' % (
+                type(node).__name__, getattr(token, 'contents', '')
+            ))
+    return digest.hexdigest()
+
+
+def load_template(template_name):
+    """
+    Returns the compiled template for a template name or the first of a list
+    of template names which exists.
+    """
+    if isinstance(template_name, (list, tuple)):
+        return select_template(template_name)
+    return get_template(template_name)
+
+
+@contextmanager
+def template_context(template_name, context=None, request=None):
+    """
+    Loads a template and binds it to a new context made of context and
+    request, like Template.render does. Yields the compiled template and the
+    context to render its nodelist with.
+    """
+    template = load_template(template_name)
+    compiled = template.template
+    context = make_context(
+        context, request, autoescape=template.backend.engine.autoescape
+    )
+    with context.render_context.push_state(compiled):
+        with context.bind_template(compiled):
+            context.template_name = compiled.name
+            yield compiled, context
+
+
+async def arender_to_string(template_name, context=None, request=None):
+    """
+    Same as django.template.loader.render_to_string, rendering the template
+    with arender_nodelist.
+    """
+    with template_context(template_name, context, request) as (compiled, context):
+        return await arender_nodelist(compiled.nodelist, context)
+
+
+def clear_template_caches():
+    """
+    Forget all templates compiled by inclusion tags and their versions.
+    """
+    template_versions.clear()
+    classes = [InclusionTag]
+    while classes:
+        klass = classes.pop()
+        klass.template_cache.clear()
+        classes.extend(klass.__subclasses__())
+
+
+@receiver(file_changed, dispatch_uid='classytags.helpers.file_changed')
+def template_changed(sender, file_path, **kwargs):
+    """
+    Template files are only loaded once, start over when any file changes
+    while the development server is running.
+    """
+    clear_template_caches()
+
 
-from classytags.core import Tag
-from classytags.utils import flatten_context
+@receiver(setting_changed, dispatch_uid='classytags.helpers.setting_changed')
+def template_setting_changed(sender, setting, **kwargs):
+    """
+    Start over when a setting Django resets its template engines for changes,
+    as override_settings does in tests.
+    """
+    if setting in {'TEMPLATES', 'DEBUG', 'INSTALLED_APPS'}:
+        clear_template_caches()
 
 
 class AsTag(Tag):
@@ -34,13 +161,81 @@ class AsTag(Tag):
         """
         varname = kwargs.pop(self.varname_name)
         if varname:
-            value = self.get_value_for_context(context, **kwargs)
+            value = self.call_deferred(
+                partial(self.get_value_for_context, context, **kwargs)
+            )
             context[varname] = value
             return ''
         else:
             value = self.get_value(context, **kwargs)
         return value
 
+    def call_deferred(self, func):
+        """
+        INTERNAL!
+
+        Calls func without arguments. If it waits for a key of a batch, the
+        varname is set to PENDING for the rest of the render, whose output is
+        discarded once the keys requested by all tags are loaded.
+        """
+        try:
+            return func()
+        except Deferred:
+            return PENDING
+
+    def render_tag_cached(self, context, kwargs):
+        """
+        INTERNAL!
+
+        Same as render_tag for pure tags, memoizing the value rather than the
+        output so the varname is set on every render.
+        """
+        varname = kwargs.pop(self.varname_name)
+        if varname:
+            value = self.call_deferred(partial(
+                self.call_cached, self.get_value_for_context, context, kwargs
+            ))
+            context[varname] = value
+            return ''
+        return self.call_cached(self.get_value, context, kwargs)
+
+    def get_prefetch_kwargs(self, context):
+        """
+        Returns the arguments prefetch is called with, which like those of
+        get_value don't include the varname.
+        """
+        kwargs = self.resolve_kwargs(context)
+        del kwargs[self.varname_name]
+        return kwargs
+
+    async def arender_tag(self, context, **kwargs):
+        """
+        INTERNAL!
+
+        Same as render_tag, awaiting aget_value_for_context or aget_value.
+        """
+        varname = kwargs.pop(self.varname_name)
+        if varname:
+            value = await self.aget_value_for_context(context, **kwargs)
+            context[varname] = value
+            return ''
+        return await self.aget_value(context, **kwargs)
+
+    async def arender_tag_cached(self, context, kwargs):
+        """
+        INTERNAL!
+
+        Same as render_tag_cached, awaiting the value.
+        """
+        varname = kwargs.pop(self.varname_name)
+        if varname:
+            value = await self.acall_cached(
+                self.aget_value_for_context, context, kwargs
+            )
+            context[varname] = value
+            return ''
+        return await self.acall_cached(self.aget_value, context, kwargs)
+
     def get_value_for_context(self, context, **kwargs):
         """
         Called when a value for a varname (in the "as varname" case) should is
@@ -53,10 +248,31 @@ class AsTag(Tag):
 
     def get_value(self, context, **kwargs):
         """
-        Returns the value for the current context and arguments.
+        Returns the value for the current context and arguments. Runs
+        aget_value in the event loop if only it is overridden.
         """
+        if type(self).aget_value is not AsTag.aget_value:
+            return async_to_sync(self.aget_value)(context, **kwargs)
         raise NotImplementedError
 
+    async def aget_value_for_context(self, context, **kwargs):
+        """
+        Same as get_value_for_context when rendering asynchronously. Calls
+        get_value_for_context if it is overridden, otherwise aget_value.
+        """
+        if type(self).get_value_for_context is not AsTag.get_value_for_context:
+            return await sync_to_async(self.get_value_for_context)(
+                context, **kwargs
+            )
+        return await self.aget_value(context, **kwargs)
+
+    async def aget_value(self, context, **kwargs):
+        """
+        Returns the value for the current context and arguments when rendering
+        asynchronously, by default calls get_value in a thread.
+        """
+        return await sync_to_async(self.get_value)(context, **kwargs)
+
 
 class InclusionTag(Tag):
     """
@@ -70,26 +286,160 @@ class InclusionTag(Tag):
     """
     template = None
     push_context = False
+    copy_context = True
+    template_cache_size = 16
+    template_cache = LRUCache(template_cache_size)
+    cache_timeout = None
+    cache_backend = 'default'
+    cache_version = None
+    # block name -> version of its nodes, set by get_block_version
+    block_versions = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.template_cache = LRUCache(cls.template_cache_size)
 
     def render_tag(self, context, **kwargs):
         """
         INTERNAL!
 
+        Renders the template, through the fragment cache if cache_timeout is
+        set.
+        """
+        if self.cache_timeout is None:
+            return self.render_template(context, **kwargs)
+        key = self.get_cache_key(context, **kwargs)
+        if key is None:
+            return self.render_template(context, **kwargs)
+        cache = caches[self.cache_backend]
+        output = cache.get(key)
+        if output is None:
+            output = self.render_template(context, **kwargs)
+            cache.set(key, output, self.cache_timeout)
+        return output
+
+    async def arender_tag(self, context, **kwargs):
+        """
+        INTERNAL!
+
+        Same as render_tag, awaiting aget_context and the fragment cache.
+        """
+        if self.cache_timeout is None:
+            return await self.arender_template(context, **kwargs)
+        key = await sync_to_async(self.get_cache_key)(context, **kwargs)
+        if key is None:
+            return await self.arender_template(context, **kwargs)
+        cache = caches[self.cache_backend]
+        output = await cache.aget(key)
+        if output is None:
+            output = await self.arender_template(context, **kwargs)
+            await cache.aset(key, output, self.cache_timeout)
+        return output
+
+    def render_template(self, context, **kwargs):
+        """
+        INTERNAL!
+
         Gets the context and data to render.
         """
-        template = self.get_template(context, **kwargs)
-        if self.push_context:
-            safe_context = flatten_context(context)
-            data = self.get_context(safe_context, **kwargs)
-            safe_context.update(**data)
-            output = render_to_string(template, safe_context)
-        else:
-            new_context = context.new(
-                flatten_context(self.get_context(context, **kwargs))
+        template = self.resolve_template(context, **kwargs)
+        depth = len(context.dicts)
+        target = self.get_context_target(context)
+        try:
+            data = self.get_context(target, **kwargs)
+            return self.render_data(template, context, target, data)
+        finally:
+            if self.push_context and not self.copy_context:
+                del context.dicts[depth:]
+
+    async def arender_template(self, context, **kwargs):
+        """
+        INTERNAL!
+
+        Same as render_template, awaiting aget_context. Like get_context,
+        get_template may query the database so the template is resolved in a
+        thread.
+        """
+        template = await sync_to_async(self.resolve_template)(
+            context, **kwargs
+        )
+        depth = len(context.dicts)
+        target = self.get_context_target(context)
+        try:
+            data = await self.aget_context(target, **kwargs)
+            # the template may hold tags which only render asynchronously
+            return await sync_to_async(self.render_data)(
+                template, context, target, data
             )
-            data = flatten_context(new_context)
-            output = render_to_string(template, data)
-        return output
+        finally:
+            if self.push_context and not self.copy_context:
+                del context.dicts[depth:]
+
+    def get_context_target(self, context):
+        """
+        INTERNAL!
+
+        Returns the context get_context is called with. With copy_context this
+        is a flat view of the context if push_context is set, otherwise the
+        context itself, pushed with push_context.
+        """
+        if not self.push_context:
+            return context
+        if self.copy_context:
+            return lazy_flatten_context(context)
+        context.push()
+        return context
+
+    def render_data(self, template, context, target, data):
+        """
+        INTERNAL!
+
+        Renders the template with the data returned by get_context, either
+        with a flat copy of the context (copy_context) or in new layers of it.
+        Layers pushed onto the current context are removed by the caller.
+        Templates of other backends than DjangoTemplates are rendered with a
+        flat dictionary.
+        """
+        if not isinstance(template, DjangoBackendTemplate):
+            if self.push_context:
+                flat = dict(flatten_context(target))
+                flat.update(flatten_context(data))
+            else:
+                flat = dict(flatten_context(data))
+            return template.render(flat)
+        if self.copy_context:
+            if self.push_context:
+                target.update(**data)
+            else:
+                target = lazy_flatten_context(
+                    context.new(flatten_context(data))
+                )
+            return template.template.render(
+                Context(target, autoescape=template.backend.engine.autoescape)
+            )
+        if not self.push_context:
+            new_context = context.new(data)
+            new_context.push()
+            return template.template.render(new_context)
+        if data is not context:
+            context.update(data)
+            context.push()
+        return template.template.render(context)
+
+    def resolve_template(self, context, **kwargs):
+        """
+        Returns the compiled template for the current context and arguments.
+        Templates are loaded once per name and kept in the template_cache of
+        the class.
+        """
+        template_name = self.get_template(context, **kwargs)
+        if isinstance(template_name, list):
+            template_name = tuple(template_name)
+        template = self.template_cache.get(template_name)
+        if template is None:
+            template = load_template(template_name)
+            self.template_cache.set(template_name, template)
+        return template
 
     def get_template(self, context, **kwargs):
         """
@@ -99,6 +449,47 @@ class InclusionTag(Tag):
 
     def get_context(self, context, **kwargs):
         """
-        Returns the context to render the template with.
+        Returns the context to render the template with. Runs aget_context in
+        the event loop if only it is overridden.
+        """
+        if type(self).aget_context is not InclusionTag.aget_context:
+            return async_to_sync(self.aget_context)(context, **kwargs)
+        return {}
+
+    async def aget_context(self, context, **kwargs):
         """
+        Returns the context to render the template with when rendering
+        asynchronously, by default calls get_context in a thread if it is
+        overridden.
+        """
+        if type(self).get_context is not InclusionTag.get_context:
+            return await sync_to_async(self.get_context)(context, **kwargs)
         return {}
+
+    def get_cache_key(self, context, **kwargs):
+        """
+        Returns the key to cache the output for the current context and
+        arguments under, or None to not cache it. By default the key varies on
+        the arguments, cache_version and the source of the template.
+        """
+        template = self.get_template(context, **kwargs)
+        vary_on = [self.cache_version, get_template_version(template)]
+        for key, value in sorted(kwargs.items()):
+            if key in self.blocks:
+                value = self.get_block_version(key)
+            vary_on.append('%s=%s' % (key, value))
+        return make_template_fragment_key('classytags.%s' % self.name, vary_on)
+
+    def get_block_version(self, name):
+        """
+        Returns the version of the block name of this tag in the cache key,
+        its call site and the digest of its nodes, computed once.
+        """
+        if self.block_versions is None:
+            self.block_versions = {}
+        version = self.block_versions.get(name)
+        if version is None:
+            version = self.block_versions[name] = '%s:%s:%s' % (
+                self.call_site + (get_nodelist_version(self.blocks[name]),)
+            )
+        return version
@@ -0,0 +1,850 @@
+"""
+Opt-in instrumentation of classy tags.
+
+Instruments wrap Tag.__init__ (parsing), Tag.render, Tag.arender and
+Tag.resolve_kwargs while they are enabled. The wrappers are set on Tag when an
+instrument is enabled and the original methods are put back once none is, so
+disabled instrumentation costs nothing.
+"""
+import sys
+from collections import deque
+from contextlib import ExitStack
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock, get_ident
+from time import perf_counter
+
+from django.db import connections
+
+from classytags.core import Tag
+from classytags.utils import get_location
+
+
+METHODS = ('__init__', 'render', 'arender', 'resolve_kwargs')
+
+originals = {name: Tag.__dict__[name] for name in METHODS}
+
+# the enabled instruments, in the order they were enabled
+active = []
+
+lock = Lock()
+
+
+def install():
+    """
+    Sets the instrumented methods of Tag to the originals wrapped by the
+    enabled instruments, the first one innermost.
+    """
+    for name, original in originals.items():
+        method = original
+        for instrument in active:
+            method = instrument.wrap(name, method)
+        setattr(Tag, name, method)
+
+
+class Instrument:
+    """
+    Base class of instruments, which implement a wrap_<name> method (without
+    the underscores of __init__) for each method they wrap, returning the
+    wrapper of the method it is given or the method itself to leave it alone.
+    """
+    def wrap(self, name, method):
+        wrapper = getattr(self, 'wrap_%s' % name.strip('_'), None)
+        if wrapper is None:
+            return method
+        wrapped = wrapper(method)
+        if wrapped is method:
+            return method
+        return wraps(method)(wrapped)
+
+    @property
+    def enabled(self):
+        return self in active
+
+    def enable(self):
+        with lock:
+            if self not in active:
+                active.append(self)
+                install()
+        return self
+
+    def disable(self):
+        with lock:
+            if self in active:
+                active.remove(self)
+                install()
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+
+
+def percentile(ordered, fraction):
+    """
+    Returns the nearest rank fraction percentile of the sorted list ordered,
+    or None if it is empty.
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class TagTimings:
+    """
+    Counters and timings of a tag, in seconds. durations holds the most recent
+    render times for the percentiles.
+    """
+    __slots__ = (
+        'parses', 'parse_time', 'renders', 'render_time', 'resolves',
+        'resolve_time', 'durations',
+    )
+
+    def __init__(self, samples):
+        self.parses = 0
+        self.parse_time = 0.0
+        self.renders = 0
+        self.render_time = 0.0
+        self.resolves = 0
+        self.resolve_time = 0.0
+        self.durations = deque(maxlen=samples)
+
+    def as_dict(self):
+        ordered = sorted(self.durations)
+        return {
+            'parses': self.parses,
+            'parse_time': self.parse_time,
+            'renders': self.renders,
+            'render_time': self.render_time,
+            'resolves': self.resolves,
+            'resolve_time': self.resolve_time,
+            'user_time': self.render_time - self.resolve_time,
+            'p50': percentile(ordered, 0.5),
+            'p90': percentile(ordered, 0.9),
+            'p99': percentile(ordered, 0.99),
+        }
+
+
+class Timings(Instrument):
+    """
+    Counts and times the parses and renders of tags by tag name, and the time
+    spent resolving their arguments. The percentiles are computed over the
+    last samples renders of each tag.
+    """
+    def __init__(self, samples=1024):
+        self.samples = samples
+        self.lock = Lock()
+        self.tags = {}
+
+    def get_timings(self, name):
+        """
+        Returns the TagTimings of the tag name, must be called holding lock.
+        """
+        timings = self.tags.get(name)
+        if timings is None:
+            timings = self.tags[name] = TagTimings(self.samples)
+        return timings
+
+    def add_parse(self, name, duration):
+        with self.lock:
+            timings = self.get_timings(name)
+            timings.parses += 1
+            timings.parse_time += duration
+
+    def add_render(self, name, duration):
+        with self.lock:
+            timings = self.get_timings(name)
+            timings.renders += 1
+            timings.render_time += duration
+            timings.durations.append(duration)
+
+    def add_resolve(self, name, duration):
+        with self.lock:
+            timings = self.get_timings(name)
+            timings.resolves += 1
+            timings.resolve_time += duration
+
+    def wrap_init(self, method):
+        def __init__(tag, parser, tokens):
+            start = perf_counter()
+            try:
+                method(tag, parser, tokens)
+            finally:
+                self.add_parse(tag.name, perf_counter() - start)
+        return __init__
+
+    def wrap_render(self, method):
+        def render(tag, context):
+            start = perf_counter()
+            try:
+                return method(tag, context)
+            finally:
+                self.add_render(tag.name, perf_counter() - start)
+        return render
+
+    def wrap_arender(self, method):
+        async def arender(tag, context):
+            start = perf_counter()
+            try:
+                return await method(tag, context)
+            finally:
+                self.add_render(tag.name, perf_counter() - start)
+        return arender
+
+    def wrap_resolve_kwargs(self, method):
+        def resolve_kwargs(tag, context):
+            start = perf_counter()
+            try:
+                return method(tag, context)
+            finally:
+                self.add_resolve(tag.name, perf_counter() - start)
+        return resolve_kwargs
+
+    def snapshot(self):
+        """
+        Returns a dictionary of the counters and timings of each tag name. The
+        render times include the tags rendered within, user_time is the part
+        not spent resolving the arguments of the tag.
+        """
+        with self.lock:
+            return {
+                name: timings.as_dict() for name, timings in self.tags.items()
+            }
+
+    def reset(self):
+        with self.lock:
+            self.tags = {}
+
+
+timings = Timings()
+
+
+# [tag, kwargs] of the render in progress, kwargs being set once resolved
+rendering = ContextVar('classytags_rendering', default=None)
+
+
+class Hooks(Instrument):
+    """
+    Registry of functions called around the parses and renders of tags:
+
+    * pre_parse(tag, parser, token)
+    * post_parse(tag, parser, token, error)
+    * pre_render(tag, context, kwargs), once the arguments are resolved
+    * post_render(tag, context, kwargs, output, error)
+
+    error is the exception raised by the parse or render, or None. The hooks
+    enable themselves while any function is registered and only wrap the
+    methods needed by the registered events.
+    """
+    EVENTS = ('pre_parse', 'post_parse', 'pre_render', 'post_render')
+
+    def __init__(self):
+        self.events = {event: () for event in self.EVENTS}
+
+    def register(self, event, func=None):
+        """
+        Registers func to be called on event, returns func. Without func,
+        returns a decorator registering the function it decorates.
+        """
+        if func is None:
+            return lambda func: self.register(event, func)
+        if event not in self.events:
+            raise ValueError(
+                'Unknown event %r, choose one of %r' % (event, self.EVENTS)
+            )
+        with lock:
+            self.events[event] += (func,)
+            self.update()
+        return func
+
+    def unregister(self, event, func):
+        with lock:
+            funcs = list(self.events[event])
+            funcs.remove(func)
+            self.events[event] = tuple(funcs)
+            self.update()
+
+    def update(self):
+        """
+        Enables or disables the hooks and installs the wrappers for the
+        registered events, must be called holding lock.
+        """
+        registered = any(self.events.values())
+        if registered and self not in active:
+            active.append(self)
+        elif not registered and self in active:
+            active.remove(self)
+        install()
+
+    def enable(self):
+        """
+        Hooks are enabled by registering functions
+        """
+        return self
+
+    def disable(self):
+        with lock:
+            self.events = {event: () for event in self.EVENTS}
+            self.update()
+
+    def wrap_init(self, method):
+        if not (self.events['pre_parse'] or self.events['post_parse']):
+            return method
+
+        def __init__(tag, parser, tokens):
+            for hook in self.events['pre_parse']:
+                hook(tag, parser, tokens)
+            try:
+                method(tag, parser, tokens)
+            except Exception as error:
+                for hook in self.events['post_parse']:
+                    hook(tag, parser, tokens, error)
+                raise
+            for hook in self.events['post_parse']:
+                hook(tag, parser, tokens, None)
+        return __init__
+
+    def wrap_render(self, method):
+        if not (self.events['pre_render'] or self.events['post_render']):
+            return method
+
+        def render(tag, context):
+            state = [tag, None]
+            token = rendering.set(state)
+            try:
+                output = method(tag, context)
+            except Exception as error:
+                for hook in self.events['post_render']:
+                    hook(tag, context, state[1], None, error)
+                raise
+            finally:
+                rendering.reset(token)
+            for hook in self.events['post_render']:
+                hook(tag, context, state[1], output, None)
+            return output
+        return render
+
+    def wrap_arender(self, method):
+        if not (self.events['pre_render'] or self.events['post_render']):
+            return method
+
+        async def arender(tag, context):
+            state = [tag, None]
+            token = rendering.set(state)
+            try:
+                output = await method(tag, context)
+            except Exception as error:
+                for hook in self.events['post_render']:
+                    hook(tag, context, state[1], None, error)
+                raise
+            finally:
+                rendering.reset(token)
+            for hook in self.events['post_render']:
+                hook(tag, context, state[1], output, None)
+            return output
+        return arender
+
+    def wrap_resolve_kwargs(self, method):
+        if not (self.events['pre_render'] or self.events['post_render']):
+            return method
+
+        def resolve_kwargs(tag, context):
+            kwargs = method(tag, context)
+            state = rendering.get()
+            # only the arguments resolved by the render of tag itself
+            if state is not None and state[0] is tag and state[1] is None:
+                state[1] = kwargs
+                for hook in self.events['pre_render']:
+                    hook(tag, context, kwargs)
+            return kwargs
+        return resolve_kwargs
+
+
+hooks = Hooks()
+
+
+def class_path(klass):
+    return '%s.%s' % (klass.__module__, klass.__qualname__)
+
+
+class SampledTimings:
+    """
+    Timings of the sampled renders of a tag class, in seconds. renders and
+    render_time are taken from the samples timed without profiling, phases
+    maps phase names to [calls, time] from the profiled samples.
+    """
+    __slots__ = ('renders', 'render_time', 'profiled', 'profiled_time', 'phases')
+
+    def __init__(self):
+        self.renders = 0
+        self.render_time = 0.0
+        self.profiled = 0
+        self.profiled_time = 0.0
+        self.phases = {}
+
+    def as_dict(self, every):
+        return {
+            'renders': self.renders,
+            'render_time': self.render_time,
+            'mean': self.render_time / self.renders if self.renders else None,
+            'estimated_renders': (self.renders + self.profiled) * every,
+            'phases': {
+                phase: {
+                    'calls': calls,
+                    'time': time,
+                    'share': time / self.profiled_time if self.profiled_time else None,
+                } for phase, (calls, time) in self.phases.items()
+            },
+        }
+
+
+class Sampler(Instrument):
+    """
+    Times one in every round(1 / rate) calls of Tag.render, aggregated by tag
+    class. Of those, one in every round(rate / profile_rate) samples is
+    profiled with sys.setprofile (in its thread only) instead to time the
+    phases, the calls of the methods named in PHASES, by the class of their
+    tag. Profiling slows a render down severalfold, so profile_rate is much
+    smaller than rate. The phase times include the profiling overhead, their
+    share of the profiled render times of their class is a better estimate.
+    """
+    PHASES = frozenset(['render_tag', 'get_context', 'get_value'])
+
+    def __init__(self, rate=0.01, profile_rate=0.0001):
+        self.every = max(1, round(1 / rate))
+        self.countdown = self.every
+        # samples per profiled sample, 0 to never profile
+        self.profile_every = max(1, round(rate / profile_rate)) if profile_rate else 0
+        self.profile_countdown = self.profile_every
+        self.lock = Lock()
+        self.tags = {}
+
+    def get_timings(self, klass):
+        """
+        Returns the SampledTimings of klass, must be called holding lock.
+        """
+        timings = self.tags.get(klass)
+        if timings is None:
+            timings = self.tags[klass] = SampledTimings()
+        return timings
+
+    def wrap_render(self, method):
+        def render(tag, context):
+            self.countdown -= 1
+            if self.countdown > 0:
+                return method(tag, context)
+            self.countdown = self.every
+            if self.profile_every:
+                self.profile_countdown -= 1
+                if self.profile_countdown <= 0:
+                    self.profile_countdown = self.profile_every
+                    if sys.getprofile() is None:
+                        return self.profile(method, tag, context)
+            start = perf_counter()
+            try:
+                return method(tag, context)
+            finally:
+                duration = perf_counter() - start
+                with self.lock:
+                    timings = self.get_timings(type(tag))
+                    timings.renders += 1
+                    timings.render_time += duration
+        return render
+
+    def profile(self, method, tag, context):
+        """
+        Renders tag with a profile function timing its phases
+        """
+        phases = self.PHASES
+        starts = {}
+        calls = []
+
+        def profile(frame, event, arg):
+            if event == 'call':
+                if frame.f_code.co_name in phases:
+                    starts[frame] = perf_counter()
+            elif event == 'return' and frame in starts:
+                duration = perf_counter() - starts.pop(frame)
+                instance = frame.f_locals.get('self')
+                if isinstance(instance, Tag):
+                    calls.append((type(instance), frame.f_code.co_name, duration))
+
+        sys.setprofile(profile)
+        start = perf_counter()
+        try:
+            return method(tag, context)
+        finally:
+            duration = perf_counter() - start
+            sys.setprofile(None)
+            with self.lock:
+                timings = self.get_timings(type(tag))
+                timings.profiled += 1
+                timings.profiled_time += duration
+                for klass, phase, time in calls:
+                    entry = self.get_timings(klass).phases.setdefault(
+                        phase, [0, 0.0]
+                    )
+                    entry[0] += 1
+                    entry[1] += time
+
+    def snapshot(self):
+        """
+        Returns a dictionary by tag class path of the sampled timings
+        """
+        with self.lock:
+            return {
+                class_path(klass): timings.as_dict(self.every)
+                for klass, timings in self.tags.items()
+            }
+
+    def reset(self):
+        with self.lock:
+            self.tags = {}
+
+
+class Recorder(Instrument):
+    """
+    Records the nested spans of the parses and renders of tags in each thread,
+    with the name, template and line of the tags, and exports them as a
+    speedscope profile or as collapsed stacks for flamegraph tools. Only sync
+    renders are recorded since the spans of async ones may interleave.
+
+    A debugging tool: once a thread recorded max_spans spans, its further
+    parses and renders are only counted in dropped, so a recorder left
+    enabled holds a bounded amount of memory.
+    """
+    def __init__(self, max_spans=100000):
+        self.max_spans = max_spans
+        self.lock = Lock()
+        # (name, template name, line) -> index
+        self.frames = {}
+        # thread ident -> list of ('O' or 'C', frame index, time)
+        self.threads = {}
+        self.dropped = 0
+        self.start = perf_counter()
+
+    def get_frame(self, name, origin, token):
+        key = (name,) + get_location(origin, token)
+        try:
+            return self.frames[key]
+        except KeyError:
+            with self.lock:
+                return self.frames.setdefault(key, len(self.frames))
+
+    def get_events(self):
+        ident = get_ident()
+        try:
+            return self.threads[ident]
+        except KeyError:
+            with self.lock:
+                return self.threads.setdefault(ident, [])
+
+    def is_full(self, events):
+        """
+        Whether events holds max_spans spans, counting the span dropped if so.
+        A span is only recorded with its enclosing ones, so every span opened
+        is also closed.
+        """
+        if len(events) < 2 * self.max_spans:
+            return False
+        with self.lock:
+            self.dropped += 1
+        return True
+
+    def wrap_init(self, method):
+        def __init__(tag, parser, tokens):
+            events = self.get_events()
+            if self.is_full(events):
+                return method(tag, parser, tokens)
+            frame = self.get_frame(
+                'parse %s' % tag.name, getattr(parser, 'origin', None), tokens
+            )
+            events.append(('O', frame, perf_counter()))
+            try:
+                method(tag, parser, tokens)
+            finally:
+                events.append(('C', frame, perf_counter()))
+        return __init__
+
+    def wrap_render(self, method):
+        def render(tag, context):
+            events = self.get_events()
+            if self.is_full(events):
+                return method(tag, context)
+            frame = self.get_frame('render %s' % tag.name, tag.origin, tag.token)
+            events.append(('O', frame, perf_counter()))
+            try:
+                return method(tag, context)
+            finally:
+                events.append(('C', frame, perf_counter()))
+        return render
+
+    def iter_spans(self, events):
+        """
+        Yields (stack, start, end, self time) for the closed spans of events,
+        stack being the tuple of frame indexes from the outermost span.
+        """
+        # [frame, start, time of the children]
+        stack = []
+        for kind, frame, at in list(events):
+            if kind == 'O':
+                stack.append([frame, at, 0.0])
+            else:
+                frame, start, children = stack.pop()
+                duration = at - start
+                if stack:
+                    stack[-1][2] += duration
+                path = tuple(item[0] for item in stack) + (frame,)
+                yield path, start, at, duration - children
+
+    def get_labels(self):
+        labels = [None] * len(self.frames)
+        for (name, template_name, line), index in list(self.frames.items()):
+            labels[index] = '%s (%s:%s)' % (name, template_name, line)
+        return labels
+
+    def collapsed(self):
+        """
+        Returns the self times of the recorded stacks in microseconds in the
+        collapsed stack format of flamegraph.pl, one 'a;b;c time' per line.
+        """
+        labels = [label.replace(';', ',') for label in self.get_labels()]
+        totals = {}
+        for events in list(self.threads.values()):
+            for path, start, end, own in self.iter_spans(events):
+                totals[path] = totals.get(path, 0.0) + own
+        return ''.join(
+            '%s %d\n' % (';'.join(labels[index] for index in path), round(own * 1000000))
+            for path, own in sorted(totals.items())
+        )
+
+    def speedscope(self, name='classytags'):
+        """
+        Returns a dictionary of the recorded spans in the speedscope file
+        format, with an evented profile per thread. Dump it as JSON to open it
+        at https://www.speedscope.app/.
+        """
+        frames = [None] * len(self.frames)
+        for (label, template_name, line), index in list(self.frames.items()):
+            frames[index] = {'name': label, 'file': template_name, 'line': line}
+        profiles = []
+        for ident, events in list(self.threads.items()):
+            spans = sorted(
+                self.iter_spans(events), key=lambda span: (span[1], -span[2])
+            )
+            if not spans:
+                continue
+            opened = []
+            timeline = []
+            for path, start, end, own in spans:
+                # close the spans which ended before this one started
+                while opened and opened[-1][1] <= start:
+                    frame, at = opened.pop()
+                    timeline.append({'type': 'C', 'frame': frame, 'at': at})
+                timeline.append({'type': 'O', 'frame': path[-1], 'at': start})
+                opened.append((path[-1], end))
+            while opened:
+                frame, at = opened.pop()
+                timeline.append({'type': 'C', 'frame': frame, 'at': at})
+            for event in timeline:
+                event['at'] = (event['at'] - self.start) * 1000
+            profiles.append({
+                'type': 'evented',
+                'name': 'thread %s' % ident,
+                'unit': 'milliseconds',
+                'startValue': timeline[0]['at'],
+                'endValue': timeline[-1]['at'],
+                'events': timeline,
+            })
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': name,
+            'exporter': 'django-classy-tags',
+            'shared': {'frames': frames},
+            'profiles': profiles,
+        }
+
+    def reset(self):
+        with self.lock:
+            self.frames = {}
+            self.threads = {}
+            self.dropped = 0
+            self.start = perf_counter()
+
+
+class CallSites(Instrument):
+    """
+    Counts and times the renders of tags by call site, the tag name and the
+    template name and line it was parsed from.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        # (name, template name, line) -> [renders, render time]
+        self.sites = {}
+
+    def wrap_render(self, method):
+        def render(tag, context):
+            start = perf_counter()
+            try:
+                return method(tag, context)
+            finally:
+                duration = perf_counter() - start
+                key = (tag.name,) + tag.call_site
+                with self.lock:
+                    site = self.sites.get(key)
+                    if site is None:
+                        site = self.sites[key] = [0, 0.0]
+                    site[0] += 1
+                    site[1] += duration
+        return render
+
+    def snapshot(self, limit=None):
+        """
+        Returns a list of dictionaries with the tag name, template, line,
+        renders, render time and mean render time of the call sites, the
+        slowest in total first, at most limit of them.
+        """
+        with self.lock:
+            sites = [
+                {
+                    'tag': name, 'template': template_name, 'line': line,
+                    'renders': renders, 'render_time': render_time,
+                    'mean': render_time / renders,
+                }
+                for (name, template_name, line), (renders, render_time)
+                in self.sites.items()
+            ]
+        sites.sort(key=lambda site: -site['render_time'])
+        return sites[:limit]
+
+    def reset(self):
+        with self.lock:
+            self.sites = {}
+
+
+class QueryCounts:
+    """
+    Database queries of the renders of a tag or call site, in seconds.
+    """
+    __slots__ = ('renders', 'queries', 'query_time', 'max_queries', 'over_budget')
+
+    def __init__(self):
+        self.renders = 0
+        self.queries = 0
+        self.query_time = 0.0
+        self.max_queries = 0
+        self.over_budget = 0
+
+    def add(self, queries, query_time, budget):
+        self.renders += 1
+        self.queries += queries
+        self.query_time += query_time
+        self.max_queries = max(self.max_queries, queries)
+        if budget is not None and queries > budget:
+            self.over_budget += 1
+
+    def as_dict(self):
+        return {
+            'renders': self.renders,
+            'queries': self.queries,
+            'query_time': self.query_time,
+            'max_queries': self.max_queries,
+            'over_budget': self.over_budget,
+        }
+
+
+class Queries(Instrument):
+    """
+    Counts and times the database queries of the renders of tags by tag class
+    and by call site, flagging renders running more than budget queries. The
+    queries are counted for the innermost tag being rendered, through execute
+    wrappers on the connections named in using (all by default) which are
+    installed around the outermost render.
+    """
+    def __init__(self, budget=None, using=None):
+        self.budget = budget
+        self.using = using
+        self.lock = Lock()
+        self.tags = {}
+        self.sites = {}
+        # stack of [queries, query time] of the renders in progress
+        self.stack = ContextVar('classytags_queries', default=None)
+
+    def get_connections(self):
+        if self.using is None:
+            return connections.all()
+        return [connections[alias] for alias in self.using]
+
+    def execute(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            counts = self.stack.get()[-1]
+            counts[0] += 1
+            counts[1] += perf_counter() - start
+
+    def wrap_render(self, method):
+        def render(tag, context):
+            stack = self.stack.get()
+            if stack is not None:
+                return self.count(method, tag, context, stack)
+            stack = []
+            token = self.stack.set(stack)
+            try:
+                with ExitStack() as wrappers:
+                    for connection in self.get_connections():
+                        wrappers.enter_context(
+                            connection.execute_wrapper(self.execute)
+                        )
+                    return self.count(method, tag, context, stack)
+            finally:
+                self.stack.reset(token)
+        return render
+
+    def count(self, method, tag, context, stack):
+        counts = [0, 0.0]
+        stack.append(counts)
+        try:
+            return method(tag, context)
+        finally:
+            stack.pop()
+            site = (tag.name,) + tag.call_site
+            with self.lock:
+                for key, store in ((type(tag), self.tags), (site, self.sites)):
+                    entry = store.get(key)
+                    if entry is None:
+                        entry = store[key] = QueryCounts()
+                    entry.add(counts[0], counts[1], self.budget)
+
+    def snapshot(self):
+        """
+        Returns a dictionary with the query counts by tag class path under
+        'tags' and a list of those by call site, the most queries first, under
+        'call_sites'.
+        """
+        with self.lock:
+            tags = {
+                class_path(klass): counts.as_dict()
+                for klass, counts in self.tags.items()
+            }
+            sites = [
+                dict(tag=name, template=template_name, line=line, **counts.as_dict())
+                for (name, template_name, line), counts in self.sites.items()
+            ]
+        sites.sort(key=lambda site: -site['queries'])
+        return {'tags': tags, 'call_sites': sites}
+
+    def flagged(self):
+        """
+        Returns the call sites of snapshot() with renders over budget
+        """
+        return [
+            site for site in self.snapshot()['call_sites'] if site['over_budget']
+        ]
+
+    def reset(self):
+        with self.lock:
+            self.tags = {}
+            self.sites = {}
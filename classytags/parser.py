@@ -1,7 +1,7 @@
-from copy import deepcopy
-
 from django import template
 
+from classytags.blocks import BlockIdentifiers
+from classytags.diagnostics import parsing
 from classytags.exceptions import ArgumentRequiredError, BreakpointExpected, TooManyArguments, TrailingBreakpoint
 
 
@@ -24,10 +24,10 @@ class Parser:
         self.blocks = {}
         self.forced_next = None
         # Get the first chunk of arguments until the next breakpoint
-        self.arguments = self.options.get_arguments()
+        self.load_arguments()
         self.current_argument = None
-        # get a copy of the bits (tokens)
-        self.todo = list(self.bits)
+        # index of the bit (token) currently handled
+        self.position = 0
         # parse the bits (tokens)
         breakpoint = False
         for bit in self.bits:
@@ -40,6 +40,29 @@ class Parser:
         self.parse_blocks()
         return self.kwargs, self.blocks
 
+    @property
+    def todo(self):
+        """
+        The bits (tokens) not handled yet, including the current one
+        """
+        return self.bits[self.position:]
+
+    def load_arguments(self):
+        """
+        Load the arguments of the current breakpoint scope
+        """
+        self.arguments = self.options.get_arguments()
+        self.argument_position = 0
+
+    def next_argument(self):
+        """
+        Make the next argument of the current breakpoint scope the current
+        argument. Raises an IndexError if there are none left.
+        """
+        self.current_argument = self.arguments[self.argument_position]
+        self.argument_position += 1
+        return self.current_argument
+
     def handle_bit(self, bit):
         """
         Handle the current bit
@@ -56,7 +79,7 @@ class Parser:
             self.handle_next_breakpoint(bit)
             breakpoint = bit
         # Check if the current bit is a future breakpoint
-        elif bit in self.options.breakpoints:
+        elif self.options.is_future_breakpoint(bit):
             self.handle_breakpoints(bit)
             breakpoint = bit
         # Otherwise it's a 'normal' argument
@@ -66,8 +89,8 @@ class Parser:
             self.forced_next = self.options.combined_breakpoints[bit]
         else:
             self.forced_next = None
-        # remove from todos
-        del self.todo[0]
+        # move on to the next bit
+        self.position += 1
         return breakpoint
 
     def handle_next_breakpoint(self, bit):
@@ -81,9 +104,9 @@ class Parser:
         # Shift the breakpoint to the next one
         self.options.shift_breakpoint()
         # Get the next chunk of arguments
-        self.arguments = self.options.get_arguments()
+        self.load_arguments()
         if self.arguments:
-            self.current_argument = self.arguments.pop(0)
+            self.next_argument()
         else:
             self.current_argument = None
 
@@ -99,8 +122,8 @@ class Parser:
             self.check_required()
             # Shift to the next breakpoint
             self.options.shift_breakpoint()
-            self.arguments = self.options.get_arguments()
-        self.current_argument = self.arguments.pop(0)
+            self.load_arguments()
+        self.next_argument()
 
     def handle_argument(self, bit):
         """
@@ -110,20 +133,19 @@ class Parser:
         if self.current_argument is None:
             try:
                 # try to get the next one
-                self.current_argument = self.arguments.pop(0)
+                self.next_argument()
             except IndexError:
                 # If we don't have any arguments, left, raise a
                 # TooManyArguments error
                 raise TooManyArguments(self.tagname, self.todo)
         # parse the current argument and check if this bit was handled by this
         # argument
-        handled = self.current_argument.parse(self.parser, bit, self.tagname,
-                                              self.kwargs)
+        handled = self.parse_argument(bit)
         # While this bit is not handled by an argument
         while not handled:
             try:
                 # Try to get the next argument
-                self.current_argument = self.arguments.pop(0)
+                self.next_argument()
             except IndexError:
                 # If there is no next argument but there are still breakpoints
                 # Raise an exception that we expected a breakpoint
@@ -138,8 +160,19 @@ class Parser:
                     # Otherwise raise a TooManyArguments excption
                     raise TooManyArguments(self.tagname, self.todo)
             # Try next argument
-            handled = self.current_argument.parse(self.parser, bit,
-                                                  self.tagname, self.kwargs)
+            handled = self.parse_argument(bit)
+
+    def parse_argument(self, bit):
+        """
+        Parse the current bit with the current argument, the values it cleans
+        report their errors under the names of the tag and argument.
+        """
+        token = parsing.set((self.tagname, self.current_argument.name))
+        try:
+            return self.current_argument.parse(self.parser, bit, self.tagname,
+                                               self.kwargs)
+        finally:
+            parsing.reset(token)
 
     def finish(self):
         """
@@ -152,7 +185,7 @@ class Parser:
         while self.options.next_breakpoint:
             # Shift to the next breakpoint
             self.options.shift_breakpoint()
-            self.arguments = self.options.get_arguments()
+            self.load_arguments()
             # And check this breakpoints arguments for required arguments.
             self.check_required()
 
@@ -170,34 +203,33 @@ class Parser:
                 pre_e: None
                 pre_g: None
         """
+        blocks = self.options.blocks
         # if no blocks are defined, bail out
-        if not self.options.blocks:
+        if not blocks:
             return
-        # copy the blocks
-        blocks = deepcopy(self.options.blocks)
-        identifiers = {}
-        for block in blocks:
-            identifiers[block] = block.collect(self)
-        while blocks:
-            current_block = blocks.pop(0)
-            current_identifiers = identifiers[current_block]
-            block_identifiers = list(current_identifiers)
-            for block in blocks:
-                block_identifiers += identifiers[block]
-            nodelist = self.parser.parse(block_identifiers)
+        identifiers = self.options.plan.block_identifiers
+        if identifiers is None:
+            identifiers = BlockIdentifiers(
+                [block.collect(self) for block in blocks]
+            )
+        index = 0
+        while index < len(blocks):
+            nodelist = self.parser.parse(identifiers.until[index])
             token = self.parser.next_token()
-            while token.contents not in current_identifiers:
-                empty_block = blocks.pop(0)
-                current_identifiers = identifiers[empty_block]
-                self.blocks[empty_block.alias] = template.NodeList()
-            self.blocks[current_block.alias] = nodelist
+            # blocks skipped until the one ended by this token are empty
+            end = index
+            while token.contents not in identifiers.ends[end]:
+                end += 1
+                self.blocks[blocks[end].alias] = template.NodeList()
+            self.blocks[blocks[index].alias] = nodelist
+            index = end + 1
 
     def check_required(self):
         """
         Iterate over arguments, checking if they're required, otherwise
         populating the kwargs dictionary with their defaults.
         """
-        for argument in self.arguments:
+        for argument in self.arguments[self.argument_position:]:
             if argument.required:
                 raise ArgumentRequiredError(argument, self.tagname)
             else:
@@ -0,0 +1,158 @@
+"""
+Loads the data of the tags of a template concurrently before rendering it.
+
+Tags implement Tag.prefetch (or Tag.aprefetch) and call Tag.get_prefetched
+(or Tag.aget_prefetched) with the same arguments while rendering. When the
+template is rendered with render_to_string or arender_to_string of this
+module, the prefetch hooks of all classy tags in the template run at once
+first; otherwise get_prefetched simply calls prefetch.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+from django.template.defaulttags import ForNode, WithNode
+
+from classytags.core import Tag, arender_nodelist, prefetched
+from classytags.helpers import template_context
+from classytags.utils import iter_variables
+
+
+# nodes binding variables for the nodes nested in them
+SCOPE_NODES = (ForNode, WithNode)
+
+
+def iter_tags(nodelist):
+    """
+    Yields the tags in nodelist and in the nodelists of its nodes, except
+    those in SCOPE_NODES since their arguments depend on the variables bound
+    by them.
+    """
+    stack = [nodelist]
+    while stack:
+        for node in stack.pop():
+            if isinstance(node, Tag):
+                yield node
+            if isinstance(node, SCOPE_NODES):
+                continue
+            for attr in node.child_nodelists:
+                child = getattr(node, attr, None)
+                if child:
+                    stack.append(child)
+
+
+def is_bound(tag, context):
+    """
+    Whether all variables looked up by the arguments of tag are set in
+    context. Others are only bound while rendering, for example by the
+    varname of an AsTag or in the branch of an {% if %} checking for them.
+    """
+    return all(
+        var.lookups[0] in context
+        for value in tag.kwargs.values() for var in iter_variables(value)
+    )
+
+
+def collect(nodelist, context):
+    """
+    Returns a list of (tag, kwargs) pairs for the tags with a prefetch hook in
+    nodelist, their arguments resolved against context. Tags whose arguments
+    look up variables missing from context or can't be resolved are skipped.
+    """
+    jobs = []
+    for node in iter_tags(nodelist):
+        if not node.has_prefetch() or not is_bound(node, context):
+            continue
+        try:
+            kwargs = node.get_prefetch_kwargs(context)
+        except Exception:
+            continue
+        jobs.append((node, kwargs))
+    return jobs
+
+
+def call_prefetch(node, context, kwargs):
+    """
+    Calls the prefetch hook of a tag in a worker thread, closing the database
+    connections the thread opened afterwards.
+    """
+    try:
+        return node.prefetch(context, **kwargs)
+    finally:
+        connections.close_all()
+
+
+def prefetch_nodelist(nodelist, context, executor=None, max_workers=32):
+    """
+    Calls the prefetch hooks of the tags in nodelist concurrently on a thread
+    pool (by default one with a thread per tag, up to max_workers) and
+    returns a dictionary of their results. Failed calls are left out,
+    get_prefetched will call prefetch again when rendering.
+    """
+    jobs = collect(nodelist, context)
+    if not jobs:
+        return {}
+    if executor is None:
+        with ThreadPoolExecutor(min(len(jobs), max_workers)) as pool:
+            return submit(jobs, context, pool)
+    return submit(jobs, context, executor)
+
+
+def submit(jobs, context, executor):
+    """
+    Runs the prefetch jobs returned by collect on executor and returns the
+    results of those which succeeded.
+    """
+    futures = [
+        (node, kwargs, executor.submit(call_prefetch, node, context, kwargs))
+        for node, kwargs in jobs
+    ]
+    results = {}
+    for node, kwargs, future in futures:
+        if future.exception() is None:
+            results[node] = (kwargs, future.result())
+    return results
+
+
+async def aprefetch_nodelist(nodelist, context):
+    """
+    Same as prefetch_nodelist, awaiting the aprefetch hooks concurrently.
+    """
+    jobs = collect(nodelist, context)
+    outcomes = await asyncio.gather(
+        *[node.aprefetch(context, **kwargs) for node, kwargs in jobs],
+        return_exceptions=True
+    )
+    results = {}
+    for (node, kwargs), outcome in zip(jobs, outcomes):
+        if not isinstance(outcome, Exception):
+            results[node] = (kwargs, outcome)
+    return results
+
+
+def render_to_string(template_name, context=None, request=None, executor=None):
+    """
+    Same as django.template.loader.render_to_string, prefetching the data of
+    the tags in the template first.
+    """
+    with template_context(template_name, context, request) as (compiled, context):
+        results = prefetch_nodelist(compiled.nodelist, context, executor)
+        token = prefetched.set(results)
+        try:
+            return compiled.nodelist.render(context)
+        finally:
+            prefetched.reset(token)
+
+
+async def arender_to_string(template_name, context=None, request=None):
+    """
+    Same as classytags.helpers.arender_to_string, prefetching the data of the
+    tags in the template first.
+    """
+    with template_context(template_name, context, request) as (compiled, context):
+        results = await aprefetch_nodelist(compiled.nodelist, context)
+        token = prefetched.set(results)
+        try:
+            return await arender_nodelist(compiled.nodelist, context)
+        finally:
+            prefetched.reset(token)
@@ -0,0 +1,38 @@
+"""
+pytest plugin for tag budgets, enable it with
+
+    pytest_plugins = ['classytags.pytest_plugin']
+
+in a conftest.py or with ``-p classytags.pytest_plugin``. Tests marked with
+
+    @pytest.mark.tag_budget(tags=['my_tag'], queries=1)
+
+fail if the tags rendered by them exceed the budget, and the tag_budget
+fixture returns classytags.testing.TagBudget to check blocks of a test.
+"""
+import pytest
+
+from classytags.testing import TagBudget
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers',
+        'tag_budget(tags=None, renders=None, queries=None, time=None, '
+        'memory=None, using=None): fail if the tags rendered by the test '
+        'exceed the budget, see classytags.testing.TagBudget',
+    )
+
+
+@pytest.fixture
+def tag_budget():
+    return TagBudget
+
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtest_call(item):
+    marker = item.get_closest_marker('tag_budget')
+    if marker is None:
+        return (yield)
+    with TagBudget(*marker.args, **marker.kwargs):
+        return (yield)
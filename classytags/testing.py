@@ -0,0 +1,155 @@
+"""
+Performance budgets for tags in test suites.
+
+Example:
+
+    with TagBudget(tags=['my_tag'], renders=10, queries=1, time=0.05):
+        render_to_string('page.html')
+
+raises an AssertionError when the block is left if my_tag was rendered more
+than 10 times, or any of its renders ran more than one query or took more
+than 50ms. See classytags.pytest_plugin for the pytest fixture and marker.
+"""
+import tracemalloc
+from contextvars import ContextVar
+from time import perf_counter
+
+from classytags.instrumentation import Instrument, Queries
+
+
+class TagUsage:
+    """
+    The renders of a tag within a TagBudget and their maximum cost
+    """
+    __slots__ = ('renders', 'time', 'memory')
+
+    def __init__(self):
+        self.renders = 0
+        self.time = 0.0
+        self.memory = 0
+
+
+class TagBudget(Instrument):
+    """
+    Context manager asserting limits for the renders of the tags named in
+    tags (all tags by default) within it: the number of renders, and the
+    database queries (on the connections named in using), the wall time in
+    seconds and the bytes allocated (traced with tracemalloc) of each render.
+    Limits which are None aren't checked.
+    """
+    def __init__(self, tags=None, renders=None, queries=None, time=None,
+                 memory=None, using=None):
+        self.tags = None if tags is None else frozenset(tags)
+        self.renders = renders
+        self.queries = queries
+        self.time = time
+        self.memory = memory
+        self.usage = {}
+        self.query_counts = Queries(using=using) if queries is not None else None
+        # the [start, peak] traced memory of the renders in progress
+        self.stack = ContextVar('classytags_budget', default=None)
+        self.tracing = False
+
+    def enable(self):
+        self.usage = {}
+        if self.memory is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        if self.query_counts is not None:
+            self.query_counts.reset()
+            self.query_counts.enable()
+        return super().enable()
+
+    def disable(self):
+        super().disable()
+        if self.query_counts is not None:
+            self.query_counts.disable()
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+        if exc_type is None:
+            self.check()
+
+    def wrap_render(self, method):
+        def render(tag, context):
+            if self.tags is not None and tag.name not in self.tags:
+                return method(tag, context)
+            if self.memory is None:
+                start = perf_counter()
+                try:
+                    return method(tag, context)
+                finally:
+                    self.add(tag.name, perf_counter() - start, 0)
+            return self.trace(method, tag, context)
+        return render
+
+    def trace(self, method, tag, context):
+        """
+        Renders tag, tracing the peak memory allocated while doing so. The
+        peak of the outer render is kept before tracing a nested one.
+        """
+        stack = self.stack.get()
+        if stack is None:
+            stack = []
+            self.stack.set(stack)
+        if stack:
+            stack[-1][1] = max(stack[-1][1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        frame = [current, current]
+        stack.append(frame)
+        start = perf_counter()
+        try:
+            return method(tag, context)
+        finally:
+            duration = perf_counter() - start
+            stack.pop()
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            self.add(tag.name, duration, peak - frame[0])
+
+    def add(self, name, duration, memory):
+        usage = self.usage.get(name)
+        if usage is None:
+            usage = self.usage[name] = TagUsage()
+        usage.renders += 1
+        usage.time = max(usage.time, duration)
+        usage.memory = max(usage.memory, memory)
+
+    def get_violations(self):
+        """
+        Returns a list of messages describing the limits which were exceeded
+        """
+        violations = []
+        for name, usage in sorted(self.usage.items()):
+            if self.renders is not None and usage.renders > self.renders:
+                violations.append('%s was rendered %d times, the limit is %d' % (
+                    name, usage.renders, self.renders
+                ))
+            if self.time is not None and usage.time > self.time:
+                violations.append('%s took %.6fs to render, the limit is %.6fs' % (
+                    name, usage.time, self.time
+                ))
+            if self.memory is not None and usage.memory > self.memory:
+                violations.append('%s allocated %d bytes in a render, the limit is %d' % (
+                    name, usage.memory, self.memory
+                ))
+        if self.query_counts is not None:
+            for klass, counts in sorted(self.query_counts.tags.items(), key=lambda item: item[0].name):
+                in_budget = self.tags is None or klass.name in self.tags
+                if in_budget and counts.max_queries > self.queries:
+                    violations.append('%s ran %d queries in a render, the limit is %d' % (
+                        klass.name, counts.max_queries, self.queries
+                    ))
+        return violations
+
+    def check(self):
+        violations = self.get_violations()
+        if violations:
+            raise AssertionError(
+                'Tag budget exceeded:\n%s' % '\n'.join(violations)
+            )
@@ -1,9 +1,13 @@
 import re
-from copy import copy
+from collections import ChainMap, OrderedDict, namedtuple
+from threading import Lock
+from types import MappingProxyType
 
-from django.template import Context, RequestContext
+from django.template.base import FilterExpression, Variable
 from django.template.context import BaseContext
 
+from classytags.blocks import BlockIdentifiers
+
 
 class NULL:
     """
@@ -11,11 +15,21 @@ class NULL:
     """
 
 
+class PENDING:
+    """
+    Internal type set as the value of AsTag varnames while the keys of a
+    batch are collected, tags loading it wait for the next render
+    """
+    do_not_call_in_templates = True
+
+
 class TemplateConstant:
     """
     A 'constant' internal template variable which basically allows 'resolving'
     returning it's initial value
     """
+    __slots__ = ('literal', 'value')
+
     def __init__(self, value):
         self.literal = value
         if isinstance(value, str):
@@ -30,45 +44,253 @@ class TemplateConstant:
         return self.value
 
 
-class StructuredOptions:
+def is_literal(var):
     """
-    Bootstrapped options
+    Check if var is a filter-free literal which resolves to the same value in
+    every context
     """
-    def __init__(self, options, breakpoints, blocks, combind_breakpoints):
+    if isinstance(var, TemplateConstant):
+        return True
+    if isinstance(var, FilterExpression):
+        if var.filters:
+            return False
+        var = var.var
+        if not isinstance(var, Variable):
+            return True
+    if isinstance(var, Variable):
+        return var.lookups is None and not var.translate
+    return False
+
+
+class ParsePlan:
+    """
+    Immutable, pre-computed view of an Options instance which the parser walks
+    through. Built once when the options are created and shared by all parses.
+    """
+    def __init__(self, options, breakpoints, blocks, combined_breakpoints):
         self.options = options
-        self.breakpoints = copy(breakpoints)
-        self.blocks = copy(blocks)
-        self.combined_breakpoints = dict(combind_breakpoints.items())
-        self.reversed_combined_breakpoints = {
-            v: k for k, v in combind_breakpoints.items()
+        self.breakpoints = tuple(breakpoints)
+        # scope 0 is the 'no breakpoint' scope, scope n is the nth breakpoint
+        self.scopes = (None,) + self.breakpoints
+        self.arguments = tuple(
+            tuple(options[breakpoint]) for breakpoint in self.scopes
+        )
+        self.positions = {
+            breakpoint: index for index, breakpoint in enumerate(self.scopes)
         }
-        self.current_breakpoint = None
-        if self.breakpoints:
-            self.next_breakpoint = self.breakpoints.pop(0)
-        else:
-            self.next_breakpoint = None
+        self.blocks = tuple(blocks)
+        self.block_identifiers = BlockIdentifiers.compile(self.blocks)
+        self.combined_breakpoints = MappingProxyType(
+            dict(combined_breakpoints)
+        )
+        self.reversed_combined_breakpoints = MappingProxyType({
+            v: k for k, v in combined_breakpoints.items()
+        })
+
+
+class StructuredOptions:
+    """
+    Bootstrapped options, a cursor over a ParsePlan
+    """
+    __slots__ = (
+        'plan', 'options', 'blocks', 'combined_breakpoints',
+        'reversed_combined_breakpoints', 'position',
+    )
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.options = plan.options
+        self.blocks = plan.blocks
+        self.combined_breakpoints = plan.combined_breakpoints
+        self.reversed_combined_breakpoints = plan.reversed_combined_breakpoints
+        self.position = 0
+
+    @property
+    def current_breakpoint(self):
+        if self.position < len(self.plan.scopes):
+            return self.plan.scopes[self.position]
+        return None
+
+    @property
+    def next_breakpoint(self):
+        if self.position < len(self.plan.breakpoints):
+            return self.plan.breakpoints[self.position]
+        return None
+
+    @property
+    def breakpoints(self):
+        """
+        The breakpoints after the next breakpoint
+        """
+        return self.plan.breakpoints[self.position + 1:]
+
+    def is_future_breakpoint(self, bit):
+        """
+        Check if bit is a breakpoint after the next breakpoint
+        """
+        return self.plan.positions.get(bit, 0) > self.position + 1
 
     def shift_breakpoint(self):
         """
         Shift to the next breakpoint
         """
-        self.current_breakpoint = self.next_breakpoint
-        if self.breakpoints:
-            self.next_breakpoint = self.breakpoints.pop(0)
-        else:
-            self.next_breakpoint = None
+        self.position += 1
 
     def get_arguments(self):
         """
         Get the current arguments
         """
-        return copy(self.options[self.current_breakpoint])
+        if self.position < len(self.plan.arguments):
+            return self.plan.arguments[self.position]
+        return ()
+
+
+CacheInfo = namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize']
+)
+
+
+class LRUCache:
+    """
+    A bounded, thread safe least recently used cache keeping count of its hits,
+    misses and evictions.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters
+        """
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        return CacheInfo(
+            self.hits, self.misses, self.evictions, self.maxsize, len(self)
+        )
+
+
+def make_hashable(value):
+    """
+    Returns a hashable representation of value distinguishing between values
+    of different types which compare equal. Raises a TypeError if value can't
+    be represented.
+    """
+    if isinstance(value, dict):
+        return type(value), tuple(
+            (make_hashable(key), make_hashable(item))
+            for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(make_hashable(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return type(value), frozenset(make_hashable(item) for item in value)
+    hash(value)
+    return type(value), value
+
+
+def iter_filters(value):
+    """
+    Yields the filter functions used by a parsed argument value
+    """
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from iter_filters(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_filters(item)
+    var = getattr(value, 'var', None)
+    for func, args in getattr(var, 'filters', ()):
+        yield func
+
+
+def iter_variables(value):
+    """
+    Yields the template variables looked up by a parsed argument value,
+    including those passed to its filters
+    """
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from iter_variables(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_variables(item)
+    var = getattr(value, 'var', None)
+    if isinstance(var, FilterExpression):
+        for func, args in var.filters:
+            for lookup, arg in args:
+                if lookup and arg.lookups is not None:
+                    yield arg
+        var = var.var
+    if isinstance(var, Variable) and var.lookups is not None:
+        yield var
+
+
+def set_source(value, source):
+    """
+    Sets the (tag, argument) names reported by the cleaning errors of a parsed
+    argument value and of the values nested in it
+    """
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+        try:
+            value.source = source
+        except AttributeError:
+            # values without a source slot report no names
+            pass
 
 
 _re1 = re.compile('(.)([A-Z][a-z]+)')
 _re2 = re.compile('([a-z0-9])([A-Z])')
 
 
+def get_location(origin, token):
+    """
+    Returns the (template name, line) of a tag parsed from token in the
+    template origin, None for the parts which are unknown.
+    """
+    name = None
+    if origin is not None:
+        name = origin.template_name or origin.name
+    return name, getattr(token, 'lineno', None)
+
+
 def get_default_name(name):
     """
     Turns "CamelCase" into "camel_case"
@@ -85,18 +307,166 @@ def mixin(parent, child, attrs=None):
     )
 
 
-def flatten_context(context):
-    def do_flatten(context):
-        flat = {}
-        for d in context.dicts:
-            if isinstance(d, (Context, RequestContext)):
-                flat.update(do_flatten(d))
-            else:
-                flat.update(d)
-        return flat
+def context_dicts(context):
+    """
+    Returns the dictionaries of a context, including those of nested contexts,
+    from the outermost to the innermost one.
+    """
+    dicts = []
+    stack = [iter(context.dicts)]
+    while stack:
+        for layer in stack[-1]:
+            if isinstance(layer, BaseContext):
+                stack.append(iter(layer.dicts))
+                break
+            dicts.append(layer)
+        else:
+            stack.pop()
+    return dicts
+
 
+def flatten_context(context):
     if callable(getattr(context, 'flatten', None)):
         return context.flatten()
     elif isinstance(context, BaseContext):
-        return do_flatten(context)
+        flat = {}
+        for layer in context_dicts(context):
+            flat.update(layer)
+        return flat
     return context
+
+
+class FlatContext(ChainMap):
+    """
+    A flat view of the layers of a context. Values set on the view are stored
+    in its first mapping, the layers of the context are copied into a single
+    dictionary only when a key of theirs is removed.
+    """
+    def materialize(self):
+        if len(self.maps) > 1:
+            self.maps = [dict(self)]
+
+    def __delitem__(self, key):
+        self.materialize()
+        super().__delitem__(key)
+
+    def pop(self, key, *args):
+        self.materialize()
+        return super().pop(key, *args)
+
+    def popitem(self):
+        self.materialize()
+        return super().popitem()
+
+    def clear(self):
+        self.maps = [{}]
+
+
+def lazy_flatten_context(context):
+    """
+    Same as flatten_context but returns a FlatContext which does not copy the
+    variables of the context.
+    """
+    if isinstance(context, BaseContext):
+        layers = context_dicts(context)
+    else:
+        layers = [context]
+    layers.reverse()
+    return FlatContext({}, *layers)
+
+
+class Deferred(Exception):
+    """
+    Raised by Tag.load when a key isn't loaded yet while collecting the keys
+    of a render
+    """
+    def __init__(self, batch):
+        super().__init__()
+        self.batch = batch
+
+
+class Batch:
+    """
+    The loads of the tags of one render, coalesced into a single call per
+    batch_load implementation (tag classes inheriting batch_load share it)
+    and memoized. Stored in the bottom layer of the
+    render_context, so it is shared by all templates rendered with that
+    context.
+
+    Unless defer is set, every load is a batch on its own. Otherwise loading
+    a key which isn't known yet raises Deferred: the tag renders nothing and
+    render renders the template again once all keys requested by it are
+    loaded.
+    """
+    def __init__(self, defer=False):
+        self.defer = defer
+        self.results = {}
+        self.pending = {}
+        self.incomplete = False
+
+    @classmethod
+    def get(cls, context):
+        """
+        Returns the batch of the render context, creating it if needed
+        """
+        layer = context.render_context.dicts[0]
+        batch = layer.get(cls)
+        if batch is None:
+            batch = layer[cls] = cls()
+        return batch
+
+    def load(self, tag, key):
+        loader = type(tag).batch_load
+        if key is PENDING:
+            # the value of a varname which is loaded by this render
+            self.incomplete = True
+            raise Deferred(self)
+        try:
+            return self.results[loader, key]
+        except KeyError:
+            pass
+        if self.defer:
+            self.pending.setdefault(loader, (tag, {}))[1][key] = None
+            self.incomplete = True
+            raise Deferred(self)
+        self.store(tag, [key])
+        return self.results[loader, key]
+
+    def store(self, tag, keys):
+        """
+        Calls batch_load of tag for keys and stores the results
+        """
+        values = tag.batch_load(keys)
+        if isinstance(values, dict):
+            values = [values.get(key) for key in keys]
+        elif len(values) != len(keys):
+            raise ValueError(
+                '%s.batch_load returned %s values for %s keys.' % (
+                    type(tag).__name__, len(values), len(keys)
+                )
+            )
+        loader = type(tag).batch_load
+        for key, value in zip(keys, values):
+            self.results[loader, key] = value
+
+    def dispatch(self):
+        """
+        Loads all pending keys, one call per batch_load implementation
+        """
+        pending, self.pending = self.pending, {}
+        for tag, keys in pending.values():
+            self.store(tag, list(keys))
+
+    def render(self, render):
+        """
+        Returns the output of render, a function rendering the template with
+        this batch. The output of renders in which a tag waited for a key is
+        discarded: the keys they requested are loaded and the template is
+        rendered again, until every key is loaded.
+        """
+        while True:
+            self.incomplete = False
+            output = render()
+            if not self.incomplete:
+                return output
+            self.dispatch()
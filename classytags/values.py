@@ -1,14 +1,61 @@
-import warnings
+from functools import lru_cache
 
 from django import template
 from django.conf import settings
 
-from classytags.exceptions import TemplateSyntaxWarning
+from classytags.diagnostics import collector, parsing
+from classytags.utils import is_literal
 
 
-class StringValue:
+class BaseValue:
+    """
+    Behaviour shared by single values and the list and dict values, without
+    any instance layout so it can be combined with list and dict.
+    """
+    __slots__ = ()
     errors = {}
     value_on_error = ""
+    # whether literals are cleaned when parsing, None to only fold the
+    # value classes whose clean methods are all those of this module
+    foldable = None
+
+    def clean(self, value):
+        return value
+
+    def fold(self):
+        return self
+
+    def error(self, value, category):
+        if settings.DEBUG:
+            raise template.TemplateSyntaxError(
+                self.get_error_message(value, category)
+            )
+        else:
+            tag, argument = self.get_source()
+            collector.record(self, value, category, tag, argument)
+            return self.value_on_error
+
+    def get_source(self):
+        """
+        Returns the (tag, argument) names of this value, as set by
+        Tag.prepare_render or of the argument being parsed, for diagnostics
+        """
+        source = getattr(self, 'source', None)
+        if source is None:
+            source = parsing.get()
+        return source or (None, None)
+
+    def get_error_message(self, value, category):
+        data = self.get_extra_error_data()
+        data['value'] = repr(value)
+        return self.errors.get(category, "") % data
+
+    def get_extra_error_data(self):
+        return {}
+
+
+class StringValue(BaseValue):
+    __slots__ = ('var', 'literal', 'source')
 
     def __init__(self, var):
         self.var = var
@@ -23,24 +70,49 @@ class StringValue:
         resolved = self.var.resolve(context)
         return self.clean(resolved)
 
-    def clean(self, value):
-        return value
+    def fold(self):
+        """
+        Returns a ConstantValue holding the cleaned value if var is a literal,
+        otherwise this value.
+        """
+        klass = self.__class__
+        if klass.resolve is StringValue.resolve and is_foldable(klass) and is_literal(self.var):
+            return ConstantValue(self.var, self.clean(self.var.resolve({})))
+        return self
 
-    def error(self, value, category):
-        data = self.get_extra_error_data()
-        data['value'] = repr(value)
-        message = self.errors.get(category, "") % data
-        if settings.DEBUG:
-            raise template.TemplateSyntaxError(message)
-        else:
-            warnings.warn(message, TemplateSyntaxWarning)
-            return self.value_on_error
 
-    def get_extra_error_data(self):
-        return {}
+@lru_cache(maxsize=None)
+def is_foldable(value_class):
+    """
+    Returns whether literals of value_class may be cleaned when parsing: its
+    foldable attribute if set, otherwise whether every clean method it
+    inherits is one of the built-in value classes, which only depend on the
+    value.
+    """
+    if value_class.foldable is not None:
+        return value_class.foldable
+    return all(
+        klass.__dict__['clean'] in BUILTIN_CLEANS
+        for klass in value_class.__mro__ if 'clean' in klass.__dict__
+    )
+
+
+class ConstantValue(StringValue):
+    """
+    A value which was resolved and cleaned when the tag was parsed
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, var, value):
+        super().__init__(var)
+        self.value = value
+
+    def resolve(self, context):
+        return self.value
 
 
 class StrictStringValue(StringValue):
+    __slots__ = ()
     errors = {
         "clean": "%(value)s is not a string",
     }
@@ -53,6 +125,7 @@ class StrictStringValue(StringValue):
 
 
 class IntegerValue(StringValue):
+    __slots__ = ()
     errors = {
         "clean": "%(value)s could not be converted to Integer",
     }
@@ -65,10 +138,12 @@ class IntegerValue(StringValue):
             return self.error(value, "clean")
 
 
-class ListValue(list, StringValue):
+class ListValue(list, BaseValue):
     """
     A list of template variables for easy resolving
     """
+    __slots__ = ('source',)
+
     def __init__(self, value):
         list.__init__(self)
         self.append(value)
@@ -78,7 +153,9 @@ class ListValue(list, StringValue):
         return self.clean(resolved)
 
 
-class DictValue(dict, StringValue):
+class DictValue(dict, BaseValue):
+    __slots__ = ('source',)
+
     def __init__(self, value):
         dict.__init__(self, value)
 
@@ -89,21 +166,63 @@ class DictValue(dict, StringValue):
         return self.clean(resolved)
 
 
+class ChoiceSet:
+    """
+    The choices of a ChoiceArgument (or ChoiceValue class), with a set of them
+    for fast membership tests if they are all hashable
+    """
+    __slots__ = ('choices', 'lookup', 'value_on_error')
+
+    def __init__(self, choices, value_on_error):
+        self.choices = choices
+        try:
+            self.lookup = frozenset(choices)
+        except TypeError:
+            self.lookup = choices
+        self.value_on_error = value_on_error
+
+    def __contains__(self, value):
+        try:
+            return value in self.lookup
+        except TypeError:
+            # unhashable values can't equal any of the hashable choices
+            return False
+
+
 class ChoiceValue(StringValue):
+    # uses the choice_set of its class, the classes returned by
+    # classytags.arguments.choice_value_class hold one per value in a slot
+    __slots__ = ()
     errors = {
         "choice": "%(value)s is not a valid choice. Valid choices: "
                   "%(choices)s.",
     }
     choices = []
+    choice_set = ChoiceSet(choices, StringValue.value_on_error)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'choice_set' not in cls.__dict__:
+            cls.choice_set = ChoiceSet(cls.choices, cls.value_on_error)
 
     def clean(self, value):
         cleaned = super().clean(value)
-        if cleaned in self.choices:
+        if cleaned in self.choice_set:
             return cleaned
         else:
             return self.error(cleaned, "choice")
 
+    def error(self, value, category):
+        super().error(value, category)
+        return self.choice_set.value_on_error
+
     def get_extra_error_data(self):
         data = super().get_extra_error_data()
-        data['choices'] = self.choices
+        data['choices'] = self.choice_set.choices
         return data
+
+
+BUILTIN_CLEANS = frozenset([
+    BaseValue.clean, StrictStringValue.clean, IntegerValue.clean,
+    ChoiceValue.clean,
+])
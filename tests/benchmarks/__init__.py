@@ -0,0 +1,55 @@
+"""
+Micro benchmarks for django-classy-tags.
+
+These are not part of the test suite, run them from the repository root with
+``python -m tests.benchmarks.<name>``.
+"""
+import timeit
+
+
+def setup():
+    """
+    Configure Django with the settings used by the test suite.
+    """
+    from django import setup as django_setup
+    from django.conf import settings
+
+    from tests import settings as test_settings
+    if not settings.configured:
+        settings.configure(
+            INSTALLED_APPS=test_settings.INSTALLED_APPS,
+            ROOT_URLCONF=test_settings.ROOT_URLCONF,
+            DATABASES=test_settings.DATABASES,
+            TEMPLATES=test_settings.TEMPLATES,
+        )
+        django_setup()
+
+
+def bench(func, repeat=5):
+    """
+    Returns the best time in seconds a single call to func took.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def report(title, headers, rows):
+    """
+    Print a simple table of benchmark results.
+    """
+    print(title)
+    print('=' * len(title))
+    widths = [
+        max(len(str(cell)) for cell in column)
+        for column in zip(headers, *rows)
+    ]
+    for row in [headers] + list(rows):
+        print('  '.join(
+            str(cell).rjust(width) for cell, width in zip(row, widths)
+        ))
+    print()
+
+
+def usec(seconds):
+    return '%.2fus' % (seconds * 1000000)
@@ -0,0 +1,46 @@
+"""
+Parse time of block tags with a chain of optional intermediate blocks, like
+elif chains, when all of them, every tenth one or none of them is used in the
+template.
+"""
+from tests.benchmarks import bench, report, setup, usec
+
+
+def main():
+    setup()
+    from django import template
+
+    from classytags import core
+    from tests.context_managers import TemplateTags
+
+    rows = []
+    for count in (5, 50, 200):
+        names = ['step%d' % index for index in range(count)]
+
+        class Chain(core.Tag):
+            options = core.Options(
+                blocks=[(name, 'pre_%s' % name) for name in names]
+                + [('end_chain', 'nodelist')],
+            )
+
+        used = {
+            'all': names,
+            'every tenth': names[::10],
+            'none': [],
+        }
+        with TemplateTags(Chain):
+            for title, steps in used.items():
+                source = '{% chain %}x' + ''.join(
+                    '{%% %s %%}x' % name for name in steps
+                ) + '{% end_chain %}'
+                seconds = bench(lambda: template.Template(source))
+                rows.append((count, title, usec(seconds)))
+    report(
+        'Parsing a tag with a chain of optional blocks',
+        ('blocks', 'used', 'per template'),
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Per error cost of a value failing to clean while DEBUG is off, warning about
+every error (the previous implementation) compared to counting repeats in
+classytags.diagnostics.collector, for a tag rendered in a loop over distinct
+invalid values. Every render starts with fresh warning registries and
+counters, like a new request with other invalid values. Warnings are captured
+by logging like Django does and written to os.devnull.
+"""
+import logging
+import os
+import warnings
+
+from tests.benchmarks import bench, report, setup, usec
+
+
+def main():
+    setup()
+    from django import template
+    from django.conf import settings
+
+    from classytags import arguments, core, values
+    from classytags.diagnostics import collector
+    from classytags.exceptions import TemplateSyntaxWarning
+    from tests.context_managers import TemplateTags
+
+    class LegacyValue(values.IntegerValue):
+        __slots__ = ()
+
+        def error(self, value, category):
+            data = self.get_extra_error_data()
+            data['value'] = repr(value)
+            message = self.errors.get(category, "") % data
+            if settings.DEBUG:
+                raise template.TemplateSyntaxError(message)
+            warnings.warn(message, TemplateSyntaxWarning)
+            return self.value_on_error
+
+    class LegacyArgument(arguments.IntegerArgument):
+        __slots__ = ()
+        value_class = LegacyValue
+
+    class Current(core.Tag):
+        options = core.Options(arguments.IntegerArgument('integer'))
+
+        def render_tag(self, context, integer):
+            return ''
+
+    class Legacy(Current):
+        options = core.Options(LegacyArgument('integer'))
+
+    source = '{%% for i in items %%}{%% %s i %%}{%% endfor %%}'
+    with TemplateTags(Current, Legacy):
+        current = template.Template(source % 'current')
+        legacy = template.Template(source % 'legacy')
+
+    def render(tpl, context):
+        # changing the filters invalidates the warning registries
+        warnings.simplefilter('default')
+        collector.reset()
+        return tpl.render(context)
+
+    logger = logging.getLogger('py.warnings')
+    logger.propagate = False
+    logging.captureWarnings(True)
+    rows = []
+    for count in (10, 1000):
+        context = template.Context({
+            'items': ['x%d' % index for index in range(count)]
+        })
+        with open(os.devnull, 'w') as devnull, warnings.catch_warnings():
+            handler = logging.StreamHandler(devnull)
+            logger.addHandler(handler)
+            old = bench(lambda: render(legacy, context)) / count
+            new = bench(lambda: render(current, context)) / count
+            logger.removeHandler(handler)
+        rows.append((count, usec(old), usec(new), '%.2fx' % (old / new)))
+    report(
+        'Failed clean while DEBUG is off (per error)',
+        ('errors', 'warn', 'collector', 'speedup'),
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
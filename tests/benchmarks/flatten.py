@@ -0,0 +1,57 @@
+"""
+Cost of Context.flatten() compared to the lazy FlatContext view returned by
+lazy_flatten_context, for deep (many layers) and wide (many variables)
+contexts, both to create the view and to create it and look up ten variables.
+"""
+from tests.benchmarks import bench, report, setup, usec
+
+
+def build(layers, width):
+    from django.template import Context
+
+    context = Context()
+    for layer in range(layers):
+        context.push({
+            'var%s' % index: layer for index in range(width)
+        })
+    return context
+
+
+def lookup(flat):
+    for index in range(10):
+        flat['var%s' % index]
+
+
+def main():
+    setup()
+    from classytags.utils import lazy_flatten_context
+
+    cases = [
+        ('deep', 100, 10),
+        ('deep', 1000, 10),
+        ('wide', 2, 1000),
+        ('wide', 2, 10000),
+    ]
+    rows = []
+    for title, layers, width in cases:
+        context = build(layers, width)
+        flatten = bench(context.flatten)
+        lazy = bench(lambda: lazy_flatten_context(context))
+        flatten_lookup = bench(lambda: lookup(context.flatten()))
+        lazy_lookup = bench(lambda: lookup(lazy_flatten_context(context)))
+        rows.append((
+            title, layers, width,
+            usec(flatten), usec(lazy), '%.2fx' % (flatten / lazy),
+            usec(flatten_lookup), usec(lazy_lookup),
+            '%.2fx' % (flatten_lookup / lazy_lookup),
+        ))
+    report(
+        'lazy_flatten_context',
+        ('case', 'layers', 'width', 'flatten', 'lazy', 'speedup',
+         'flatten+10', 'lazy+10', 'speedup'),
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
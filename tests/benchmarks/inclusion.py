@@ -0,0 +1,53 @@
+"""
+Per render cost of an InclusionTag which copies the context into dictionaries
+(copy_context = True, the default) compared to one rendering in new layers of
+the context (copy_context = False), with a growing number of variables in the
+parent context.
+"""
+from tests.benchmarks import bench, report, setup, usec
+
+
+def main():
+    setup()
+    from django import template
+
+    from classytags import helpers
+    from tests.context_managers import TemplateTags
+
+    class Copying(helpers.InclusionTag):
+        template = 'test.html'
+
+        def get_context(self, context):
+            return {'var': 'value'}
+
+    class Layered(Copying):
+        copy_context = False
+
+    rows = []
+    for push_context in (False, True):
+        Copying.push_context = Layered.push_context = push_context
+        with TemplateTags(Copying, Layered):
+            copying = template.Template('{% copying %}').nodelist[0]
+            layered = template.Template('{% layered %}').nodelist[0]
+        for size in (10, 100, 1000):
+            context = template.Context()
+            for layer in range(5):
+                context.push({
+                    'layer%s_%s' % (layer, index): index
+                    for index in range(size // 5)
+                })
+            old = bench(lambda: copying.render(context))
+            new = bench(lambda: layered.render(context))
+            rows.append((
+                push_context, size, usec(old), usec(new),
+                '%.2fx' % (old / new),
+            ))
+    report(
+        'InclusionTag.render',
+        ('push_context', 'variables', 'copy', 'layers', 'speedup'),
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
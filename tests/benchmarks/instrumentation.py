@@ -0,0 +1,109 @@
+"""
+Per call cost of Tag.render without instrumentation, after an instrument was
+enabled and disabled again and after a hook was registered and unregistered
+again (both of which should be the same), with the Timings instrument enabled,
+with no-op pre_render and post_render hooks registered and with a Sampler
+timing 1% of the renders and profiling 0.01%. The Sampler is also measured
+with an InclusionTag, its overhead is reported against the target of less
+than 1% of the render time.
+"""
+from tests.benchmarks import bench, report, setup, usec
+
+
+def compare(func, instrument, rounds=10):
+    """
+    Returns the best times of func without and with instrument enabled,
+    measured alternately so both see the same noise.
+    """
+    plain = instrumented = float('inf')
+    for _ in range(rounds):
+        plain = min(plain, bench(func, repeat=1))
+        with instrument:
+            instrumented = min(instrumented, bench(func, repeat=1))
+    return plain, instrumented
+
+
+def main():
+    setup()
+    from django import template
+
+    from classytags import arguments, core, helpers, instrumentation
+    from tests.context_managers import TemplateTags
+
+    class Format(core.Tag):
+        options = core.Options(
+            arguments.Argument('value'),
+            arguments.IntegerArgument('width'),
+        )
+
+        def render_tag(self, context, value, width):
+            return str(value).rjust(width)
+
+    class Greeting(helpers.InclusionTag):
+        template = 'test.html'
+
+        def get_context(self, context):
+            return {'var': 'value'}
+
+    with TemplateTags(Format, Greeting):
+        tag = template.Template('{% format value 10 %}').nodelist[0]
+        inclusion = template.Template('{% greeting %}').nodelist[0]
+    context = template.Context({'value': 'value'})
+
+    def render():
+        return tag.render(context)
+
+    plain = bench(render)
+    timings = instrumentation.Timings()
+    timings.enable()
+    timings.disable()
+    disabled = bench(render)
+    with timings:
+        enabled = bench(render)
+
+    def hook(*args):
+        pass
+
+    hooks = instrumentation.hooks
+    hooks.register('pre_render', hook)
+    hooks.unregister('pre_render', hook)
+    unhooked = bench(render)
+    hooks.register('pre_render', hook)
+    hooks.register('post_render', hook)
+    hooked = bench(render)
+    hooks.disable()
+    sampler = instrumentation.Sampler(rate=0.01, profile_rate=0.0001)
+    with sampler:
+        sampled = bench(render)
+    plain_inclusion = bench(lambda: inclusion.render(context))
+    with sampler:
+        sampled_inclusion = bench(lambda: inclusion.render(context))
+    rows = [
+        ('plain', usec(plain), '1.00x'),
+        ('disabled', usec(disabled), '%.2fx' % (disabled / plain)),
+        ('timings', usec(enabled), '%.2fx' % (enabled / plain)),
+        ('no hooks', usec(unhooked), '%.2fx' % (unhooked / plain)),
+        ('hooks', usec(hooked), '%.2fx' % (hooked / plain)),
+        ('sampler 1%', usec(sampled), '%.2fx' % (sampled / plain)),
+        ('inclusion', usec(plain_inclusion), '1.00x'),
+        ('inclusion, sampler 1%', usec(sampled_inclusion),
+         '%.2fx' % (sampled_inclusion / plain_inclusion)),
+    ]
+    report('Tag.render with instrumentation', ('mode', 'time', 'relative'), rows)
+    target = 0.01
+    rows = []
+    for name, func in [
+        ('tag', render),
+        ('inclusion', lambda: inclusion.render(context)),
+    ]:
+        before, after = compare(func, sampler)
+        overhead = after / before - 1
+        rows.append((
+            name, '%.2f%%' % (overhead * 100),
+            'ok' if overhead < target else 'over',
+        ))
+    report('Sampler overhead (target < 1%)', ('tag', 'overhead', 'target'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Memory held by parsed tags, measured with tracemalloc: the bytes allocated
+(and still alive) per tag instance for a few typical argument layouts.
+"""
+import gc
+import tracemalloc
+
+from tests.benchmarks import report, setup
+
+
+COUNT = 2000
+
+
+def measure(klass, contents, parser):
+    from django.template.base import Token, TokenType
+
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    tags = [
+        klass(parser, Token(TokenType.BLOCK, contents)) for _ in range(COUNT)
+    ]
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del tags
+    return size / COUNT
+
+
+def main():
+    setup()
+    from django.template.base import Parser as TemplateParser
+
+    from classytags import arguments, core
+    from tests.context_managers import builtins
+
+    class Simple(core.Tag):
+        options = core.Options(
+            arguments.Argument('value'),
+            arguments.IntegerArgument('width', required=False),
+        )
+
+    class Keywords(core.Tag):
+        options = core.Options(
+            arguments.MultiKeywordArgument('attrs'),
+            'as',
+            arguments.Argument('varname', resolve=False, required=False),
+        )
+
+    class Values(core.Tag):
+        options = core.Options(
+            arguments.MultiValueArgument('values'),
+            arguments.Flag('flag', true_values=['on'], default=False),
+        )
+
+    cases = [
+        ('variable and literal', Simple, 'simple value 10'),
+        ('keywords and varname', Keywords, 'keywords a=1 b=c c="d" as var'),
+        ('values and flag', Values, 'values a b "c" 1 2'),
+    ]
+    parser = TemplateParser([], builtins=builtins)
+    rows = [
+        (title, '%d bytes' % measure(klass, contents, parser))
+        for title, klass, contents in cases
+    ]
+    report(
+        'Memory per parsed tag (%d tags)' % COUNT, ('case', 'size'), rows
+    )
+
+
+if __name__ == '__main__':
+    main()
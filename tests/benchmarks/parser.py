@@ -0,0 +1,43 @@
+"""
+Parse time of tags with very long argument lists, which should grow linearly
+with the number of bits. The arguments are not resolved so the time is spent in
+the argument parser rather than in compiling filter expressions.
+"""
+from tests.benchmarks import bench, report, setup, usec
+
+
+def main():
+    setup()
+    from django.template.base import Parser as TemplateParser
+    from django.template.base import Token, TokenType
+    from django.template.engine import Engine
+
+    from classytags import arguments, core
+
+    template_parser = TemplateParser(
+        [], builtins=Engine.get_default().template_builtins
+    )
+    options = core.Options(
+        arguments.MultiValueArgument('values', resolve=False),
+        'as',
+        arguments.MultiKeywordArgument('extra', required=False,
+                                       resolve=False),
+    )
+    rows = []
+    for count in (10, 100, 1000, 10000):
+        bits = ['"value%d"' % index for index in range(count)]
+        bits += ['as'] + ['key%d=value%d' % (index, index)
+                          for index in range(count)]
+        token = Token(TokenType.BLOCK, 'bench %s' % ' '.join(bits))
+        seconds = bench(lambda: options.parse(template_parser, token))
+        per_bit = seconds / len(bits)
+        rows.append((len(bits), usec(seconds), usec(per_bit)))
+    report(
+        'Parsing MultiValueArgument/MultiKeywordArgument tags',
+        ('bits', 'per parse', 'per bit'),
+        rows,
+    )
+
+
+if __name__ == '__main__':
+    main()
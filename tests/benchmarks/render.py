@@ -0,0 +1,62 @@
+"""
+Per call cost of Tag.render compared to the previous implementation which
+merged the resolved arguments and blocks into a new dictionary and converted
+the output with str() on every call.
+"""
+from tests.benchmarks import bench, report, setup, usec
+
+
+def legacy_render(tag, context):
+    items = tag.kwargs.items()
+    kwargs = {key: value.resolve(context) for key, value in items}
+    kwargs.update(tag.blocks)
+    return str(tag.render_tag(context, **kwargs))
+
+
+def main():
+    setup()
+    from django import template
+    from django.utils.safestring import mark_safe
+
+    from classytags import arguments, core
+    from tests.context_managers import TemplateTags
+
+    class Format(core.Tag):
+        options = core.Options(
+            arguments.Argument('value'),
+            arguments.Argument('prefix'),
+            arguments.IntegerArgument('width'),
+            'as',
+            arguments.Argument('varname', resolve=False, required=False),
+        )
+
+        def render_tag(self, context, value, prefix, width, varname):
+            return mark_safe(prefix + str(value).rjust(width))
+
+    class Wrap(core.Tag):
+        options = core.Options(
+            arguments.Argument('css'),
+            blocks=['end_wrap'],
+        )
+
+        def render_tag(self, context, css, end_wrap):
+            return '<div class="%s">' % css
+
+    cases = [
+        ('literal arguments', Format, '{% format "x" ">" 5 %}'),
+        ('variable argument', Format, '{% format value ">" 5 %}'),
+        ('block tag', Wrap, '{% wrap "box" %}{% end_wrap %}'),
+    ]
+    rows = []
+    for title, klass, source in cases:
+        with TemplateTags(klass):
+            tag = template.Template(source).nodelist[0]
+        context = template.Context({'value': 42})
+        old = bench(lambda: legacy_render(tag, context))
+        new = bench(lambda: tag.render(context))
+        rows.append((title, usec(old), usec(new), '%.2fx' % (old / new)))
+    report('Tag.render', ('case', 'previous', 'current', 'speedup'), rows)
+
+
+if __name__ == '__main__':
+    main()
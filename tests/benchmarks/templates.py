@@ -0,0 +1,50 @@
+"""
+Per render cost of an InclusionTag which loads its template on every call,
+like render_to_string does (the previous implementation) compared to one
+which keeps the compiled template in its template_cache, with the cached and
+the plain filesystem template loaders.
+"""
+from tests.benchmarks import bench, report, setup, usec
+
+
+def main():
+    setup()
+    from django import template
+    from django.template import engines
+    from django.template.loader import get_template
+
+    from classytags import helpers
+    from tests.context_managers import TemplateTags
+
+    class Greeting(helpers.InclusionTag):
+        template = 'test.html'
+
+        def get_context(self, context):
+            return {'var': 'value'}
+
+    class Legacy(Greeting):
+        def resolve_template(self, context, **kwargs):
+            return get_template(self.get_template(context, **kwargs))
+
+    engine = engines['django'].engine
+    filesystem = ['django.template.loaders.filesystem.Loader']
+    loaders = [
+        ('cached loader', [('django.template.loaders.cached.Loader', filesystem)]),
+        ('filesystem loader', filesystem),
+    ]
+    rows = []
+    for title, config in loaders:
+        engine.loaders = config
+        engine.__dict__.pop('template_loaders', None)
+        with TemplateTags(Greeting, Legacy):
+            current = template.Template('{% greeting %}').nodelist[0]
+            legacy = template.Template('{% legacy %}').nodelist[0]
+        context = template.Context()
+        old = bench(lambda: legacy.render(context))
+        new = bench(lambda: current.render(context))
+        rows.append((title, usec(old), usec(new), '%.2fx' % (old / new)))
+    report('InclusionTag.render', ('loader', 'previous', 'current', 'speedup'), rows)
+
+
+if __name__ == '__main__':
+    main()
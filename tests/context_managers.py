@@ -44,8 +44,11 @@ class TemplateTags:  # pragma: no cover
             self.lib.tag(tag)
 
     def __enter__(self):
-        self.old = list(builtins)
-        builtins.insert(0, self.lib)
+        # the default engine is created again when the template settings
+        # are overridden
+        self.builtins = Engine.get_default().template_builtins
+        self.old = list(self.builtins)
+        self.builtins.insert(0, self.lib)
 
     def __exit__(self, type, value, traceback):
-        builtins[:] = self.old
+        self.builtins[:] = self.old
@@ -1,17 +1,38 @@
+import asyncio
+import importlib.util
+import json
 import operator
 import os
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import warnings
-from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from unittest import TestCase, skipUnless
 
 from django import template
+from django.core.cache import InvalidCacheBackendError, caches
 from django.core.exceptions import ImproperlyConfigured
-from django.template import Context, RequestContext
-from django.test import RequestFactory
-
-from classytags import arguments, core, exceptions, helpers, parser, utils, values
-from classytags.blocks import BlockDefinition, VariableBlockName
-from tests.context_managers import SettingsOverride, TemplateTags
+from django.core.signals import request_finished
+from django.db import connection
+from django.template import Context, RequestContext, engines
+from django.template.base import Parser as TemplateParser
+from django.template.base import Token, TokenType
+from django.template.loader import render_to_string
+from django.test import RequestFactory, override_settings
+from django.utils.safestring import SafeString, mark_safe
+
+from classytags import (
+    arguments, batching, core, diagnostics, exceptions, helpers, instrumentation, parser, prefetch, testing, utils,
+    values,
+)
+from classytags.blocks import BlockDefinition, BlockIdentifiers, VariableBlockName
+from tests.context_managers import SettingsOverride, TemplateTags, builtins
 
 
 CLASSY_TAGS_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -76,6 +97,9 @@ def _collect_warnings(observe_warning, f, *args, **kwargs):
 
 
 class ClassytagsTests(TestCase):
+    def setUp(self):
+        diagnostics.collector.reset()
+
     def failUnlessWarns(self, category, message, f, *args, **kwargs):
         warnings_shown = []
         result = _collect_warnings(warnings_shown.append, f, *args, **kwargs)
@@ -270,6 +294,29 @@ class ClassytagsTests(TestCase):
         self.assertRaises(exceptions.InvalidFlag,
                           options.parse, dummy_parser, dummy_tokens)
 
+    def test_flag_lookup(self):
+        flag = arguments.Flag(
+            'myflag', true_values=['On', 'yes', 1], false_values=['off', 'yes']
+        )
+        self.assertEqual(flag.true_values, ['on', 'yes', '1'])
+        self.assertEqual(flag.allowed_values, ('on', 'yes', '1', 'off', 'yes'))
+        self.assertEqual(
+            {key: value.resolve({}) for key, value in flag.lookup.items()},
+            {'on': True, 'yes': True, '1': True, 'off': False},
+        )
+        for token, expected in [('ON', True), ('Yes', True), (1, True), ('OFF', False)]:
+            kwargs = {}
+            self.assertTrue(flag.parse(dummy_parser, token, 'tag', kwargs))
+            self.assertIs(kwargs['myflag'].resolve({}), expected)
+        with self.assertRaises(exceptions.InvalidFlag) as raised:
+            flag.parse(dummy_parser, 'maybe', 'tag', {})
+        self.assertIs(raised.exception.allowed_values, flag.allowed_values)
+        sensitive = arguments.Flag('myflag', true_values=['On'], case_sensitive=True)
+        self.assertEqual(sensitive.mod('On'), 'On')
+        self.assertRaises(
+            exceptions.InvalidFlag, sensitive.parse, dummy_parser, 'on', 'tag', {}
+        )
+
     def test_flag_wrong_value_no_false(self):
         options = core.Options(
             arguments.Flag('myflag', true_values=['on'])
@@ -401,6 +448,32 @@ class ClassytagsTests(TestCase):
         self.assertRaises(exceptions.TooManyArguments,
                           options.parse, dummy_parser, dummy_tokens)
 
+    def test_multi_value_many_values(self):
+        options = core.Options(
+            arguments.MultiValueArgument('myarg'),
+            'as',
+            arguments.MultiKeywordArgument('extra', required=False),
+        )
+        values = ['myval%s' % index for index in range(5000)]
+        extra = ['key%s=value%s' % (index, index) for index in range(5000)]
+        dummy_tokens = DummyTokens(*(values + ['as'] + extra))
+        kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
+        self.assertEqual(blocks, {})
+        dummy_context = {}
+        self.assertEqual(kwargs['myarg'].resolve(dummy_context), values)
+        resolved = kwargs['extra'].resolve(dummy_context)
+        self.assertEqual(len(resolved), 5000)
+        self.assertEqual(resolved['key4999'], 'value4999')
+
+    def test_too_many_arguments_extra(self):
+        options = core.Options(
+            arguments.MultiValueArgument('myarg', max_values=2),
+        )
+        dummy_tokens = DummyTokens('one', 'two', 'three', 'four')
+        with self.assertRaises(exceptions.TooManyArguments) as raised:
+            options.parse(dummy_parser, dummy_tokens)
+        self.assertEqual(raised.exception.extra, "'three', 'four'")
+
     def test_multi_value_no_resolve(self):
         # test no resolve
         options = core.Options(
@@ -763,26 +836,22 @@ class ClassytagsTests(TestCase):
             kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
             dummy_context = {}
             self.assertEqual(kwargs['integer'].resolve(dummy_context), 1)
-            # test warning
+            # test warning, literals are cleaned when parsing
             dummy_tokens = DummyTokens('one')
-            kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
-            dummy_context = {}
             one = repr('one')
             message = arguments.IntegerValue.errors['clean'] % {'value': one}
-            self.assertWarns(exceptions.TemplateSyntaxWarning,
-                             message, kwargs['integer'].resolve, dummy_context)
+            kwargs, blocks = self.assertWarns(
+                exceptions.TemplateSyntaxWarning, message,
+                options.parse, dummy_parser, dummy_tokens
+            )
+            dummy_context = {}
             self.assertEqual(kwargs['integer'].resolve(dummy_context),
                              values.IntegerValue.value_on_error)
             # test exception
         with SettingsOverride(DEBUG=True):
             dummy_tokens = DummyTokens('one')
-            kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
-            dummy_context = {}
-            message = values.IntegerValue.errors['clean'] % {
-                'value': repr('one')
-            }
             self.assertRaises(template.TemplateSyntaxError,
-                              kwargs['integer'].resolve, dummy_context)
+                              options.parse, dummy_parser, dummy_tokens)
         # test the same as above but with resolving
 
         class IntegerTag(core.Tag):
@@ -866,11 +935,17 @@ class ClassytagsTests(TestCase):
                 self.assertEqual(kwargs['choice'].resolve(dummy_context), good)
             bad = 'four'
             dummy_tokens = DummyTokens(bad)
-            kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
-            dummy_context = {}
             self.assertRaises(template.TemplateSyntaxError,
-                              kwargs['choice'].resolve, dummy_context)
+                              options.parse, dummy_parser, dummy_tokens)
         with SettingsOverride(DEBUG=False):
+            dummy_tokens = DummyTokens(bad)
+            message = values.ChoiceValue.errors['choice'] % {
+                'value': repr(bad), 'choices': ['one', 'two', 'three'],
+            }
+            kwargs, blocks = self.assertWarns(
+                exceptions.TemplateSyntaxWarning, message,
+                options.parse, dummy_parser, dummy_tokens
+            )
             self.assertEqual(kwargs['choice'].resolve(dummy_context), 'one')
             # test other value class
 
@@ -891,11 +966,11 @@ class ClassytagsTests(TestCase):
                                  int(good))
             bad = '4'
             dummy_tokens = DummyTokens(bad)
-            kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
-            dummy_context = {}
             self.assertRaises(template.TemplateSyntaxError,
-                              kwargs['choice'].resolve, dummy_context)
+                              options.parse, dummy_parser, dummy_tokens)
         with SettingsOverride(DEBUG=False):
+            dummy_tokens = DummyTokens(bad)
+            kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
             self.assertEqual(kwargs['choice'].resolve(dummy_context), default)
             # reset settings
 
@@ -1148,6 +1223,72 @@ class ClassytagsTests(TestCase):
             expected_output = 'nodelist:nodelist-content;myarg:world'
             self.assertEqual(output, expected_output)
 
+    def test_block_identifiers(self):
+        options = core.Options(
+            blocks=[('middle', 'pre_middle'), 'other', ('end', 'pre_end')],
+        )
+        identifiers = options.plan.block_identifiers
+        self.assertEqual(identifiers.ends, (
+            frozenset(['middle']), frozenset(['other']), frozenset(['end']),
+        ))
+        self.assertEqual(identifiers.until, (
+            ('middle', 'other', 'end'), ('other', 'end'), ('end',),
+        ))
+        vbn = VariableBlockName('end %(value)s', 'myarg')
+        options = core.Options(
+            arguments.Argument('myarg'),
+            blocks=[BlockDefinition('nodelist', vbn, 'end')],
+        )
+        self.assertIsNone(options.plan.block_identifiers)
+        self.assertIsInstance(
+            BlockIdentifiers([['end x', 'end']]).ends[0], frozenset
+        )
+
+        class Chain(core.Tag):
+            options = core.Options(
+                blocks=[('middle', 'pre_middle'), 'other', ('end_chain', 'pre_end')],
+            )
+
+            def render_tag(self, context, pre_middle, other, pre_end):
+                return '%s|%s|%s' % (
+                    pre_middle.render(context), other.render(context),
+                    pre_end.render(context),
+                )
+
+        with TemplateTags(Chain):
+            tpl = template.Template(
+                '{% chain %}a{% middle %}b{% other %}c{% end_chain %}'
+            )
+            self.assertEqual(tpl.render(Context()), 'a|b|c')
+            # skipped blocks are empty
+            tpl = template.Template('{% chain %}a{% end_chain %}')
+            self.assertEqual(tpl.render(Context()), 'a||')
+            tpl = template.Template('{% chain %}a{% other %}c{% end_chain %}')
+            self.assertEqual(tpl.render(Context()), 'a||c')
+            with self.assertRaises(template.TemplateSyntaxError) as raised:
+                template.Template('{% chain %}a')
+            self.assertIn('middle, other, end_chain', str(raised.exception))
+
+    def test_named_block_names_cached(self):
+        vbn = VariableBlockName('end_block %(value)s', 'myarg')
+
+        class StartBlock(core.Tag):
+            options = core.Options(
+                arguments.Argument('myarg'),
+                blocks=[BlockDefinition('nodelist', vbn, 'end_block')],
+            )
+
+            def render_tag(self, context, myarg, nodelist):
+                return nodelist.render(context)
+
+        with TemplateTags(StartBlock):
+            for _ in range(2):
+                tpl = template.Template(
+                    '{% start_block x %}content{% end_block x %}'
+                )
+                self.assertEqual(tpl.render(Context()), 'content')
+        self.assertEqual(vbn.names, {'x': 'end_block x'})
+
     def test_fail_named_block(self):
         vbn = VariableBlockName('endblock %(value)s', 'myarg')
         self.assertRaises(ImproperlyConfigured, core.Options,
@@ -1193,30 +1334,100 @@ class ClassytagsTests(TestCase):
             self.assertEqual(
                 kwargs['string'].resolve(dummy_context), 'string'
             )
-            # test warning
+            # test warning, literals are cleaned when parsing
             dummy_tokens = DummyTokens(1)
-            kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
-            dummy_context = {}
             message = values.StrictStringValue.errors['clean'] % {
                 'value': repr(1)
             }
-            self.assertWarns(
+            kwargs, blocks = self.assertWarns(
                 exceptions.TemplateSyntaxWarning,
                 message,
-                kwargs['string'].resolve,
-                dummy_context
+                options.parse,
+                dummy_parser,
+                dummy_tokens
             )
+            self.assertEqual(kwargs['string'].resolve({}), '')
         with SettingsOverride(DEBUG=True):
             # test exception
             dummy_tokens = DummyTokens(1)
-            kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
-            dummy_context = {}
             self.assertRaises(
                 template.TemplateSyntaxError,
-                kwargs['string'].resolve,
-                dummy_context
+                options.parse,
+                dummy_parser,
+                dummy_tokens
+            )
+
+    def test_render_bindings(self):
+        class Bound(core.Tag):
+            options = core.Options(
+                arguments.Argument('literal'),
+                arguments.Argument('variable'),
+                arguments.Argument('optional', required=False, default=1),
+                blocks=['end_bound'],
+            )
+
+            def render_tag(self, context, literal, variable, optional,
+                           end_bound):
+                return '{}:{}:{}:{}'.format(
+                    literal, variable, optional, end_bound.render(context)
+                )
+
+        with TemplateTags(Bound):
+            tpl = template.Template(
+                '{% bound "a" var %}{{ var }}{% end_bound %}'
+            )
+        tag = tpl.nodelist[0]
+        self.assertIsNone(tag.resolvers)
+        self.assertEqual(tpl.render(Context({'var': 'b'})), 'a:b:1:b')
+        self.assertEqual(
+            [key for key, value in tag.resolvers], ['variable']
+        )
+        self.assertEqual(
+            sorted(tag.static_kwargs), ['end_bound', 'literal', 'optional']
+        )
+        self.assertEqual(tpl.render(Context({'var': 'c'})), 'a:c:1:c')
+        # changing the arguments after parsing requires preparing again
+        tag.kwargs['literal'] = values.StringValue(
+            utils.TemplateConstant('d')
+        )
+        tag.prepare_render()
+        self.assertEqual(tpl.render(Context({'var': 'b'})), 'd:b:1:b')
+
+    def test_render_bindings_changed_in_init(self):
+        class Changed(core.Tag):
+            options = core.Options(
+                arguments.Argument('a'),
+                arguments.Argument('b', required=False, default='default'),
+            )
+
+            def __init__(self, parser, tokens):
+                super().__init__(parser, tokens)
+                self.kwargs['b'] = utils.TemplateConstant('B')
+
+            def render_tag(self, context, a, b):
+                return a + b
+
+        with TemplateTags(Changed):
+            tpl = template.Template('{% changed "A" %}')
+        self.assertEqual(tpl.render(Context()), 'AB')
+
+    def test_render_output_types(self):
+        class Output(core.Tag):
+            options = core.Options(
+                arguments.Argument('value', resolve=False),
             )
 
+            def render_tag(self, context, value):
+                if value == 'safe':
+                    return mark_safe('<b>')
+                return 42
+
+        safe = Output(dummy_parser, DummyTokens('safe')).render({})
+        self.assertIsInstance(safe, SafeString)
+        self.assertEqual(safe, '<b>')
+        self.assertEqual(Output(dummy_parser, DummyTokens('int')).render({}),
+                         '42')
+
     def test_get_value_for_context(self):
         message = 'exception handled'
 
@@ -1250,168 +1461,2146 @@ class ClassytagsTests(TestCase):
         self.assertRaises(MyException, tag.render, {})
 
 
-class MultiBreakpointTests(TestCase):
-    def test_optional_firstonly(self):
-        options = core.Options(
-            arguments.Argument('first'),
-            'also',
-            'using',
-            arguments.Argument('second', required=False),
-        )
-        # check only using the first argument
-        dummy_tokens = DummyTokens('firstval')
-        kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
-        self.assertEqual(blocks, {})
-        self.assertEqual(len(kwargs), 2)
-        dummy_context = {}
-        self.assertEqual(kwargs['first'].resolve(dummy_context), 'firstval')
-        self.assertEqual(kwargs['second'].resolve(dummy_context), None)
+class SlotsTests(TestCase):
+    def test_compact_instances(self):
+        var = TemplateParser([]).compile_filter('var')
+        instances = [
+            utils.TemplateConstant('x'),
+            values.StringValue(var),
+            values.IntegerValue(var),
+            values.ConstantValue(var, 1),
+            values.ListValue(var),
+            values.DictValue({'key': var}),
+            arguments.Argument('name'),
+            arguments.KeywordArgument('name'),
+            arguments.MultiValueArgument('name'),
+            arguments.MultiKeywordArgument('name'),
+            arguments.Flag('name', true_values=['on']),
+            core.Options(arguments.Argument('name')).bootstrap(),
+        ]
+        for instance in instances:
+            self.assertFalse(hasattr(instance, '__dict__'), instance)
 
-    def test_optional_both(self):
-        options = core.Options(
-            arguments.Argument('first'),
-            'also',
-            'using',
-            arguments.Argument('second', required=False),
-        )
-        # check using both arguments and both breakpoints
-        dummy_tokens = DummyTokens('firstval', 'also', 'using', 'secondval')
-        kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
-        self.assertEqual(blocks, {})
-        self.assertEqual(len(kwargs), 2)
-        dummy_context = {}
-        self.assertEqual(kwargs['first'].resolve(dummy_context), 'firstval')
-        self.assertEqual(kwargs['second'].resolve(dummy_context), 'secondval')
+    def test_subclasses(self):
+        class Custom(values.StringValue):
+            pass
 
-    def test_partial_breakpoints(self):
-        options = core.Options(
-            arguments.Argument('first'),
-            'also',
-            'using',
-            arguments.Argument('second', required=False),
-        )
-        # check only using the first breakpoint
-        dummy_tokens = DummyTokens('firstval', 'also')
-        self.assertRaises(
-            exceptions.TrailingBreakpoint,
-            options.parse, dummy_parser, dummy_tokens
-        )
+        value = Custom(utils.TemplateConstant('x'))
+        value.extra = True
+        self.assertEqual(value.resolve({}), 'x')
+        self.assertIsInstance(values.ListValue('x'), values.BaseValue)
+
+
+class ChoiceTests(TestCase):
+    def parse(self, argument, token):
+        options = core.Options(argument)
+        parser = TemplateParser([], builtins=builtins)
+        kwargs, blocks = options.parse(parser, DummyTokens(token))
+        return kwargs['choice']
+
+    def test_shared_value_class(self):
+        first = arguments.ChoiceArgument('choice', ['a', 'b'])
+        second = arguments.ChoiceArgument('choice', ['c'])
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertIs(first.value_class, values.StringValue)
+        value = self.parse(first, 'var')
+        other = self.parse(second, 'var')
+        self.assertIs(type(value), type(other))
+        self.assertIsInstance(value, values.ChoiceValue)
+        self.assertIs(value.choice_set, first.choice_set)
+        self.assertEqual(value.resolve({'var': 'b'}), 'b')
+        self.assertEqual(other.resolve({'var': 'c'}), 'c')
+        self.assertIs(
+            arguments.choice_value_class(values.IntegerValue),
+            arguments.choice_value_class(values.IntegerValue),
+        )
+
+    def test_slotted_value_class(self):
+        class Upper(values.StringValue):
+            __slots__ = ('upper',)
+
+            def __init__(self, var):
+                super().__init__(var)
+                self.upper = True
+
+            def clean(self, value):
+                return value.upper() if self.upper else value
+
+        class Color(values.ChoiceValue):
+            __slots__ = ()
+            choices = ['RED']
+
+        class UpperArgument(arguments.ChoiceArgument):
+            __slots__ = ()
+            value_class = Upper
+
+        class ColorArgument(arguments.ChoiceArgument):
+            __slots__ = ()
+            value_class = Color
+
+        value = self.parse(UpperArgument('choice', ['A', 'B']), 'var')
+        self.assertFalse(hasattr(value, '__dict__'))
+        self.assertIsInstance(value, Upper)
+        self.assertIsInstance(value, values.ChoiceValue)
+        self.assertEqual(value.resolve({'var': 'b'}), 'B')
+        value = self.parse(ColorArgument('choice', ['BLUE']), 'var')
+        self.assertIsInstance(value, Color)
+        self.assertEqual(value.resolve({'var': 'BLUE'}), 'BLUE')
+        self.assertEqual(Color(value.var).resolve({'var': 'RED'}), 'RED')
+
+    def test_choice_set(self):
+        choices = values.ChoiceSet(['a', 'b'], 'a')
+        self.assertIsInstance(choices.lookup, frozenset)
+        self.assertIn('a', choices)
+        self.assertNotIn('c', choices)
+        self.assertNotIn(['a'], choices)
+        unhashable = values.ChoiceSet([['a'], 'b'], 'b')
+        self.assertIsInstance(unhashable.lookup, list)
+        self.assertIn(['a'], unhashable)
+        self.assertNotIn('a', unhashable)
+
+    def test_value_on_error(self):
+        with SettingsOverride(DEBUG=False):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                required = arguments.ChoiceArgument('choice', ['a', 'b'])
+                self.assertEqual(self.parse(required, 'var').resolve({'var': 'c'}), 'a')
+                default = arguments.ChoiceArgument('choice', ['a', 'b'], default='b')
+                self.assertEqual(self.parse(default, 'var').resolve({'var': 'c'}), 'b')
+                optional = arguments.ChoiceArgument('choice', ['a', 'b'], required=False)
+                self.assertIsNone(self.parse(optional, 'var').resolve({'var': 'c'}))
+
+    def test_choice_value_class(self):
+        class Color(values.ChoiceValue):
+            choices = ['red', 'green']
+            value_on_error = 'red'
+
+        var = TemplateParser([]).compile_filter('var')
+        value = Color(var)
+        self.assertEqual(value.resolve({'var': 'green'}), 'green')
+        choice_set = values.ChoiceSet(['blue'], 'blue')
+        self.assertRaises(TypeError, values.ChoiceValue, var, choice_set)
+        blue = arguments.choice_value_class(Color)(var, choice_set)
+        self.assertIsInstance(blue, Color)
+        self.assertEqual(blue.resolve({'var': 'blue'}), 'blue')
+        with SettingsOverride(DEBUG=False):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                self.assertEqual(value.resolve({'var': 'blue'}), 'red')
 
-    def test_partial_breakpoints_second(self):
-        options = core.Options(
-            arguments.Argument('first'),
-            'also',
-            'using',
-            arguments.Argument('second', required=False),
-        )
-        # check only using the second breakpoint
-        dummy_tokens = DummyTokens('firstval', 'using')
-        self.assertRaises(
-            exceptions.BreakpointExpected,
-            options.parse, dummy_parser, dummy_tokens
-        )
 
-    def test_partial_breakpoints_both(self):
-        options = core.Options(
-            arguments.Argument('first'),
-            'also',
-            'using',
-            arguments.Argument('second', required=False),
-        )
-        # check only using the first breakpoint
-        dummy_tokens = DummyTokens('firstval', 'also', 'secondval')
-        # should raise an exception
-        self.assertRaises(
-            exceptions.BreakpointExpected,
-            options.parse, dummy_parser, dummy_tokens
-        )
+class DiagnosticsTests(TestCase):
+    def setUp(self):
+        diagnostics.collector.reset()
 
-    def test_partial_breakpoints_second_both(self):
-        options = core.Options(
-            arguments.Argument('first'),
-            'also',
-            'using',
-            arguments.Argument('second', required=False),
-        )
-        # check only using the second breakpoint
-        dummy_tokens = DummyTokens('firstval', 'using', 'secondval')
-        self.assertRaises(
-            exceptions.BreakpointExpected,
-            options.parse, dummy_parser, dummy_tokens
-        )
+    def test_repeated_errors_counted(self):
+        class IntegerTag(core.Tag):
+            options = core.Options(
+                arguments.IntegerArgument('integer'),
+            )
 
-    def test_partial_breakpoints_both_trailing(self):
-        options = core.Options(
-            arguments.Argument('first'),
-            'also',
-            'using',
-            arguments.Argument('second', required=False),
-        )
-        dummy_tokens = DummyTokens('firstval', 'also', 'using')
-        self.assertRaises(
-            exceptions.TrailingBreakpoint,
-            options.parse, dummy_parser, dummy_tokens
-        )
+            def render_tag(self, context, integer):
+                return integer
 
-    def test_add_options(self):
-        options1 = core.Options(
-            arguments.Argument('first')
-        )
-        options2 = core.Options(
-            arguments.Argument('second')
+        with TemplateTags(IntegerTag):
+            tpl = template.Template('{% for i in items %}{% integer_tag i %}{% endfor %}')
+        with SettingsOverride(DEBUG=False):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                output = tpl.render(Context({'items': ['x'] * 100}))
+        self.assertEqual(output, '0' * 100)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(
+            diagnostics.collector.snapshot(),
+            {('integer_tag', 'integer', 'clean'): 100},
         )
-        combined = options1 + options2
-        self.assertEqual(len(combined.options), 1, combined.options)
-        self.assertIn(None, combined.options)
-        self.assertEqual(len(combined.options[None]), 2, combined.options[None])
-        self.assertEqual(combined.all_argument_names, ['first', 'second'])
-        self.assertEqual(len(combined.blocks), 0, combined.blocks)
 
-    def test_add_options_blocks_first(self):
-        options1 = core.Options(
-            arguments.Argument('first'),
-            blocks=['a']
-        )
-        options2 = core.Options(
-            arguments.Argument('second'),
+    def test_parse_errors_attributed(self):
+        options = core.Options(arguments.IntegerArgument('integer', resolve=False))
+        with SettingsOverride(DEBUG=False):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                options.parse(dummy_parser, DummyTokens('one'))
+        self.assertEqual(
+            diagnostics.collector.snapshot(),
+            {('dummy_tag', 'integer', 'clean'): 1},
         )
-        combined = options1 + options2
-        self.assertEqual(len(combined.blocks), 1, combined.blocks)
-        self.assertEqual(combined.blocks[0].alias, 'a')
-        self.assertEqual(combined.blocks[0].names, ('a', ))
 
-    def test_add_options_blocks_second(self):
-        options1 = core.Options(
-            arguments.Argument('first'),
-        )
-        options2 = core.Options(
-            arguments.Argument('second'),
-            blocks=['a']
-        )
-        combined = options1 + options2
-        self.assertEqual(len(combined.blocks), 1, combined.blocks)
-        self.assertEqual(combined.blocks[0].alias, 'a')
-        self.assertEqual(combined.blocks[0].names, ('a', ))
+    def test_names_passed_explicitly(self):
+        class Renamed(arguments.Argument):
+            __slots__ = ()
+            value_class = values.IntegerValue
 
-    def test_add_options_blocks_both(self):
-        options1 = core.Options(
-            arguments.Argument('first'),
-            blocks=['a'],
-        )
-        options2 = core.Options(
-            arguments.Argument('second'),
-            blocks=['a']
-        )
-        self.assertRaises(
-            ValueError,
-            operator.add,
-            options1,
-            options2,
-        )
+            def parse(self, parser, bit, name, result):
+                if self.name in result:
+                    return False
+                result[self.name] = self.wrap_value(self.parse_token(parser, bit))
+                return True
 
-    def test_add_options_not_options(self):
-        options = core.Options(
-            arguments.Argument('first'),
+        class IntegersArgument(arguments.MultiValueArgument):
+            __slots__ = ()
+            value_class = values.IntegerValue
+
+        class Numbers(core.Tag):
+            options = core.Options(
+                Renamed('literal'),
+                IntegersArgument('numbers'),
+            )
+
+            def render_tag(self, context, literal, numbers):
+                return ''
+
+        with SettingsOverride(DEBUG=False):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                with TemplateTags(Numbers):
+                    tpl = template.Template('{% numbers "x" a b %}')
+                tpl.render(Context({'a': 'y', 'b': 'z'}))
+                # values cleaned elsewhere have no names
+                values.IntegerValue(utils.TemplateConstant('x')).resolve({})
+        self.assertEqual(diagnostics.collector.snapshot(), {
+            ('numbers', 'literal', 'clean'): 1,
+            ('numbers', 'numbers', 'clean'): 2,
+            (None, None, 'clean'): 1,
+        })
+
+    def test_summary(self):
+        collector = diagnostics.Diagnostics(interval=3600, limit=1)
+        value = values.IntegerValue(utils.TemplateConstant('x'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for bad in ('one', 'two', 'three'):
+                collector.record(value, bad, 'clean', tag='a', argument='b')
+            collector.record(value, 'four', 'clean', tag='a', argument='c')
+            collector.record(value, 'four', 'clean', tag='a', argument='c')
+            self.assertEqual(len(caught), 2)
+            self.assertEqual(str(caught[0].message), value.get_error_message('one', 'clean'))
+            collector.emit()
+            self.assertEqual(len(caught), 3)
+            collector.emit()
+            self.assertEqual(len(caught), 3)
+        summary = str(caught[2].message)
+        self.assertTrue(summary.startswith('3 value errors repeated'))
+        self.assertIn(
+            "clean (tag 'a', argument 'b'): 2 times, last: %s" % value.get_error_message('three', 'clean'),
+            summary,
+        )
+        self.assertIn('and 1 more', summary)
+        self.assertEqual(collector.snapshot()[('a', 'b', 'clean')], 3)
+        collector.reset()
+        self.assertEqual(collector.snapshot(), {})
+
+    def test_interval(self):
+        collector = diagnostics.Diagnostics(interval=0)
+        value = values.IntegerValue(utils.TemplateConstant('x'))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            collector.record(value, 'one', 'clean', tag='a', argument='b')
+            collector.record(value, 'one', 'clean', tag='a', argument='b')
+        # every record starts a new interval, so each error is a first one
+        self.assertEqual(len(caught), 2)
+
+    def test_per_request(self):
+        collector = diagnostics.collector
+        collector.per_request = True
+        value = values.IntegerValue(utils.TemplateConstant('x'))
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                collector.record(value, 'one', 'clean', tag='a', argument='b')
+                collector.record(value, 'one', 'clean', tag='a', argument='b')
+                request_finished.send(sender=None)
+        finally:
+            collector.per_request = False
+        self.assertEqual(len(caught), 2)
+        self.assertIn('1 value errors repeated', str(caught[1].message))
+
+
+class InstrumentationTests(TestCase):
+    def test_disabled_restores_methods(self):
+        methods = {name: core.Tag.__dict__[name] for name in instrumentation.METHODS}
+        timings = instrumentation.Timings()
+        with timings:
+            self.assertTrue(timings.enabled)
+            self.assertIsNot(core.Tag.render, methods['render'])
+            self.assertEqual(core.Tag.render.__name__, 'render')
+        self.assertFalse(timings.enabled)
+        for name, method in methods.items():
+            self.assertIs(core.Tag.__dict__[name], method)
+
+    def test_nested_instruments(self):
+        first = instrumentation.Timings()
+        second = instrumentation.Timings()
+
+        class Hello(core.Tag):
+            def render_tag(self, context):
+                return 'hello'
+
+        with TemplateTags(Hello):
+            first.enable()
+            second.enable()
+            first.disable()
+            tpl = template.Template('{% hello %}')
+            tpl.render(Context())
+            second.disable()
+        self.assertEqual(first.snapshot(), {})
+        self.assertEqual(second.snapshot()['hello']['renders'], 1)
+        self.assertIs(core.Tag.render, instrumentation.originals['render'])
+
+    def test_timings(self):
+        def slow(value):
+            time.sleep(0.01)
+            return value
+
+        class Slow(core.Tag):
+            options = core.Options(arguments.Argument('value'))
+
+            def render_tag(self, context, value):
+                time.sleep(0.02)
+                return value
+
+        library = template.Library()
+        library.filter('slow', slow)
+        parser = TemplateParser([], builtins=builtins + [library])
+        timings = instrumentation.Timings(samples=2)
+        with timings:
+            tag = Slow(parser, Token(TokenType.BLOCK, 'slow value|slow'))
+            for _ in range(3):
+                self.assertEqual(tag.render(Context({'value': 'x'})), 'x')
+        snapshot = timings.snapshot()['slow']
+        self.assertEqual(snapshot['parses'], 1)
+        self.assertEqual(snapshot['renders'], 3)
+        self.assertEqual(snapshot['resolves'], 3)
+        self.assertGreaterEqual(snapshot['resolve_time'], 0.03)
+        self.assertGreaterEqual(snapshot['user_time'], 0.06)
+        self.assertLess(snapshot['resolve_time'], snapshot['user_time'])
+        self.assertAlmostEqual(
+            snapshot['render_time'],
+            snapshot['resolve_time'] + snapshot['user_time'],
+        )
+        self.assertGreaterEqual(snapshot['p50'], 0.03)
+        self.assertLessEqual(snapshot['p50'], snapshot['p99'])
+        self.assertEqual(len(timings.tags['slow'].durations), 2)
+        timings.reset()
+        self.assertEqual(timings.snapshot(), {})
+
+    def test_async_timings(self):
+        class Hello(core.Tag):
+            def render_tag(self, context):
+                return 'hello'
+
+        parser = TemplateParser([], builtins=builtins)
+        tag = Hello(parser, Token(TokenType.BLOCK, 'hello'))
+        with instrumentation.Timings() as timings:
+            self.assertEqual(asyncio.run(tag.arender(Context())), 'hello')
+        self.assertEqual(timings.snapshot()['hello']['renders'], 1)
+
+    def test_percentile(self):
+        self.assertIsNone(instrumentation.percentile([], 0.5))
+        ordered = list(range(100))
+        self.assertEqual(instrumentation.percentile(ordered, 0.5), 50)
+        self.assertEqual(instrumentation.percentile(ordered, 0.99), 99)
+        self.assertEqual(instrumentation.percentile(ordered, 1), 99)
+
+
+class HookTests(TestCase):
+    def tearDown(self):
+        instrumentation.hooks.disable()
+
+    def test_compiled_out(self):
+        hooks = instrumentation.hooks
+
+        def hook(*args):
+            pass
+
+        hooks.register('pre_parse', hook)
+        self.assertTrue(hooks.enabled)
+        self.assertIsNot(core.Tag.__init__, instrumentation.originals['__init__'])
+        # only the methods needed by the registered events are wrapped
+        self.assertIs(core.Tag.render, instrumentation.originals['render'])
+        self.assertIs(core.Tag.resolve_kwargs, instrumentation.originals['resolve_kwargs'])
+        hooks.unregister('pre_parse', hook)
+        self.assertFalse(hooks.enabled)
+        for name, method in instrumentation.originals.items():
+            self.assertIs(core.Tag.__dict__[name], method)
+        with self.assertRaises(ValueError):
+            hooks.register('render', hook)
+
+    def test_hooks(self):
+        calls = []
+        hooks = instrumentation.hooks
+
+        @hooks.register('pre_parse')
+        def pre_parse(tag, parser, token):
+            calls.append(('pre_parse', tag.name, token.contents))
+
+        @hooks.register('post_parse')
+        def post_parse(tag, parser, token, error):
+            calls.append(('post_parse', tag.kwargs['value'].literal, error))
+
+        @hooks.register('pre_render')
+        def pre_render(tag, context, kwargs):
+            calls.append(('pre_render', dict(kwargs)))
+            kwargs['value'] = kwargs['value'].upper()
+
+        @hooks.register('post_render')
+        def post_render(tag, context, kwargs, output, error):
+            calls.append(('post_render', kwargs, output, error))
+
+        class Echo(core.Tag):
+            options = core.Options(arguments.Argument('value'))
+
+            def render_tag(self, context, value):
+                return value
+
+        parser = TemplateParser([], builtins=builtins)
+        tag = Echo(parser, Token(TokenType.BLOCK, 'echo value'))
+        self.assertEqual(tag.render(Context({'value': 'x'})), 'X')
+        # prefetching resolves the arguments outside of a render
+        tag.get_prefetch_kwargs(Context({'value': 'y'}))
+        self.assertEqual(calls, [
+            ('pre_parse', 'echo', 'echo value'),
+            ('post_parse', 'value', None),
+            ('pre_render', {'value': 'x'}),
+            ('post_render', {'value': 'X'}, 'X', None),
+        ])
+
+    def test_errors(self):
+        errors = []
+        hooks = instrumentation.hooks
+        hooks.register('post_parse', lambda tag, parser, token, error: errors.append(error))
+        hooks.register(
+            'post_render',
+            lambda tag, context, kwargs, output, error: errors.append((kwargs, output, error)),
+        )
+
+        class Broken(core.Tag):
+            options = core.Options(arguments.Argument('value'))
+
+            def render_tag(self, context, value):
+                raise KeyError(value)
+
+        parser = TemplateParser([], builtins=builtins)
+        self.assertRaises(
+            exceptions.ArgumentRequiredError,
+            Broken, parser, Token(TokenType.BLOCK, 'broken'),
+        )
+        self.assertIsInstance(errors.pop(), exceptions.ArgumentRequiredError)
+        tag = Broken(parser, Token(TokenType.BLOCK, 'broken "x"'))
+        self.assertEqual(errors.pop(), None)
+        self.assertRaises(KeyError, tag.render, Context())
+        kwargs, output, error = errors.pop()
+        self.assertEqual(kwargs, {'value': 'x'})
+        self.assertIsNone(output)
+        self.assertIsInstance(error, KeyError)
+
+    def test_async(self):
+        calls = []
+        hooks = instrumentation.hooks
+        hooks.register('pre_render', lambda tag, context, kwargs: calls.append(kwargs))
+        hooks.register(
+            'post_render',
+            lambda tag, context, kwargs, output, error: calls.append(output),
+        )
+
+        class Echo(core.Tag):
+            options = core.Options(arguments.Argument('value'))
+
+            def render_tag(self, context, value):
+                return value
+
+        parser = TemplateParser([], builtins=builtins)
+        tag = Echo(parser, Token(TokenType.BLOCK, 'echo value'))
+        self.assertEqual(asyncio.run(tag.arender(Context({'value': 'x'}))), 'x')
+        self.assertEqual(calls, [{'value': 'x'}, 'x'])
+
+
+class SamplerTests(TestCase):
+    def get_tag(self):
+        class Sampled(helpers.AsTag):
+            options = core.Options(
+                arguments.Argument('value'),
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+
+            def get_value(self, context, value):
+                return value
+
+        parser = TemplateParser([], builtins=builtins)
+        return Sampled(parser, Token(TokenType.BLOCK, 'sampled value'))
+
+    def test_sampling(self):
+        tag = self.get_tag()
+        sampler = instrumentation.Sampler(rate=0.5, profile_rate=0.25)
+        self.assertEqual(sampler.every, 2)
+        self.assertEqual(sampler.profile_every, 2)
+        with sampler:
+            for _ in range(8):
+                self.assertEqual(tag.render(Context({'value': 'x'})), 'x')
+        snapshot = sampler.snapshot()
+        path = 'tests.test_core.SamplerTests.get_tag.<locals>.Sampled'
+        self.assertEqual(list(snapshot), [path])
+        timings = snapshot[path]
+        self.assertEqual(timings['renders'], 2)
+        self.assertEqual(timings['estimated_renders'], 8)
+        self.assertGreater(timings['mean'], 0)
+        self.assertEqual(set(timings['phases']), {'render_tag', 'get_value'})
+        for phase in timings['phases'].values():
+            self.assertEqual(phase['calls'], 2)
+            self.assertGreater(phase['share'], 0)
+            self.assertLessEqual(phase['share'], 1)
+        self.assertIsNone(sys.getprofile())
+        sampler.reset()
+        self.assertEqual(sampler.snapshot(), {})
+
+    def test_existing_profiler(self):
+        tag = self.get_tag()
+        sampler = instrumentation.Sampler(rate=1, profile_rate=1)
+
+        def profile(frame, event, arg):
+            pass
+
+        sys.setprofile(profile)
+        try:
+            with sampler:
+                for _ in range(2):
+                    tag.render(Context({'value': 'x'}))
+            self.assertIs(sys.getprofile(), profile)
+        finally:
+            sys.setprofile(None)
+        timings = list(sampler.snapshot().values())[0]
+        # the samples which would have been profiled are only timed
+        self.assertEqual(timings['renders'], 2)
+        self.assertEqual(timings['phases'], {})
+
+    def test_profile_rate(self):
+        tag = self.get_tag()
+        sampler = instrumentation.Sampler()
+        self.assertEqual(sampler.every, 100)
+        self.assertEqual(sampler.profile_every, 100)
+        unprofiled = instrumentation.Sampler(rate=1, profile_rate=0)
+        with unprofiled:
+            for _ in range(4):
+                tag.render(Context({'value': 'x'}))
+        timings = list(unprofiled.snapshot().values())[0]
+        self.assertEqual(timings['renders'], 4)
+        self.assertEqual(timings['phases'], {})
+
+
+class RecorderTests(TestCase):
+    def setUp(self):
+        for loader in engines['django'].engine.template_loaders:
+            loader.reset()
+
+    def render(self, recorder):
+        class Outer(core.Tag):
+            options = core.Options(blocks=['end_outer'])
+
+            def render_tag(self, context, end_outer):
+                return end_outer.render(context)
+
+        class Branch(helpers.InclusionTag):
+            template = 'tree.html'
+
+        class Leaf(core.Tag):
+            def render_tag(self, context):
+                return 'leaf'
+
+        with TemplateTags(Outer, Branch, Leaf):
+            with recorder:
+                tpl = template.Template('{% outer %}\n{% branch %}{% end_outer %}')
+                self.assertEqual(tpl.render(Context()), '\nleaf')
+
+    def test_collapsed(self):
+        recorder = instrumentation.Recorder()
+        self.render(recorder)
+        lines = recorder.collapsed().splitlines()
+        stacks = [line.rsplit(' ', 1)[0] for line in lines]
+        self.assertEqual(stacks, [
+            'parse outer (<unknown source>:1)',
+            'parse outer (<unknown source>:1);parse branch (<unknown source>:2)',
+            'render outer (<unknown source>:1)',
+            'render outer (<unknown source>:1);render branch (<unknown source>:2)',
+            'render outer (<unknown source>:1);render branch (<unknown source>:2);parse leaf (tree.html:1)',
+            'render outer (<unknown source>:1);render branch (<unknown source>:2);render leaf (tree.html:1)',
+        ])
+        for line in lines:
+            self.assertGreaterEqual(int(line.rsplit(' ', 1)[1]), 0)
+        recorder.reset()
+        self.assertEqual(recorder.collapsed(), '')
+
+    def test_speedscope(self):
+        recorder = instrumentation.Recorder()
+        self.render(recorder)
+        profile = json.loads(json.dumps(recorder.speedscope('page')))
+        self.assertEqual(profile['name'], 'page')
+        frames = profile['shared']['frames']
+        self.assertIn({'name': 'render leaf', 'file': 'tree.html', 'line': 1}, frames)
+        [thread] = profile['profiles']
+        self.assertEqual(thread['type'], 'evented')
+        names = []
+        stack = []
+        last = thread['startValue']
+        for event in thread['events']:
+            self.assertGreaterEqual(event['at'], last)
+            last = event['at']
+            if event['type'] == 'O':
+                stack.append(event['frame'])
+                names.append([frames[frame]['name'] for frame in stack])
+            else:
+                self.assertEqual(stack.pop(), event['frame'])
+        self.assertEqual(stack, [])
+        self.assertEqual(last, thread['endValue'])
+        self.assertIn(['render outer', 'render branch', 'render leaf'], names)
+        self.assertEqual(len(names), 6)
+
+    def test_unclosed_spans(self):
+        recorder = instrumentation.Recorder()
+        recorder.get_events().extend([
+            ('O', recorder.get_frame('render a', None, None), 0.0),
+            ('O', recorder.get_frame('render b', None, None), 1.0),
+            ('C', 1, 2.0),
+        ])
+        self.assertEqual(recorder.collapsed(), 'render a (None:None);render b (None:None) 1000000\n')
+
+    def test_max_spans(self):
+        recorder = instrumentation.Recorder(max_spans=2)
+        self.render(recorder)
+        # the parse of outer fills the thread together with the nested parse
+        # of branch, the renders are dropped
+        self.assertEqual(recorder.collapsed().count('\n'), 2)
+        self.assertEqual(sum(map(len, recorder.threads.values())), 4)
+        self.assertEqual(recorder.dropped, 4)
+        recorder.reset()
+        self.assertEqual(recorder.dropped, 0)
+
+
+class CallSiteTests(TestCase):
+    def setUp(self):
+        for loader in engines['django'].engine.template_loaders:
+            loader.reset()
+
+    def test_call_site(self):
+        class Leaf(core.Tag):
+            def render_tag(self, context):
+                return 'leaf'
+
+        class Site(core.Tag):
+            def render_tag(self, context):
+                return '%s:%s' % self.call_site
+
+        with TemplateTags(Leaf, Site):
+            tag = engines['django'].engine.get_template('tree.html').nodelist[0]
+            self.assertEqual(tag.call_site, ('tree.html', 1))
+            tpl = template.Template('\n\n{% site %}')
+            self.assertEqual(tpl.render(Context()).strip(), '<unknown source>:3')
+        # tags created directly don't know their template
+        tag = Leaf(TemplateParser([]), Token(TokenType.BLOCK, 'leaf', lineno=4))
+        self.assertEqual(tag.call_site, (None, 4))
+
+    def test_call_sites(self):
+        class Slow(core.Tag):
+            options = core.Options(arguments.IntegerArgument('delay'))
+
+            def render_tag(self, context, delay):
+                time.sleep(delay / 100)
+                return ''
+
+        with TemplateTags(Slow):
+            tpl = template.Template('{% slow 0 %}\n{% slow 1 %}{% slow 0 %}')
+        with instrumentation.CallSites() as call_sites:
+            tpl.render(Context())
+            tpl.render(Context())
+        sites = call_sites.snapshot()
+        self.assertEqual(
+            [(site['tag'], site['template'], site['line'], site['renders']) for site in sites],
+            [('slow', '<unknown source>', 2, 4), ('slow', '<unknown source>', 1, 2)],
+        )
+        self.assertGreaterEqual(sites[0]['render_time'], 0.02)
+        self.assertAlmostEqual(sites[0]['mean'], sites[0]['render_time'] / 4)
+        self.assertEqual(len(call_sites.snapshot(limit=1)), 1)
+        call_sites.reset()
+        self.assertEqual(call_sites.snapshot(), [])
+
+
+class QueriesTests(TestCase):
+    def get_template(self):
+        class Outer(core.Tag):
+            options = core.Options(blocks=['end_outer'])
+
+            def render_tag(self, context, end_outer):
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                return end_outer.render(context)
+
+        class Lookup(core.Tag):
+            options = core.Options(arguments.IntegerArgument('count'))
+
+            def render_tag(self, context, count):
+                with connection.cursor() as cursor:
+                    for _ in range(count):
+                        cursor.execute('SELECT %s', [count])
+                return ''
+
+        with TemplateTags(Outer, Lookup):
+            return template.Template(
+                '{% outer %}{% lookup 3 %}\n{% lookup 2 %}{% end_outer %}'
+            )
+
+    def test_counts(self):
+        tpl = self.get_template()
+        queries = instrumentation.Queries(budget=2)
+        with queries:
+            tpl.render(Context())
+            tpl.render(Context())
+        # the wrappers are only installed while rendering
+        self.assertEqual(connection.execute_wrappers, [])
+        snapshot = queries.snapshot()
+        tags = {path.rsplit('.', 1)[1]: counts for path, counts in snapshot['tags'].items()}
+        self.assertEqual(tags['Outer']['queries'], 2)
+        self.assertEqual(tags['Outer']['renders'], 2)
+        self.assertEqual(tags['Lookup']['queries'], 10)
+        self.assertEqual(tags['Lookup']['max_queries'], 3)
+        self.assertEqual(tags['Lookup']['over_budget'], 2)
+        self.assertGreater(tags['Lookup']['query_time'], 0)
+        self.assertEqual(
+            [(site['tag'], site['line'], site['queries']) for site in snapshot['call_sites']],
+            [('lookup', 1, 6), ('lookup', 2, 4), ('outer', 1, 2)],
+        )
+        flagged = queries.flagged()
+        self.assertEqual(len(flagged), 1)
+        self.assertEqual((flagged[0]['tag'], flagged[0]['line']), ('lookup', 1))
+        queries.reset()
+        self.assertEqual(queries.snapshot(), {'tags': {}, 'call_sites': []})
+
+    def test_using(self):
+        tpl = self.get_template()
+        queries = instrumentation.Queries(using=['default'])
+        with queries:
+            tpl.render(Context())
+        self.assertEqual(queries.snapshot()['call_sites'][0]['queries'], 3)
+        queries = instrumentation.Queries(using=[])
+        with queries:
+            tpl.render(Context())
+        self.assertEqual(queries.snapshot()['call_sites'][0]['queries'], 0)
+
+
+class TagBudgetTests(TestCase):
+    def get_template(self):
+        class Outer(core.Tag):
+            options = core.Options(blocks=['end_outer'])
+
+            def render_tag(self, context, end_outer):
+                return end_outer.render(context)
+
+        class Costly(core.Tag):
+            options = core.Options(
+                arguments.IntegerArgument('queries'),
+                arguments.IntegerArgument('size'),
+            )
+
+            def render_tag(self, context, queries, size):
+                with connection.cursor() as cursor:
+                    for _ in range(queries):
+                        cursor.execute('SELECT 1')
+                return str(len(bytearray(size)))
+
+        with TemplateTags(Outer, Costly):
+            return template.Template(
+                '{% outer %}{% costly 2 100000 %}{% costly 0 10 %}{% end_outer %}'
+            )
+
+    def test_within_budget(self):
+        tpl = self.get_template()
+        with testing.TagBudget(renders=2, queries=2, time=10, memory=1000000) as budget:
+            self.assertEqual(tpl.render(Context()), '10000010')
+        self.assertEqual(budget.get_violations(), [])
+        for name, method in instrumentation.originals.items():
+            self.assertIs(core.Tag.__dict__[name], method)
+
+    def test_violations(self):
+        tpl = self.get_template()
+        with self.assertRaises(AssertionError) as raised:
+            with testing.TagBudget(renders=1, queries=1, time=0, memory=50000):
+                tpl.render(Context())
+        lines = str(raised.exception).splitlines()
+        self.assertEqual(lines[0], 'Tag budget exceeded:')
+        self.assertEqual([line.split(' ')[:2] for line in lines[1:]], [
+            ['costly', 'was'], ['costly', 'took'], ['costly', 'allocated'],
+            # the allocations of nested tags count for the outer tag too
+            ['outer', 'took'], ['outer', 'allocated'], ['costly', 'ran'],
+        ])
+        self.assertEqual(lines[1], 'costly was rendered 2 times, the limit is 1')
+        self.assertEqual(lines[6], 'costly ran 2 queries in a render, the limit is 1')
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_tags(self):
+        tpl = self.get_template()
+        with testing.TagBudget(tags=['outer'], renders=1, queries=0, memory=10) as budget:
+            tpl.render(Context())
+            self.assertEqual(list(budget.usage), ['outer'])
+            self.assertGreaterEqual(budget.usage['outer'].memory, 100000)
+            self.assertEqual(budget.get_violations(), [
+                'outer allocated %d bytes in a render, the limit is 10' % budget.usage['outer'].memory,
+            ])
+            budget.usage.clear()
+
+    def test_exception_not_checked(self):
+        with self.assertRaises(KeyError):
+            with testing.TagBudget(renders=0) as budget:
+                budget.usage['tag'] = testing.TagUsage()
+                budget.usage['tag'].renders = 1
+                raise KeyError('tag')
+
+    @skipUnless(importlib.util.find_spec('pytest'), 'pytest is not installed')
+    def test_pytest_plugin(self):
+        source = (
+            'import pytest\n'
+            'from django.conf import settings\n'
+            'from tests.settings import DATABASES, TEMPLATES\n'
+            'settings.configure(DATABASES=DATABASES, TEMPLATES=TEMPLATES)\n'
+            'import django\n'
+            'django.setup()\n'
+            'from django import template\n'
+            'from classytags import core\n'
+            'from tests.context_managers import TemplateTags\n'
+            'class Hello(core.Tag):\n'
+            '    def render_tag(self, context):\n'
+            '        return "hello"\n'
+            'with TemplateTags(Hello):\n'
+            '    tpl = template.Template("{% hello %}{% hello %}")\n'
+            '@pytest.mark.tag_budget(renders=2)\n'
+            'def test_marker_passes():\n'
+            '    tpl.render(template.Context())\n'
+            '@pytest.mark.tag_budget(tags=["hello"], renders=1)\n'
+            'def test_marker_fails():\n'
+            '    tpl.render(template.Context())\n'
+            'def test_fixture(tag_budget):\n'
+            '    with pytest.raises(AssertionError):\n'
+            '        with tag_budget(renders=1):\n'
+            '            tpl.render(template.Context())\n'
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test_budget.py')
+            with open(path, 'w') as fobj:
+                fobj.write(source)
+            result = subprocess.run(
+                [sys.executable, '-m', 'pytest', '-q', '-p', 'classytags.pytest_plugin', path],
+                capture_output=True, text=True, cwd=directory,
+                env=dict(os.environ, PYTHONPATH=os.path.dirname(CLASSY_TAGS_DIR)),
+            )
+        self.assertIn('1 failed, 2 passed', result.stdout)
+        self.assertIn('hello was rendered 2 times, the limit is 1', result.stdout)
+
+
+class ConstantFoldingTests(TestCase):
+    def setUp(self):
+        diagnostics.collector.reset()
+
+    def _parse(self, options, contents):
+        class Folded(core.Tag):
+            pass
+        Folded.options = options
+        parser = TemplateParser([], builtins=builtins)
+        return Folded(parser, Token(TokenType.BLOCK, 'folded %s' % contents))
+
+    def test_literals_folded(self):
+        options = core.Options(
+            arguments.Argument('string'),
+            arguments.IntegerArgument('integer'),
+            arguments.Argument('name', resolve=False),
+            arguments.MultiValueArgument('multi', required=False),
+        )
+        tag = self._parse(options, '"hello" 5 myname "a" 1')
+        for key in ('string', 'integer', 'name'):
+            self.assertIsInstance(tag.kwargs[key], values.ConstantValue)
+        for item in tag.kwargs['multi']:
+            self.assertIsInstance(item, values.ConstantValue)
+        context = Context()
+        self.assertEqual(tag.kwargs['string'].resolve(context), 'hello')
+        self.assertEqual(tag.kwargs['integer'].resolve(context), 5)
+        self.assertEqual(tag.kwargs['name'].resolve(context), 'myname')
+        self.assertEqual(tag.kwargs['multi'].resolve(context), ['a', 1])
+        self.assertEqual(tag.kwargs['string'].literal, '"hello"')
+
+    def test_dynamic_not_folded(self):
+        options = core.Options(
+            arguments.Argument('variable'),
+            arguments.Argument('filtered'),
+            arguments.KeywordArgument('keyword'),
+        )
+        tag = self._parse(options, 'var "x"|upper key=var')
+        self.assertNotIsInstance(tag.kwargs['variable'], values.ConstantValue)
+        self.assertNotIsInstance(tag.kwargs['filtered'], values.ConstantValue)
+        self.assertNotIsInstance(
+            tag.kwargs['keyword']['key'], values.ConstantValue
+        )
+        context = Context({'var': 'value'})
+        self.assertEqual(tag.kwargs['variable'].resolve(context), 'value')
+        self.assertEqual(tag.kwargs['filtered'].resolve(context), 'X')
+
+    def test_custom_resolve_not_folded(self):
+        class ContextValue(values.StringValue):
+            def resolve(self, context):
+                return context['prefix'] + super().resolve(context)
+
+        class ContextArgument(arguments.Argument):
+            value_class = ContextValue
+
+        tag = self._parse(core.Options(ContextArgument('value')), '"x"')
+        context = Context({'prefix': '>'})
+        self.assertEqual(tag.kwargs['value'].resolve(context), '>x')
+
+    def test_custom_clean_not_folded(self):
+        calls = []
+
+        class LookupValue(values.StringValue):
+            def clean(self, value):
+                calls.append(value)
+                return '%s:%s' % (value, len(calls))
+
+        class FoldedValue(LookupValue):
+            foldable = True
+
+        class LookupArgument(arguments.Argument):
+            value_class = LookupValue
+
+        class FoldedArgument(arguments.Argument):
+            value_class = FoldedValue
+
+        class LookupChoiceArgument(arguments.ChoiceArgument):
+            value_class = LookupValue
+
+        options = core.Options(
+            LookupArgument('lookup'),
+            FoldedArgument('folded'),
+            LookupChoiceArgument('choice', ['a:1', 'a:2', 'a:3']),
+        )
+        tag = self._parse(options, '"a" "b" "a"')
+        self.assertNotIsInstance(tag.kwargs['lookup'], values.ConstantValue)
+        self.assertIsInstance(tag.kwargs['folded'], values.ConstantValue)
+        self.assertNotIsInstance(tag.kwargs['choice'], values.ConstantValue)
+        self.assertEqual(calls, ['b'])
+        self.assertEqual(tag.kwargs['lookup'].resolve(Context()), 'a:2')
+        self.assertEqual(tag.kwargs['lookup'].resolve(Context()), 'a:3')
+        self.assertEqual(tag.kwargs['folded'].resolve(Context()), 'b:1')
+
+    def test_literal_errors_when_parsing(self):
+        class IntegerTag(core.Tag):
+            options = core.Options(
+                arguments.IntegerArgument('integer'),
+            )
+
+            def render_tag(self, context, integer):
+                return integer
+
+        with TemplateTags(IntegerTag):
+            with SettingsOverride(DEBUG=True):
+                self.assertRaises(template.TemplateSyntaxError,
+                                  template.Template, '{% integer_tag "x" %}')
+            with SettingsOverride(DEBUG=False):
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter('always')
+                    tpl = template.Template('{% integer_tag "x" %}')
+                    self.assertEqual(len(caught), 1)
+                    self.assertEqual(tpl.render(Context()), '0')
+                    self.assertEqual(tpl.render(Context()), '0')
+                    self.assertEqual(len(caught), 1)
+
+
+class PureTagTests(TestCase):
+    def test_make_hashable(self):
+        self.assertEqual(utils.make_hashable(1), (int, 1))
+        self.assertNotEqual(utils.make_hashable(1), utils.make_hashable(True))
+        self.assertEqual(
+            utils.make_hashable({'a': [1, {2}]}),
+            (dict, ((
+                (str, 'a'),
+                (list, ((int, 1), (set, frozenset([(int, 2)])))),
+            ),)),
+        )
+        self.assertRaises(TypeError, utils.make_hashable, [bytearray()])
+
+    def test_pure_tag(self):
+        calls = []
+
+        class Pure(core.Tag):
+            pure = True
+            cache_size = 2
+            options = core.Options(
+                arguments.Argument('value'),
+                arguments.MultiValueArgument('extra', required=False),
+            )
+
+            def render_tag(self, context, value, extra):
+                calls.append(value)
+                return '%s%s' % (value, len(extra))
+
+        with TemplateTags(Pure):
+            tpl = template.Template(
+                '{% for v in values %}{% pure v %}{% endfor %}'
+            )
+            multi = template.Template('{% pure "x" 1 2 %}{% pure "x" 1 2 %}')
+        output = tpl.render(Context({'values': ['a', 'a', 'b', 'c', 'a']}))
+        self.assertEqual(output, 'a0a0b0c0a0')
+        self.assertIsNone(core.Tag.render_cache)
+        # 'a' was evicted by 'c' before being rendered again
+        self.assertEqual(Pure.render_cache.info(),
+                         utils.CacheInfo(1, 4, 2, 2, 2))
+        self.assertEqual(calls, ['a', 'b', 'c', 'a'])
+        # values of multi value arguments are hashed as well
+        self.assertEqual(multi.render(Context()), 'x2x2')
+        self.assertEqual(calls[-1:], ['x'])
+        self.assertEqual(Pure.render_cache.info().hits, 2)
+
+    def test_pure_tag_unhashable(self):
+        class Unhashable:
+            __hash__ = None
+
+        class Pure(core.Tag):
+            pure = True
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+
+            def render_tag(self, context, value):
+                return 'rendered'
+
+        with TemplateTags(Pure):
+            tpl = template.Template('{% pure value %}{% pure value %}')
+        self.assertEqual(
+            tpl.render(Context({'value': Unhashable()})), 'renderedrendered'
+        )
+        self.assertEqual(len(Pure.render_cache), 0)
+
+    def test_pure_block_tag_not_cached(self):
+        class PureBlock(core.Tag):
+            pure = True
+            options = core.Options(
+                blocks=['end_pure_block'],
+            )
+
+            def render_tag(self, context, end_pure_block):
+                return end_pure_block.render(context)
+
+        self.assertIsNone(PureBlock.render_cache)
+
+        class Impure(PureBlock):
+            pure = False
+            options = core.Options()
+
+        self.assertIsNone(Impure.render_cache)
+
+    def test_pure_astag(self):
+        calls = []
+
+        class PureAs(helpers.AsTag):
+            pure = True
+            options = core.Options(
+                arguments.Argument('value'),
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+
+            def get_value(self, context, value):
+                calls.append(value)
+                return value.upper()
+
+        with TemplateTags(PureAs):
+            tpl = template.Template(
+                '{% pure_as "a" %}{% pure_as "a" as x %}{{ x }}'
+                '{% pure_as "a" as y %}{{ y }}{% pure_as "a" %}'
+            )
+        self.assertEqual(tpl.render(Context()), 'AAAA')
+        self.assertEqual(calls, ['a', 'a'])
+        self.assertEqual(PureAs.render_cache.info().hits, 2)
+
+
+class CopyFreeInclusionTagTests(TestCase):
+    def test_context_pollution(self):
+        class NoPushPop(helpers.InclusionTag):
+            template = 'inclusion.html'
+            copy_context = False
+
+            def get_context(self, context):
+                return context.update({'pollution': True})
+
+        class Standard(helpers.InclusionTag):
+            template = 'inclusion.html'
+            copy_context = False
+
+            def get_context(self, context):
+                return {'pollution': True}
+
+        with TemplateTags(NoPushPop, Standard):
+            ctx1 = template.Context({'pollution': False})
+            template.Template("{% no_push_pop %}").render(ctx1)
+            self.assertEqual(ctx1['pollution'], True)
+            ctx2 = template.Context({'pollution': False})
+            template.Template("{% standard %}").render(ctx2)
+            self.assertEqual(ctx2['pollution'], False)
+            self.assertEqual(len(ctx2.dicts), 2)
+
+    def test_push_context(self):
+        class IncPollute(helpers.InclusionTag):
+            template = 'test.html'
+            copy_context = False
+            push_context = True
+
+            options = core.Options(
+                arguments.Argument('var')
+            )
+
+            def get_context(self, context, var):
+                context.update({'var': 'polluted'})
+                return context
+
+        class Inc(IncPollute):
+            def get_context(self, context, var):
+                return {'var': var.upper()}
+
+        with TemplateTags(IncPollute, Inc):
+            tpl = template.Template('{% inc_pollute var %}|{% inc var %}|{{ var }}')
+            ctx = template.Context({'var': 'test'})
+            self.assertEqual(tpl.render(ctx), 'polluted|TEST|test')
+            self.assertEqual(ctx['var'], 'test')
+            self.assertEqual(len(ctx.dicts), 2)
+
+    def test_isolation(self):
+        data = {'var': 'data'}
+
+        class Inc(helpers.InclusionTag):
+            template = 'test.html'
+            copy_context = False
+
+            def get_context(self, context):
+                return data
+
+        with TemplateTags(Inc):
+            tpl = template.Template('{% inc %}')
+            ctx = template.Context({'var': 'parent', 'other': True})
+            self.assertEqual(tpl.render(ctx), 'data')
+            Inc.push_context = True
+            self.assertEqual(tpl.render(ctx), 'data')
+        self.assertEqual(data, {'var': 'data'})
+        self.assertEqual(ctx.flatten()['var'], 'parent')
+
+
+class AsyncRenderTests(TestCase):
+    def render(self, source, context=None, *tags):
+        with TemplateTags(*tags):
+            tpl = template.Template(source)
+        return asyncio.run(
+            core.arender_nodelist(tpl.nodelist, template.Context(context))
+        )
+
+    def test_arender_tag(self):
+        class Sleepy(core.Tag):
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+
+            async def arender_tag(self, context, value):
+                await asyncio.sleep(0)
+                return value.upper()
+
+        class Sync(core.Tag):
+            def render_tag(self, context):
+                return 'sync'
+
+        output = self.render(
+            '{% sleepy value %}|{% sync %}|{{ value }}', {'value': 'a'},
+            Sleepy, Sync,
+        )
+        self.assertEqual(output, 'A|sync|a')
+        self.assertIsInstance(output, SafeString)
+
+    def test_pure_tag(self):
+        calls = []
+
+        class Pure(core.Tag):
+            pure = True
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+
+            async def arender_tag(self, context, value):
+                calls.append(value)
+                return value
+
+        output = self.render('{% pure "a" %}{% pure "a" %}{% pure "b" %}', {}, Pure)
+        self.assertEqual(output, 'aab')
+        self.assertEqual(calls, ['a', 'b'])
+
+    def test_as_tag(self):
+        class Value(helpers.AsTag):
+            options = core.Options(
+                arguments.Argument('value'),
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+
+            async def aget_value(self, context, value):
+                await asyncio.sleep(0)
+                return value * 2
+
+        class SyncValue(Value):
+            def get_value(self, context, value):
+                return value * 3
+
+            aget_value = helpers.AsTag.aget_value
+
+        class Suppressed(Value):
+            def get_value_for_context(self, context, value):
+                return 'suppressed'
+
+        output = self.render(
+            '{% value "a" %}|{% value "b" as b %}{{ b }}|'
+            '{% sync_value "c" %}|{% sync_value "d" as d %}{{ d }}|'
+            '{% suppressed "e" %}|{% suppressed "f" as f %}{{ f }}',
+            {}, Value, SyncValue, Suppressed,
+        )
+        self.assertEqual(output, 'aa|bb|ccc|ddd|ee|suppressed')
+
+    def test_inclusion_tag(self):
+        class Inc(helpers.InclusionTag):
+            template = 'test.html'
+            options = core.Options(
+                arguments.Argument('var'),
+            )
+
+            async def aget_context(self, context, var):
+                await asyncio.sleep(0)
+                return {'var': var.upper()}
+
+        class SyncInc(Inc):
+            aget_context = helpers.InclusionTag.aget_context
+
+            def get_context(self, context, var):
+                return {'var': var * 2}
+
+        source = '{% inc var %}|{% sync_inc var %}|{{ var }}'
+        for copy_context in (True, False):
+            for push_context in (True, False):
+                Inc.copy_context = copy_context
+                Inc.push_context = push_context
+                context = {'var': 'a'}
+                output = self.render(source, context, Inc, SyncInc)
+                self.assertEqual(output, 'A|aa|a')
+
+    def test_inclusion_tag_fragment_cache(self):
+        calls = []
+
+        class Inc(helpers.InclusionTag):
+            template = 'test.html'
+            cache_timeout = 60
+
+            async def aget_context(self, context):
+                calls.append(True)
+                return {'var': 'a'}
+
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        self.assertEqual(self.render('{% inc %}{% inc %}', {}, Inc), 'aa')
+        self.assertEqual(len(calls), 1)
+
+    def test_arender_to_string(self):
+        class Sleepy(core.Tag):
+            async def arender_tag(self, context):
+                return 'async'
+
+        with TemplateTags(Sleepy):
+            output = asyncio.run(helpers.arender_to_string(
+                ['missing.html', 'async.html'], {'var': 'var'}
+            ))
+        self.assertEqual(output, 'async:var')
+
+    def test_nested_tags(self):
+        class Sleepy(core.Tag):
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+
+            async def arender_tag(self, context, value):
+                await asyncio.sleep(0)
+                return value.upper()
+
+        class Value(helpers.AsTag):
+            options = core.Options(
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+
+            async def aget_value(self, context):
+                return 'value'
+
+        class Inc(helpers.InclusionTag):
+            template = 'test.html'
+
+            async def aget_context(self, context):
+                return {'var': 'inc'}
+
+        class Wrap(core.Tag):
+            options = core.Options(
+                blocks=['end_wrap'],
+            )
+
+            def render_tag(self, context, end_wrap):
+                return '[%s]' % end_wrap.render(context)
+
+        source = (
+            '{% if True %}{% sleepy "a" %}{% endif %}|'
+            '{% for value in values %}{% sleepy value %}{% endfor %}|'
+            '{% wrap %}{% sleepy "d" %}{% value %}{% inc %}{% end_wrap %}|'
+            '{% filter upper %}{% value as var %}{{ var }}{% endfilter %}'
+        )
+        tags = (Sleepy, Value, Inc, Wrap)
+        context = {'values': ['b', 'c'], 'var': 'var'}
+        expected = 'A|BC|[Dvalueinc]|VALUE'
+        with TemplateTags(*tags):
+            self.assertEqual(self.render(source, context), expected)
+            # tags which only render asynchronously also render synchronously
+            tpl = template.Template(source)
+            self.assertEqual(tpl.render(Context(context)), expected)
+
+    def test_extends(self):
+        class Sleepy(core.Tag):
+            async def arender_tag(self, context):
+                await asyncio.sleep(0)
+                return 'async'
+
+        for loader in engines['django'].engine.template_loaders:
+            loader.reset()
+        with TemplateTags(Sleepy):
+            output = asyncio.run(helpers.arender_to_string(
+                'async_child.html', {'var': 'var'}
+            ))
+        self.assertEqual(output, 'async:var|async')
+
+        class Wrapper(helpers.InclusionTag):
+            template = 'async.html'
+
+            def get_context(self, context):
+                return {'var': 'inc'}
+
+        with TemplateTags(Sleepy, Wrapper):
+            tpl = template.Template('{% wrapper %}')
+            output = asyncio.run(core.arender_nodelist(tpl.nodelist, Context()))
+        self.assertEqual(output, 'async:inc')
+
+    def test_sync_code_queries(self):
+        def query():
+            # raises SynchronousOnlyOperation in the event loop
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                return str(cursor.fetchone()[0])
+
+        class Lazy:
+            @property
+            def related(self):
+                return query()
+
+        class Query(core.Tag):
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+
+            def render_tag(self, context, value):
+                return query() + value
+
+        class Value(helpers.AsTag):
+            options = core.Options(
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+
+            def get_value(self, context):
+                return query()
+
+        class Inc(helpers.InclusionTag):
+            template = 'test.html'
+
+            def get_context(self, context):
+                return {'var': query()}
+
+        source = (
+            '{% query "a" %}|{% query obj.related %}|{{ obj.related }}|'
+            '{% value %}|{% value as var %}{{ var }}|{% inc %}'
+        )
+        output = self.render(
+            source, {'obj': Lazy()}, Query, Value, Inc,
+        )
+        self.assertEqual(output, '1a|11|1|1|1|1')
+
+
+class PrefetchTests(TestCase):
+    def setUp(self):
+        # prefetch.html is compiled with the tags of each test
+        for loader in engines['django'].engine.template_loaders:
+            loader.reset()
+
+    def get_tags(self, barrier=None):
+        calls = []
+
+        class Slow(core.Tag):
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+
+            def prefetch(self, context, value):
+                calls.append(value)
+                if barrier is not None and value in 'abcd':
+                    barrier.wait()
+                return value.upper()
+
+            def render_tag(self, context, value):
+                return self.get_prefetched(context, value=value)
+
+        class Value(helpers.AsTag):
+            options = core.Options(
+                arguments.Argument('value'),
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+            prefetch = Slow.prefetch
+
+            def get_value(self, context, value):
+                return self.get_prefetched(context, value=value)
+
+        return calls, Slow, Value
+
+    def test_prefetch(self):
+        barrier = threading.Barrier(4, timeout=5)
+        calls, Slow, Value = self.get_tags(barrier)
+        context = {'show': True, 'items': ['x', 'y']}
+        with TemplateTags(Slow, Value):
+            output = prefetch.render_to_string('prefetch.html', context)
+        self.assertEqual(output, 'ABCDXY')
+        self.assertEqual(sorted(calls[:4]), ['a', 'b', 'c', 'd'])
+        self.assertEqual(calls[4:], ['x', 'y'])
+        self.assertIsNone(core.prefetched.get())
+
+    def test_without_prefetch(self):
+        calls, Slow, Value = self.get_tags()
+        context = {'show': False, 'items': ['x']}
+        with TemplateTags(Slow, Value):
+            output = render_to_string('prefetch.html', context)
+        self.assertEqual(output, 'ABDX')
+        self.assertEqual(calls, ['a', 'b', 'd', 'x'])
+
+    def test_failed_prefetch(self):
+        calls = []
+
+        class Flaky(core.Tag):
+            def prefetch(self, context):
+                calls.append(True)
+                if len(calls) == 1:
+                    raise ValueError
+                return 'flaky'
+
+            def render_tag(self, context):
+                return self.get_prefetched(context)
+
+        class Broken(Flaky):
+            def get_prefetch_kwargs(self, context):
+                raise ValueError
+
+        with TemplateTags(Flaky, Broken):
+            tpl = template.Template('{% flaky %}{% broken %}')
+        context = template.Context()
+        self.assertEqual(prefetch.prefetch_nodelist(tpl.nodelist, context), {})
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(tpl.render(context), 'flakyflaky')
+
+    def test_unbound_variables(self):
+        calls, Slow, Value = self.get_tags()
+        source = (
+            '{% slow var %}{% slow var|default:missing %}'
+            '{% with var="w" %}{% slow var %}{% endwith %}'
+            '{% if obj %}{% slow obj.name %}{% endif %}'
+            '{% value "d" as d %}{% slow d %}{% slow d.x|upper %}'
+        )
+        with TemplateTags(Slow, Value):
+            tpl = template.Template(source)
+        context = template.Context({'var': 'v'})
+        results = prefetch.prefetch_nodelist(tpl.nodelist, context)
+        self.assertEqual(sorted(calls), ['d', 'v'])
+        self.assertEqual(
+            sorted(kwargs['value'] for kwargs, value in results.values()),
+            ['d', 'v'],
+        )
+
+    def test_executor(self):
+        calls, Slow, Value = self.get_tags()
+        with TemplateTags(Slow, Value):
+            tpl = template.Template('{% slow "a" %}{% value "b" as b %}')
+        context = template.Context()
+        with ThreadPoolExecutor(1) as executor:
+            results = prefetch.prefetch_nodelist(tpl.nodelist, context, executor)
+        self.assertEqual(
+            {node.name: value for node, value in results.items()},
+            {'slow': ({'value': 'a'}, 'A'), 'value': ({'value': 'b'}, 'B')},
+        )
+
+    def test_aprefetch(self):
+        calls = []
+        started = []
+
+        class Slow(core.Tag):
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+
+            async def aprefetch(self, context, value):
+                calls.append(value)
+                started.append(value)
+                while len(started) < 3:
+                    await asyncio.sleep(0)
+                return value.upper()
+
+            async def arender_tag(self, context, value):
+                return await self.aget_prefetched(context, value=value)
+
+            def render_tag(self, context, value):
+                # nested in {% if %}, rendered synchronously
+                return self.get_prefetched(context, value=value)
+
+        class Value(helpers.AsTag):
+            options = core.Options(
+                arguments.Argument('value'),
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+
+            def prefetch(self, context, value):
+                calls.append(value)
+                return value.upper()
+
+            async def aget_value(self, context, value):
+                return await self.aget_prefetched(context, value=value)
+
+        context = {'show': True, 'items': []}
+        with TemplateTags(Slow, Value):
+            output = asyncio.run(asyncio.wait_for(
+                prefetch.arender_to_string('prefetch.html', context), 5
+            ))
+        self.assertEqual(output, 'ABCD')
+        self.assertEqual(sorted(calls), ['a', 'b', 'c', 'd'])
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        # batch.html is compiled with the tags of each test
+        for loader in engines['django'].engine.template_loaders:
+            loader.reset()
+
+    def get_tags(self):
+        backend = {1: 'one', 2: 'two', 3: 'three', 4: 'four'}
+        calls = []
+
+        class Avatar(core.Tag):
+            options = core.Options(
+                arguments.Argument('key'),
+            )
+
+            def batch_load(self, keys):
+                calls.append(keys)
+                return {key: backend[key] for key in keys if key in backend}
+
+            def render_tag(self, context, key):
+                return '<%s>' % self.load(context, key)
+
+        class Card(Avatar):
+            options = core.Options(
+                arguments.Argument('key'),
+                blocks=['end_card'],
+            )
+
+            def render_tag(self, context, key, end_card):
+                value = self.load(context, key)
+                return '[%s:%s]' % (value, end_card.render(context))
+
+        class AvatarAs(helpers.AsTag):
+            options = core.Options(
+                arguments.Argument('key'),
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+            batch_load = Avatar.batch_load
+
+            def get_value(self, context, key):
+                return self.load(context, key)
+
+        return calls, [Avatar, Card, AvatarAs]
+
+    def test_batching(self):
+        calls, tags = self.get_tags()
+        with TemplateTags(*tags):
+            output = batching.render_to_string(
+                'batch.html', {'users': [1, 2, 1, 3, 5]}
+            )
+        self.assertEqual(
+            output,
+            '<one>[one:1],<two>[two:2],<one>[one:1],<three>[three:3],'
+            '<None>[None:5],four'
+        )
+        self.assertIsInstance(output, SafeString)
+        # AvatarAs sets its varname once the keys are loaded
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(calls[0]), [1, 2, 3, 4, 5])
+
+    def test_without_batching(self):
+        calls, tags = self.get_tags()
+        with TemplateTags(*tags):
+            output = render_to_string('batch.html', {'users': [1, 2, 1]})
+        self.assertEqual(output, '<one>[one:1],<two>[two:2],<one>[one:1],four')
+        # memoized for the render, but not batched
+        self.assertEqual(calls, [[1], [2], [4]])
+        tag = tags[0](dummy_parser, DummyTokens('key'))
+        self.assertEqual(tag.load({}, 3), 'three')
+        self.assertEqual(calls[-1], [3])
+
+    def test_dependent_loads(self):
+        calls = []
+
+        class Chain(core.Tag):
+            options = core.Options(
+                arguments.Argument('key'),
+            )
+
+            def batch_load(self, keys):
+                calls.append(keys)
+                return [key - 1 for key in keys]
+
+            def render_tag(self, context, key):
+                while key:
+                    key = self.load(context, key)
+                return 'done'
+
+        with TemplateTags(Chain):
+            tpl = template.Template('{% chain 2 %}{% chain 3 %}')
+        context = template.Context()
+        batch = utils.Batch(defer=True)
+        context.render_context.dicts[0][utils.Batch] = batch
+        with context.bind_template(tpl):
+            output = batch.render(partial(tpl.nodelist.render, context))
+        self.assertEqual(output, 'donedone')
+        self.assertEqual(calls, [[2, 3], [1]])
+
+    def test_loop_variables(self):
+        calls, tags = self.get_tags()
+
+        class Numbered(tags[0]):
+            options = core.Options(
+                arguments.Argument('key'),
+                arguments.Argument('number'),
+            )
+
+            def render_tag(self, context, key, number):
+                return '%s:%s ' % (self.load(context, key), number)
+
+        context = {'users': [1, 2, 3]}
+        expected = 'one:1 two:2 three:3 |<ONE><TWO><THREE>\n'
+        with TemplateTags(Numbered, *tags):
+            self.assertEqual(render_to_string('batch_loop.html', context), expected)
+            del calls[:]
+            output = batching.render_to_string('batch_loop.html', context)
+        self.assertEqual(output, expected)
+        self.assertEqual(calls, [[1, 2, 3]])
+
+    def test_as_varname_in_loop(self):
+        calls, tags = self.get_tags()
+        context = {'users': [1, 2, 3]}
+        # the value loaded for 4 is itself a key, loaded by a third render
+        expected = 'one,two,three,<None>\n'
+        with TemplateTags(*tags):
+            self.assertEqual(render_to_string('batch_as.html', context), expected)
+            self.assertEqual(calls, [[1], [2], [3], [4], ['four']])
+            del calls[:]
+            output = batching.render_to_string('batch_as.html', context)
+        self.assertEqual(output, expected)
+        self.assertEqual(calls, [[1, 2, 3, 4], ['four']])
+
+    def test_batch_load_length(self):
+        class Broken(core.Tag):
+            def batch_load(self, keys):
+                return []
+
+        tag = Broken(dummy_parser, DummyTokens())
+        self.assertRaises(ValueError, tag.load, {}, 1)
+        self.assertRaises(
+            NotImplementedError, core.Tag.batch_load, tag, [1]
+        )
+
+
+class TemplateCacheTests(TestCase):
+    def test_static_template(self):
+        class Inc(helpers.InclusionTag):
+            template = 'test.html'
+
+            def get_context(self, context):
+                return {'var': 'a'}
+
+        self.assertIsNot(Inc.template_cache, helpers.InclusionTag.template_cache)
+        with TemplateTags(Inc):
+            tpl = template.Template('{% inc %}{% inc %}')
+        self.assertEqual(tpl.render(Context()), 'aa')
+        self.assertEqual(tpl.render(Context()), 'aa')
+        self.assertEqual(Inc.template_cache.info(), utils.CacheInfo(3, 1, 0, 16, 1))
+
+    def test_dynamic_template(self):
+        class Inc(helpers.InclusionTag):
+            template_cache_size = 1
+
+            options = core.Options(
+                arguments.Argument('name'),
+            )
+
+            def get_template(self, context, name):
+                return name
+
+        with TemplateTags(Inc):
+            tpl = template.Template('{% inc name %}')
+        for name in ['test.html', 'test.html', 'inclusion.html']:
+            tpl.render(Context({'name': name}))
+        self.assertEqual(Inc.template_cache.info(), utils.CacheInfo(1, 2, 1, 1, 1))
+        tpl.render(Context({'name': ['missing.html', 'test.html']}))
+        self.assertIn(('missing.html', 'test.html'), Inc.template_cache.data)
+
+    def test_clear_template_caches(self):
+        class Inc(helpers.InclusionTag):
+            template = 'test.html'
+
+        class SubInc(Inc):
+            pass
+
+        with TemplateTags(Inc, SubInc):
+            tpl = template.Template('{% inc %}{% sub_inc %}')
+        tpl.render(Context())
+        self.assertEqual(len(Inc.template_cache), 1)
+        self.assertEqual(len(SubInc.template_cache), 1)
+        helpers.file_changed.send(sender=None, file_path=Path('test.py'))
+        self.assertEqual(len(Inc.template_cache), 0)
+        self.assertEqual(len(SubInc.template_cache), 0)
+
+    def test_templates_setting_changed(self):
+        class Inc(helpers.InclusionTag):
+            template = 'inc.html'
+
+        with TemplateTags(Inc):
+            tpl = template.Template('{% inc %}')
+        with tempfile.TemporaryDirectory() as first, tempfile.TemporaryDirectory() as second:
+            for directory, content in [(first, 'A'), (second, 'B')]:
+                Path(directory, 'inc.html').write_text(content)
+            for directory, content in [(first, 'A'), (second, 'B')]:
+                templates = [{
+                    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                    'DIRS': [directory],
+                }]
+                with override_settings(TEMPLATES=templates):
+                    self.assertEqual(render_to_string('inc.html'), content)
+                    self.assertEqual(tpl.render(Context()), content)
+
+
+class OtherBackendTests(TestCase):
+    def test_inclusion_tag(self):
+        class Inc(helpers.InclusionTag):
+            template = 'inc.html'
+
+            def get_context(self, context):
+                return {'var': 'data'}
+
+        with TemplateTags(Inc):
+            tpl = template.Template('{% inc %}')
+        with tempfile.TemporaryDirectory() as directory:
+            Path(directory, 'inc.html').write_text('$var|$outer')
+            templates = [{
+                'BACKEND': 'django.template.backends.dummy.TemplateStrings',
+                'DIRS': [directory],
+            }]
+            with override_settings(TEMPLATES=templates):
+                for copy_context in (True, False):
+                    for push_context, expected in ((True, 'data|o'), (False, 'data|$outer')):
+                        Inc.copy_context = copy_context
+                        Inc.push_context = push_context
+                        context = Context({'outer': 'o', 'var': 'v'})
+                        self.assertEqual(tpl.render(context), expected)
+                        self.assertEqual(context['var'], 'v')
+
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        helpers.template_versions.clear()
+
+    def tearDown(self):
+        caches['default'].clear()
+
+    def test_fragment_cache(self):
+        calls = []
+
+        class Cached(helpers.InclusionTag):
+            template = 'test.html'
+            cache_timeout = 60
+            options = core.Options(
+                arguments.Argument('var'),
+            )
+
+            def get_context(self, context, var):
+                calls.append(var)
+                return {'var': var}
+
+        with TemplateTags(Cached):
+            tpl = template.Template('{% cached var %}|{% cached "b" %}')
+        self.assertEqual(tpl.render(Context({'var': 'a'})), 'a|b')
+        self.assertEqual(tpl.render(Context({'var': 'a'})), 'a|b')
+        self.assertEqual(calls, ['a', 'b'])
+        self.assertEqual(tpl.render(Context({'var': 'c'})), 'c|b')
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        # bumping the version invalidates all fragments
+        Cached.cache_version = 2
+        self.assertEqual(tpl.render(Context({'var': 'a'})), 'a|b')
+        self.assertEqual(calls, ['a', 'b', 'c', 'a', 'b'])
+
+    def test_fragment_cache_key(self):
+        class Cached(helpers.InclusionTag):
+            template = 'test.html'
+            cache_timeout = 60
+            options = core.Options(
+                arguments.Argument('var'),
+            )
+
+        tag = Cached(dummy_parser, DummyTokens('x'))
+        key = tag.get_cache_key(Context(), var='x')
+        self.assertTrue(key.startswith('template.cache.classytags.cached.'))
+        self.assertEqual(key, tag.get_cache_key(Context(), var='x'))
+        self.assertNotEqual(key, tag.get_cache_key(Context(), var='y'))
+        # the key changes with the template source
+        tag.template = 'inclusion.html'
+        self.assertNotEqual(key, tag.get_cache_key(Context(), var='x'))
+        tag.template = ['missing.html', 'test.html']
+        self.assertEqual(key, tag.get_cache_key(Context(), var='x'))
+
+    def test_fragment_cache_blocks(self):
+        class Cached(helpers.InclusionTag):
+            template = 'test.html'
+            cache_timeout = 60
+            options = core.Options(
+                blocks=['end_cached'],
+            )
+
+            def get_context(self, context, end_cached):
+                return {'var': end_cached.render(context)}
+
+        prefix = 'x' * 30
+        with TemplateTags(Cached):
+            tpl = template.Template(
+                '{%% cached %%}%sa{%% end_cached %%}|{%% cached %%}%sb{%% end_cached %%}|'
+                '{%% cached %%}{%% if var %%}{{ var }}{%% endif %%}{%% end_cached %%}' % (prefix, prefix)
+            )
+            other = template.Template(
+                '{% cached %}{% if var %}{{ var|upper }}{% endif %}{% end_cached %}'
+            )
+        self.assertEqual(
+            tpl.render(Context({'var': 'v'})), '%sa|%sb|v' % (prefix, prefix)
+        )
+        # a block on the same line of another template with other contents
+        self.assertEqual(other.render(Context({'var': 'v'})), 'V')
+        self.assertEqual(
+            helpers.get_nodelist_version(tpl.nodelist[2].end_cached),
+            helpers.get_nodelist_version(tpl.nodelist[2].end_cached),
+        )
+
+    def test_fragment_cache_disabled(self):
+        calls = []
+
+        class Uncached(helpers.InclusionTag):
+            template = 'test.html'
+
+            def get_context(self, context):
+                calls.append(True)
+                return {'var': 'a'}
+
+        class NoKey(Uncached):
+            cache_timeout = 60
+
+            def get_cache_key(self, context, **kwargs):
+                return None
+
+        with TemplateTags(Uncached, NoKey):
+            tpl = template.Template('{% uncached %}{% no_key %}')
+        self.assertEqual(tpl.render(Context()), 'aa')
+        self.assertEqual(tpl.render(Context()), 'aa')
+        self.assertEqual(len(calls), 4)
+
+    def test_fragment_cache_backend(self):
+        class Cached(helpers.InclusionTag):
+            template = 'test.html'
+            cache_timeout = 60
+            cache_backend = 'missing'
+
+            def get_context(self, context):
+                return {'var': 'a'}
+
+        with TemplateTags(Cached):
+            tpl = template.Template('{% cached %}')
+        self.assertRaises(InvalidCacheBackendError, tpl.render, Context())
+
+
+class ParseCacheTests(TestCase):
+    def setUp(self):
+        core.parse_cache.clear()
+
+    def tearDown(self):
+        core.parse_cache.clear()
+
+    def _parser(self, **filters):
+        library = template.Library()
+        for name, func in filters.items():
+            library.filter(name, func)
+        return TemplateParser([], builtins=[library])
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(maxsize=2)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # 'b' was the least recently used entry
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.info(), utils.CacheInfo(2, 2, 1, 2, 2))
+        cache.clear()
+        self.assertEqual(cache.info(), utils.CacheInfo(0, 0, 0, 2, 0))
+
+    def test_cached_parse(self):
+        class Cached(core.Tag):
+            cache_parse = True
+            options = core.Options(
+                arguments.Argument('value'),
+                'as',
+                arguments.Argument('varname', resolve=False, required=False),
+            )
+
+        parser = self._parser()
+        token = Token(TokenType.BLOCK, 'cached "x" as y')
+        first = Cached(parser, token)
+        second = Cached(self._parser(), token)
+        self.assertEqual(core.parse_cache.info().hits, 1)
+        self.assertEqual(core.parse_cache.info().misses, 1)
+        self.assertEqual(first.kwargs.keys(), second.kwargs.keys())
+        self.assertIs(first.kwargs['value'], second.kwargs['value'])
+        self.assertIsNot(first.kwargs, second.kwargs)
+        self.assertEqual(second.kwargs['varname'].resolve({}), 'y')
+        Cached(parser, Token(TokenType.BLOCK, 'cached "z" as y'))
+        self.assertEqual(core.parse_cache.info().misses, 2)
+
+    def test_cached_parse_filter_changed(self):
+        class Cached(core.Tag):
+            cache_parse = True
+            options = core.Options(
+                arguments.Argument('value'),
+            )
+
+        def shout(value):
+            return value.upper()
+
+        def whisper(value):
+            return value.lower()
+
+        token = Token(TokenType.BLOCK, 'cached "Hi"|loud')
+        first = Cached(self._parser(loud=shout), token)
+        second = Cached(self._parser(loud=shout), token)
+        self.assertIs(first.kwargs['value'], second.kwargs['value'])
+        # another library registers a different 'loud' filter
+        third = Cached(self._parser(loud=whisper), token)
+        self.assertEqual(core.parse_cache.stale, 1)
+        self.assertEqual(third.kwargs['value'].resolve(Context()), 'hi')
+        # without the filter the tag fails to parse as it would uncached
+        self.assertRaises(template.TemplateSyntaxError,
+                          Cached, self._parser(), token)
+
+    def test_blocks_not_cached(self):
+        class Cached(core.Tag):
+            cache_parse = True
+            options = core.Options(
+                blocks=['end_cached'],
+            )
+
+            def render_tag(self, context, end_cached):
+                return end_cached.render(context)
+
+        with TemplateTags(Cached):
+            tpl = template.Template('{% cached %}a{% end_cached %}')
+            tpl = template.Template('{% cached %}a{% end_cached %}')
+        self.assertEqual(tpl.render(Context()), 'a')
+        self.assertEqual(len(core.parse_cache), 0)
+
+
+class MultiBreakpointTests(TestCase):
+    def test_optional_firstonly(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'also',
+            'using',
+            arguments.Argument('second', required=False),
+        )
+        # check only using the first argument
+        dummy_tokens = DummyTokens('firstval')
+        kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
+        self.assertEqual(blocks, {})
+        self.assertEqual(len(kwargs), 2)
+        dummy_context = {}
+        self.assertEqual(kwargs['first'].resolve(dummy_context), 'firstval')
+        self.assertEqual(kwargs['second'].resolve(dummy_context), None)
+
+    def test_optional_both(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'also',
+            'using',
+            arguments.Argument('second', required=False),
+        )
+        # check using both arguments and both breakpoints
+        dummy_tokens = DummyTokens('firstval', 'also', 'using', 'secondval')
+        kwargs, blocks = options.parse(dummy_parser, dummy_tokens)
+        self.assertEqual(blocks, {})
+        self.assertEqual(len(kwargs), 2)
+        dummy_context = {}
+        self.assertEqual(kwargs['first'].resolve(dummy_context), 'firstval')
+        self.assertEqual(kwargs['second'].resolve(dummy_context), 'secondval')
+
+    def test_partial_breakpoints(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'also',
+            'using',
+            arguments.Argument('second', required=False),
+        )
+        # check only using the first breakpoint
+        dummy_tokens = DummyTokens('firstval', 'also')
+        self.assertRaises(
+            exceptions.TrailingBreakpoint,
+            options.parse, dummy_parser, dummy_tokens
+        )
+
+    def test_partial_breakpoints_second(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'also',
+            'using',
+            arguments.Argument('second', required=False),
+        )
+        # check only using the second breakpoint
+        dummy_tokens = DummyTokens('firstval', 'using')
+        self.assertRaises(
+            exceptions.BreakpointExpected,
+            options.parse, dummy_parser, dummy_tokens
+        )
+
+    def test_partial_breakpoints_both(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'also',
+            'using',
+            arguments.Argument('second', required=False),
+        )
+        # check only using the first breakpoint
+        dummy_tokens = DummyTokens('firstval', 'also', 'secondval')
+        # should raise an exception
+        self.assertRaises(
+            exceptions.BreakpointExpected,
+            options.parse, dummy_parser, dummy_tokens
+        )
+
+    def test_partial_breakpoints_second_both(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'also',
+            'using',
+            arguments.Argument('second', required=False),
+        )
+        # check only using the second breakpoint
+        dummy_tokens = DummyTokens('firstval', 'using', 'secondval')
+        self.assertRaises(
+            exceptions.BreakpointExpected,
+            options.parse, dummy_parser, dummy_tokens
+        )
+
+    def test_partial_breakpoints_both_trailing(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'also',
+            'using',
+            arguments.Argument('second', required=False),
+        )
+        dummy_tokens = DummyTokens('firstval', 'also', 'using')
+        self.assertRaises(
+            exceptions.TrailingBreakpoint,
+            options.parse, dummy_parser, dummy_tokens
+        )
+
+    def test_add_options(self):
+        options1 = core.Options(
+            arguments.Argument('first')
+        )
+        options2 = core.Options(
+            arguments.Argument('second')
+        )
+        combined = options1 + options2
+        self.assertEqual(len(combined.options), 1, combined.options)
+        self.assertIn(None, combined.options)
+        self.assertEqual(len(combined.options[None]), 2, combined.options[None])
+        self.assertEqual(combined.all_argument_names, ['first', 'second'])
+        self.assertEqual(len(combined.blocks), 0, combined.blocks)
+
+    def test_add_options_blocks_first(self):
+        options1 = core.Options(
+            arguments.Argument('first'),
+            blocks=['a']
+        )
+        options2 = core.Options(
+            arguments.Argument('second'),
+        )
+        combined = options1 + options2
+        self.assertEqual(len(combined.blocks), 1, combined.blocks)
+        self.assertEqual(combined.blocks[0].alias, 'a')
+        self.assertEqual(combined.blocks[0].names, ('a', ))
+
+    def test_add_options_blocks_second(self):
+        options1 = core.Options(
+            arguments.Argument('first'),
+        )
+        options2 = core.Options(
+            arguments.Argument('second'),
+            blocks=['a']
+        )
+        combined = options1 + options2
+        self.assertEqual(len(combined.blocks), 1, combined.blocks)
+        self.assertEqual(combined.blocks[0].alias, 'a')
+        self.assertEqual(combined.blocks[0].names, ('a', ))
+
+    def test_add_options_blocks_both(self):
+        options1 = core.Options(
+            arguments.Argument('first'),
+            blocks=['a'],
+        )
+        options2 = core.Options(
+            arguments.Argument('second'),
+            blocks=['a']
+        )
+        self.assertRaises(
+            ValueError,
+            operator.add,
+            options1,
+            options2,
+        )
+
+    def test_add_options_not_options(self):
+        options = core.Options(
+            arguments.Argument('first'),
         )
         self.assertRaises(
             TypeError,
@@ -1464,6 +3653,70 @@ class MultiBreakpointTests(TestCase):
             '<Options:<Argument: first>,breakpoint,<Flag: flag>;block>'
         )
 
+    def test_parse_plan(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'also',
+            'using',
+            arguments.Argument('second', required=False),
+            blocks=['end_tag'],
+        )
+        plan = options.plan
+        self.assertEqual(plan.scopes, (None, 'also', 'using'))
+        self.assertEqual(plan.positions, {None: 0, 'also': 1, 'using': 2})
+        self.assertEqual(len(plan.arguments[0]), 1)
+        self.assertEqual(plan.arguments[1], ())
+        self.assertEqual(len(plan.arguments[2]), 1)
+        self.assertEqual(dict(plan.combined_breakpoints), {'also': 'using'})
+        self.assertEqual(
+            dict(plan.reversed_combined_breakpoints), {'using': 'also'}
+        )
+        # the plan is shared by all parses and never mutated by them
+        first = options.bootstrap()
+        second = options.bootstrap()
+        self.assertIs(first.plan, plan)
+        self.assertIs(second.plan, plan)
+        for _ in range(2):
+            argparser = parser.Parser(options)
+            argparser.parse_blocks = lambda: None
+            dummy_tokens = DummyTokens('firstval', 'also', 'using', 'second')
+            kwargs, blocks = argparser.parse(dummy_parser, dummy_tokens)
+            self.assertEqual(kwargs['second'].resolve({}), 'second')
+        self.assertEqual(plan.scopes, (None, 'also', 'using'))
+        self.assertEqual(len(plan.blocks), 1)
+
+    def test_structured_options_cursor(self):
+        options = core.Options(
+            arguments.Argument('first'),
+            'as',
+            arguments.Argument('second'),
+            'using',
+            arguments.Argument('third'),
+        )
+        structured = options.bootstrap()
+        self.assertEqual(structured.current_breakpoint, None)
+        self.assertEqual(structured.next_breakpoint, 'as')
+        self.assertEqual(structured.breakpoints, ('using',))
+        self.assertTrue(structured.is_future_breakpoint('using'))
+        self.assertFalse(structured.is_future_breakpoint('as'))
+        self.assertFalse(structured.is_future_breakpoint('first'))
+        self.assertEqual(
+            [arg.name for arg in structured.get_arguments()], ['first']
+        )
+        structured.shift_breakpoint()
+        self.assertEqual(structured.current_breakpoint, 'as')
+        self.assertEqual(structured.next_breakpoint, 'using')
+        self.assertEqual(structured.breakpoints, ())
+        self.assertFalse(structured.is_future_breakpoint('using'))
+        structured.shift_breakpoint()
+        self.assertEqual(structured.current_breakpoint, 'using')
+        self.assertEqual(structured.next_breakpoint, None)
+        self.assertEqual(
+            [arg.name for arg in structured.get_arguments()], ['third']
+        )
+        # a fresh cursor starts at the beginning again
+        self.assertEqual(options.bootstrap().current_breakpoint, None)
+
     def test_flatten_context(self):
         context = Context({'foo': 'bar'})
         context.push()
@@ -1485,6 +3738,57 @@ class MultiBreakpointTests(TestCase):
         flat = utils.flatten_context({'foo': 'test', 'bar': 'baz'})
         self.assertEqual(flat, {'foo': 'test', 'bar': 'baz'})
 
+    def test_flatten_nested_context(self):
+        inner = Context({'foo': 'inner', 'bar': 'inner'})
+        context = Context({'foo': 'outer'})
+        context.dicts.append(inner)
+        context.push(bar='top')
+        context.flatten = None
+        self.assertEqual(
+            utils.context_dicts(context),
+            [context.dicts[0], {'foo': 'outer'}, inner.dicts[0],
+             {'foo': 'inner', 'bar': 'inner'}, {'bar': 'top'}],
+        )
+        flat = utils.flatten_context(context)
+        self.assertEqual((flat['foo'], flat['bar']), ('inner', 'top'))
+        view = utils.lazy_flatten_context(context)
+        self.assertEqual(dict(view), flat)
+        # deeply nested contexts do not recurse
+        deep = Context({'depth': 0})
+        for index in range(1, sys.getrecursionlimit() + 10):
+            parent = Context({'depth': index})
+            parent.dicts.append(deep)
+            deep = parent
+        deep.flatten = None
+        self.assertEqual(utils.flatten_context(deep)['depth'], 0)
+        self.assertEqual(utils.lazy_flatten_context(deep)['depth'], 0)
+
+    def test_lazy_flatten_context(self):
+        context = Context({'foo': 'bar', 'bar': 'baz'})
+        context.push(foo='test')
+        view = utils.lazy_flatten_context(context)
+        self.assertIsInstance(view, utils.FlatContext)
+        self.assertEqual(dict(view), context.flatten())
+        self.assertEqual(view['foo'], 'test')
+        # writes do not touch the context
+        view['foo'] = 'view'
+        view.update(new=True)
+        self.assertEqual((view['foo'], view['new']), ('view', True))
+        self.assertEqual(len(view.maps), 4)
+        self.assertEqual(context.flatten()['foo'], 'test')
+        self.assertNotIn('new', context)
+        # removing a key of the context materializes the view
+        del view['bar']
+        self.assertEqual(len(view.maps), 1)
+        self.assertNotIn('bar', view)
+        self.assertEqual(view.pop('foo'), 'view')
+        self.assertEqual(context['bar'], 'baz')
+        view.clear()
+        self.assertEqual(dict(view), {})
+        self.assertEqual(
+            dict(utils.lazy_flatten_context({'foo': 'bar'})), {'foo': 'bar'}
+        )
+
     def test_flatten_requestcontext(self):
         factory = RequestFactory()
         request = factory.get('/')